@@ -1,2 +1,17 @@
-from .random_language_agent import RandomLLMAgent
-from .mistral_agent import MistralAgent
\ No newline at end of file
+# The agents are imported on first access, so that importing a submodule
+# (e.g. `agents.dialogue_log`) does not load civrealm and the LLM clients.
+_AGENTS = {
+    "RandomLLMAgent": ".random_language_agent",
+    "MistralAgent": ".mistral_agent",
+}
+
+__all__ = list(_AGENTS)
+
+
+def __getattr__(name):
+    if name not in _AGENTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import importlib
+    value = getattr(importlib.import_module(_AGENTS[name], __name__), name)
+    globals()[name] = value
+    return value
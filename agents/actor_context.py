@@ -0,0 +1,178 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Per-actor conversation state.
+
+An actor is first described with a full prompt. Its follow-up requests only
+send what changed since the last request (tiles, blocks, fields, actions),
+after a bounded history of the previous exchanges. A full prompt is sent
+again every `resync_every` requests, and the state of actors which left
+`info['llm_info']` is dropped.
+"""
+
+import json
+import threading
+from collections import deque
+
+import config
+from .prompt_encoder import answer_schema, group_actions
+
+DIFF_ACTOR_PROMPT = """Update for {name} since your last decision:
+{changes}
+
+You must choose one action from: {actions}
+
+Reply with only this JSON object, without markdown:
+{schema}
+"""
+
+
+def _flatten(actor: dict) -> dict:
+    """{field: value} of an actor, with one field per tile and block."""
+    flat = {}
+    for key, value in actor.items():
+        if key not in ('name', 'available_actions', 'observations'):
+            flat[key] = value
+    for key, value in actor.get('observations', {}).items():
+        if key in ('minimap', 'upper_map') and isinstance(value, dict):
+            flat.update(value)
+        else:
+            flat[key] = value
+    return flat
+
+
+def _describe(value) -> str:
+    if isinstance(value, list) and all(isinstance(item, str) for item in value):
+        return ", ".join(value) or "-"
+    return json.dumps(value, separators=(",", ":"))
+
+
+def describe_changes(previous: dict, actor: dict, previous_actions: list) -> str:
+    """The changes of `actor` since the flattened state `previous`."""
+    lines = []
+    current = _flatten(actor)
+    for key, value in current.items():
+        if previous.get(key) != value:
+            lines.append(f"{key}: {_describe(value)}")
+    for key in previous:
+        if key not in current:
+            lines.append(f"{key}: removed")
+    actions = actor['available_actions']
+    new_actions = [action for action in actions if action not in
+                   previous_actions]
+    gone_actions = [action for action in previous_actions if action not in
+                    actions]
+    if new_actions:
+        lines.append("new actions: " + group_actions(new_actions))
+    if gone_actions:
+        lines.append("removed actions: " + group_actions(gone_actions))
+    return "\n".join(lines) or "nothing changed"
+
+
+class ActorContext:
+    """What was sent to the LLM about an actor, and the last exchanges."""
+    def __init__(self, history: int):
+        self.state = {}
+        self.actions = []
+        self.messages = deque(maxlen=2 * history)
+        self.requests_since_sync = 0
+
+
+class ActorContextStore:
+    """
+    Parameters
+    ----------
+    history: int, exchanges (request and answer) kept per actor, at least
+        `resync_every - 1`, so that the diffs never outlive the full prompt
+        they are based on.
+    resync_every: int, a full prompt is sent every `resync_every` requests.
+    """
+    def __init__(self,
+                 history: int = config.ACTOR_CONTEXT_HISTORY,
+                 resync_every: int = config.ACTOR_CONTEXT_RESYNC):
+        if history < resync_every - 1:
+            raise ValueError(
+                f"An actor context history of {history} exchanges drops " +
+                f"the full prompt sent every {resync_every} requests: " +
+                f"keep at least {resync_every - 1} exchanges.")
+        self.history = history
+        self.resync_every = resync_every
+        self.contexts = {}
+        self._lock = threading.Lock()
+
+    def build_messages(self, key: tuple, actor: dict,
+                       full_prompt: callable) -> tuple:
+        """
+        The chat messages of a request about `actor`: the history, then the
+        changes since the last answered request, or `full_prompt(actor)`
+        when the actor is new or due for a resync.
+
+        Returns
+        -------
+        (messages, ticket): the ticket is passed to `record` once the
+            request is answered. Nothing changes until then.
+        """
+        with self._lock:
+            context = self.contexts.get(key)
+            if context is None:
+                context = self.contexts[key] = ActorContext(self.history)
+            ticket = (context, context.requests_since_sync)
+            state, actions = context.state, context.actions
+            history = list(context.messages)
+        if ticket[1] % self.resync_every == 0:
+            history, content = [], full_prompt(actor)
+        else:
+            content = DIFF_ACTOR_PROMPT.format(
+                name=actor['name'],
+                changes=describe_changes(state, actor, actions),
+                actions=group_actions(actor['available_actions']),
+                schema=answer_schema())
+        return history + [{"role": "user", "content": content}], ticket
+
+    def record(self, key: tuple, ticket: tuple, actor: dict, request: dict,
+               action_name: str):
+        """
+        Append an answered exchange to the history of the actor, which
+        becomes the baseline of its next diff. An answer arriving after the
+        actor was reset, or after a later request was answered, is ignored.
+        """
+        context, requests_since_sync = ticket
+        with self._lock:
+            if self.contexts.get(key) is not context or \
+                    context.requests_since_sync != requests_since_sync:
+                return
+            if requests_since_sync % self.resync_every == 0:
+                context.messages.clear()
+                context.requests_since_sync = 0
+            context.messages.append(request)
+            context.messages.append({
+                "role": "assistant",
+                "content": json.dumps({"action_name": action_name})
+            })
+            context.state = _flatten(actor)
+            context.actions = list(actor['available_actions'])
+            context.requests_since_sync += 1
+
+    def reset(self, key: tuple):
+        """Forget the actor, e.g. when the LLM did not get the request."""
+        with self._lock:
+            self.contexts.pop(key, None)
+
+    def evict(self, llm_info: dict):
+        """Drop the actors which are not in `llm_info` anymore."""
+        with self._lock:
+            for key in list(self.contexts):
+                if key[1] not in llm_info.get(key[0], {}):
+                    del self.contexts[key]
@@ -0,0 +1,122 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Once-per-turn advisor.
+
+The advisor sees the whole empire (cities, units, visible enemies) and the
+zoomed-out map of `MapAggregator`, and answers one suggestion per turn with
+the `advisor_instruction` prompt. The suggestion is then sent with every
+actor request of the turn, so that the empire-level reasoning is done once
+instead of once per actor.
+"""
+
+from collections import Counter
+
+import config
+from .map_aggregator import MapAggregator
+from .output_parser import ParseError, extract_json
+from .prompt_handlers.base_prompt_handler import BasePromptHandler
+
+ADVICE_PROMPT = """The advisor of our civilization suggests for this turn:
+{advice}
+Follow the suggestion when it applies to you."""
+
+
+def my_player_id(observations: dict, llm_info: dict):
+    """Our player id: the owner of the units we control, or None."""
+    units = observations.get('unit', {})
+    for unit_id in llm_info.get('unit', {}):
+        if unit_id in units:
+            return units[unit_id].get('owner')
+    return None
+
+
+class Advisor:
+    """
+    Parameters
+    ----------
+    prompt_solution: str, the prompt collection of the advisor prompts.
+    max_blocks: int, blocks of the zoomed-out map shown to the advisor.
+    """
+    def __init__(self,
+                 prompt_solution: str = config.PROMPT_SOLUTIONS["vanilla"],
+                 max_blocks: int = config.ADVISOR_MAX_BLOCKS):
+        self.prompt_handler = BasePromptHandler(prompt_solution)
+        self.max_blocks = max_blocks
+        self.aggregator = MapAggregator()
+
+    def summary(self, observations: dict, llm_info: dict) -> str:
+        """The empire and the zoomed-out map, in words."""
+        player_id = my_player_id(observations, llm_info)
+        cities = observations.get('city', {}).values()
+        units = observations.get('unit', {}).values()
+        sizes = [city.get('size') for city in cities
+                 if city.get('owner') == player_id]
+        ours = Counter(unit.get('type_rule_name') for unit in units
+                       if unit.get('owner') == player_id)
+        enemy_units = sum(1 for unit in units
+                          if unit.get('owner') != player_id)
+        enemy_cities = sum(1 for city in cities
+                           if city.get('owner') != player_id)
+        lines = [
+            f"We have {len(sizes)} cities" +
+            (f" of sizes {', '.join(str(size) for size in sizes)}."
+             if sizes else "."),
+            f"We have {sum(ours.values())} units" +
+            (": " + ", ".join(f"{count} {kind}"
+                              for kind, count in ours.most_common()) + "."
+             if ours else "."),
+            f"We can see {enemy_units} units and {enemy_cities} cities of " +
+            "other civilizations."
+        ]
+        if 'map' in observations:
+            self.aggregator.update(observations['map'])
+            blocks = self.aggregator.zoomed_out_map(player_id,
+                                                    self.max_blocks)
+            lines.append("The zoomed-out observation is {" + ", ".join(
+                f"{name}: [{', '.join(description)}]"
+                for name, description in blocks.items()) + "}.")
+        return "\n".join(lines)
+
+    def messages(self, observations: dict, llm_info: dict) -> list:
+        """The system and user messages of the advisor request."""
+        return [{
+            "role": "system",
+            "content": self.prompt_handler.generate("advisor_instruction")
+        }, {
+            "role": "user",
+            "content": self.prompt_handler.generate("advisor_advise") +
+            "\n" + self.summary(observations, llm_info)
+        }]
+
+    @staticmethod
+    def parse(llm_output: str) -> str:
+        """
+        The suggestion of an advisor answer. The examples of the prompt put
+        it in command.input.suggestion or command.input.action.
+
+        Raises
+        ------
+        ParseError: "missing_action" if there is no suggestion.
+        """
+        parsed, _ = extract_json(llm_output)
+        command = parsed.get("command") if isinstance(parsed, dict) else None
+        inputs = command.get("input") if isinstance(command, dict) else None
+        if isinstance(inputs, dict):
+            for key in ("suggestion", "action"):
+                if isinstance(inputs.get(key), str) and inputs[key].strip():
+                    return inputs[key].strip()
+        raise ParseError("missing_action", "No suggestion in the advice.")
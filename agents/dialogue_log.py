@@ -0,0 +1,301 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Buffered dialogue log.
+
+`DialogueLogWriter` appends dialogue records from a background thread into
+rotating gzip-compressed JSONL segments, each with a small `.idx.json`
+sidecar indexing its records by turn and actor, written when the segment is
+closed. `DialogueLogReader` uses the sidecars to fetch dialogues without
+decompressing unrelated segments, and scans the segment being written.
+
+Usage:
+    python -m agents.dialogue_log saved_dialogues --turn 12 --actor "Settlers 103"
+"""
+
+import argparse
+import atexit
+import gzip
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+import zlib
+
+from civrealm.freeciv.utils.freeciv_logging import fc_logger
+
+import config
+
+SEGMENT_SUFFIX = ".jsonl.gz"
+INDEX_SUFFIX = ".idx.json"
+
+
+class DialogueLogWriter:
+    """
+    Appends dialogue records to `directory` from a background thread.
+
+    Records are queued in a bounded queue (callers block when the writer
+    falls behind), written in batches, and flushed at least every
+    `flush_interval` seconds. A new segment is started every
+    `segment_records` records. Every record gets a unique sequence number,
+    so that no dialogue overwrites another. The directory and the thread
+    are only created at the first record.
+    """
+    def __init__(self,
+                 directory: str,
+                 segment_records: int = config.DIALOGUE_SEGMENT_RECORDS,
+                 queue_size: int = config.DIALOGUE_QUEUE_SIZE,
+                 batch_size: int = config.DIALOGUE_BATCH_SIZE,
+                 flush_interval: float = config.DIALOGUE_FLUSH_INTERVAL):
+        self.directory = directory
+        self.segment_records = segment_records
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.run_id = time.strftime("%Y%m%d_%H%M%S") + f"_{os.getpid()}"
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._seq = itertools.count()
+        self._segment_index = 0
+        self._segment_records = 0
+        self._segment_path = None
+        self._segment_file = None
+        self._segment_turns = {}
+        self._closed = False
+        self.dropped = 0
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._close_lock = threading.Lock()
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self._thread = threading.Thread(target=self._run,
+                                            name="dialogue_log",
+                                            daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def write(self, record: dict):
+        """
+        Queue a record; `seq` and `time` fields are added. Records written
+        after `close` (e.g. late LLM answers) are dropped.
+        """
+        # Not queued behind the end marker, which nobody would read.
+        with self._close_lock:
+            if self._closed:
+                if not self.dropped:
+                    fc_logger.warning("Dialogue log closed, dropping late " +
+                                      "records.")
+                self.dropped += 1
+                return
+            if self._thread is None:
+                self._start()
+            record = dict(record, seq=next(self._seq), time=time.time())
+            self._queue.put(record)
+
+    def close(self):
+        """Flush the queued records and close the current segment."""
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._thread is None:
+                return
+            self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        running = True
+        while running:
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                running = False
+                batch = [record for record in batch if record is not None]
+            try:
+                self._write_batch(batch)
+            except Exception as einfo:
+                fc_logger.error(f"Failed to write dialogue log: {einfo!r}")
+        self._close_segment()
+
+    def _write_batch(self, batch: list):
+        for record in batch:
+            if self._segment_file is None:
+                self._open_segment()
+            self._segment_file.write(
+                json.dumps(record, ensure_ascii=False) + "\n")
+            actors = self._segment_turns.setdefault(str(record.get("turn")),
+                                                    {})
+            actors.setdefault(str(record.get("actor")),
+                              []).append(self._segment_records)
+            self._segment_records += 1
+            if self._segment_records >= self.segment_records:
+                self._close_segment()
+        if self._segment_file is not None:
+            # Sync flush: the segment stays readable while it is written.
+            # Its index is only written once it is closed.
+            self._segment_file.flush()
+
+    def _open_segment(self):
+        self._segment_path = os.path.join(
+            self.directory,
+            f"dialogues_{self.run_id}_{self._segment_index:05d}" +
+            SEGMENT_SUFFIX)
+        self._segment_file = gzip.open(self._segment_path,
+                                       "wt",
+                                       encoding="utf-8",
+                                       compresslevel=6)
+        self._segment_index += 1
+        self._segment_records = 0
+        self._segment_turns = {}
+
+    def _write_index(self):
+        with open(self._segment_path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX,
+                  "w",
+                  encoding="utf-8") as filep:
+            json.dump({"records": self._segment_records,
+                       "turns": self._segment_turns}, filep)
+
+    def _close_segment(self):
+        if self._segment_file is None:
+            return
+        self._segment_file.close()
+        self._write_index()
+        self._segment_file = None
+
+
+class DialogueLogReader:
+    """Reads the dialogue segments of a directory, in writing order."""
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def segments(self) -> list:
+        return sorted(
+            os.path.join(self.directory, fname)
+            for fname in os.listdir(self.directory)
+            if fname.endswith(SEGMENT_SUFFIX))
+
+    @staticmethod
+    def load_index(segment: str):
+        try:
+            with open(segment[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX,
+                      "r",
+                      encoding="utf-8") as filep:
+                return json.load(filep)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def read_segment(segment: str):
+        """Yields the records of a segment, which may still be written."""
+        with gzip.open(segment, "rt", encoding="utf-8") as filep:
+            try:
+                for line in filep:
+                    if line.endswith("\n"):
+                        yield json.loads(line)
+            except (EOFError, zlib.error):
+                # The segment is being written and has no gzip trailer yet.
+                return
+
+    def __iter__(self):
+        for segment in self.segments():
+            yield from self.read_segment(segment)
+
+    def index(self) -> dict:
+        """Returns {turn: {actor: record count}} over all segments."""
+        out = {}
+        for segment in self.segments():
+            seg_index = self.load_index(segment)
+            if seg_index is None:
+                seg_index = {"turns": {}}
+                for number, record in enumerate(self.read_segment(segment)):
+                    seg_index["turns"].setdefault(
+                        str(record.get("turn")),
+                        {}).setdefault(str(record.get("actor")),
+                                       []).append(number)
+            for turn, actors in seg_index["turns"].items():
+                for actor, numbers in actors.items():
+                    counts = out.setdefault(turn, {})
+                    counts[actor] = counts.get(actor, 0) + len(numbers)
+        return out
+
+    def find(self, turn=None, actor: str = None) -> list:
+        """
+        Fetch dialogues by turn and/or actor name.
+
+        Segments whose index has no matching record are not decompressed.
+        """
+        turn = None if turn is None else str(turn)
+        found = []
+        for segment in self.segments():
+            seg_index = self.load_index(segment)
+            if seg_index is not None:
+                wanted = set()
+                for seg_turn, actors in seg_index["turns"].items():
+                    if turn is not None and seg_turn != turn:
+                        continue
+                    for seg_actor, numbers in actors.items():
+                        if actor is None or seg_actor == actor:
+                            wanted.update(numbers)
+                if not wanted:
+                    continue
+                found += [
+                    record
+                    for number, record in enumerate(self.read_segment(segment))
+                    if number in wanted
+                ]
+                continue
+            found += [
+                record for record in self.read_segment(segment)
+                if (turn is None or str(record.get("turn")) == turn) and (
+                    actor is None or str(record.get("actor")) == actor)
+            ]
+        return found
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fetch saved LLM dialogues by turn and actor.")
+    parser.add_argument("directory", nargs="?", default="saved_dialogues")
+    parser.add_argument("--turn", type=int, default=None)
+    parser.add_argument("--actor", default=None)
+    parser.add_argument("--index",
+                        action="store_true",
+                        help="print the number of dialogues per turn/actor")
+    args = parser.parse_args()
+
+    reader = DialogueLogReader(args.directory)
+    if args.index:
+        print(json.dumps(reader.index(), indent=2))
+        return
+    for record in reader.find(args.turn, args.actor):
+        print(f"=== Turn {record.get('turn')}, {record.get('actor')}, " +
+              f"seq {record.get('seq')} ===")
+        print(f"Prompt:\n{record.get('prompt')}\n\n" +
+              f"LLM Output:\n{record.get('llm_output')}\n")
+
+
+if __name__ == '__main__':
+    main()
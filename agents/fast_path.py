@@ -0,0 +1,207 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Decisions which do not need the LLM.
+
+`FastPath.decide` answers forced or predictable choices (a single available
+action, only passive actions, per actor type rules, continued activities)
+and choices the LLM keeps making for the same actor type and set of
+actions. Every decision is counted as `fast_path.<rule>[<actor type>]`.
+"""
+
+import hashlib
+import os
+import threading
+from collections import Counter
+
+import config
+from .metrics import actor_type
+from .prompt_encoder import normalize_action
+
+
+def action_signature(available_actions: list) -> str:
+    """A short digest of a set of actions, independent of their order."""
+    names = sorted({normalize_action(action) for action in available_actions})
+    return hashlib.sha1("|".join(names).encode("utf-8")).hexdigest()[:16]
+
+
+class FastPath:
+    """
+    Parameters
+    ----------
+    rules: dict, per actor type, actions taken whenever available, in order.
+    passive_actions: tuple, actions leaving a unit as it is, in order of
+        preference; an actor having only variants of them takes the first.
+    continued_actions: tuple, multi-turn activities, continued with
+        `continue_action` while the available actions stay the same.
+    learned: bool, if True, repeat what the LLM agreed on, see `learn`.
+    """
+    def __init__(self,
+                 rules: dict = config.FAST_PATH_RULES,
+                 passive_actions: tuple = config.FAST_PATH_PASSIVE_ACTIONS,
+                 continued_actions: tuple = config.FAST_PATH_CONTINUED_ACTIONS,
+                 continue_action: str = config.FAST_PATH_CONTINUE_ACTION,
+                 continue_turns: int = config.FAST_PATH_CONTINUE_TURNS,
+                 learned: bool = config.FAST_PATH_LEARNED,
+                 min_samples: int = config.FAST_PATH_LEARNED_MIN_SAMPLES,
+                 min_agreement: float = config.FAST_PATH_LEARNED_MIN_AGREEMENT):
+        self.rules = rules
+        self.passive_actions = tuple(passive_actions)
+        self.continued_actions = set(continued_actions)
+        self.continue_action = continue_action
+        self.continue_turns = continue_turns
+        self.learned = learned
+        self.min_samples = min_samples
+        self.min_agreement = min_agreement
+        # (actor type, action signature) -> Counter of the LLM choices
+        self.choices = {}
+        # (ctrl_type, actor_id) -> (turn, activity, signature, continued)
+        self.activities = {}
+        self._lock = threading.Lock()
+
+    def decide(self, key, actor: dict, turn):
+        """
+        Returns (action_name, rule), or None if the LLM has to decide.
+        `key` is the (ctrl_type, actor_id) of `actor`.
+        """
+        available_actions = actor['available_actions']
+        if len(available_actions) == 1:
+            return available_actions[0], "single_option"
+
+        kind = actor_type(actor['name'])
+        names = {normalize_action(action): action
+                 for action in available_actions}
+        if all(name.startswith(self.passive_actions) for name in names):
+            for passive in self.passive_actions:
+                if passive in names:
+                    return names[passive], "passive"
+            return available_actions[0], "passive"
+
+        for action in self.rules.get(kind, ()):
+            action = normalize_action(action)
+            if action in names:
+                return names[action], "rule"
+
+        signature = action_signature(available_actions)
+        activity = self.activities.get(key)
+        if activity is not None and self.continue_action in names:
+            last_turn, name, last_signature, continued = activity
+            if last_turn == turn - 1 and last_signature == signature and \
+                    name in self.continued_actions and \
+                    continued < self.continue_turns:
+                return names[self.continue_action], "continue"
+
+        if self.learned:
+            with self._lock:
+                counts = self.choices.get((kind, signature))
+                if counts is not None:
+                    total = sum(counts.values())
+                    name, count = counts.most_common(1)[0]
+                    if total >= self.min_samples and name in names and \
+                            count >= self.min_agreement * total:
+                        return names[name], "learned"
+        return None
+
+    def guess(self, actor: dict):
+        """
+        The available action the LLM chose most often for the actor type and
+        set of actions, however rarely, or None.
+        """
+        kind = actor_type(actor['name'])
+        names = {normalize_action(action): action
+                 for action in actor['available_actions']}
+        with self._lock:
+            counts = self.choices.get(
+                (kind, action_signature(actor['available_actions'])))
+            ranked = counts.most_common() if counts is not None else ()
+        for name, _ in ranked:
+            if name in names:
+                return names[name]
+        return None
+
+    def previous(self, key, actor: dict, turn):
+        """
+        The action of the actor at the previous turn, if available again, or
+        None.
+        """
+        activity = self.activities.get(key)
+        if activity is None or activity[0] != turn - 1:
+            return None
+        names = {normalize_action(action): action
+                 for action in actor['available_actions']}
+        if activity[3] > 0 and self.continue_action in names:
+            # It was continuing its activity.
+            return names[self.continue_action]
+        return names.get(activity[1])
+
+    def record(self, key, actor: dict, turn, action_name: str):
+        """Remember the action taken by the actor this turn, however chosen."""
+        name = normalize_action(action_name)
+        signature = action_signature(actor['available_actions'])
+        activity = self.activities.get(key)
+        if name == self.continue_action and activity is not None and \
+                activity[0] == turn - 1:
+            # Still the same activity.
+            self.activities[key] = (turn, activity[1], signature,
+                                    activity[3] + 1)
+        else:
+            self.activities[key] = (turn, name, signature, 0)
+
+    def learn(self, actor: dict, action_name: str, signature: str = None):
+        """Count an action the LLM chose for the actor."""
+        if not self.learned:
+            return
+        kind = actor_type(actor['name'])
+        signature = signature or action_signature(actor['available_actions'])
+        with self._lock:
+            self.choices.setdefault((kind, signature),
+                                    Counter())[normalize_action(action_name)] += 1
+
+    def learn_from_dialogues(
+            self,
+            directory: str,
+            max_segments: int = config.FAST_PATH_LEARNED_SEGMENTS,
+            skip_run: str = None) -> int:
+        """
+        Count the LLM choices of the last `max_segments` dialogue segments of
+        `directory`, except those of the run `skip_run` (already learned
+        from as they are made). Returns the number of dialogues learned from.
+        """
+        if not self.learned or not os.path.isdir(directory):
+            return 0
+        from .dialogue_log import DialogueLogReader
+        segments = [
+            segment for segment in DialogueLogReader(directory).segments()
+            if skip_run is None or f"_{skip_run}_" not in segment
+        ][-max_segments:] if max_segments > 0 else []
+        learned = 0
+        for segment in segments:
+            for record in DialogueLogReader.read_segment(segment):
+                if record.get("source") != "llm" or \
+                        not record.get("signature"):
+                    continue
+                self.learn({'name': record.get("actor", "")},
+                           record["action_name"], record["signature"])
+                learned += 1
+        return learned
+
+    def forget(self, llm_info: dict):
+        """Drop the activities of the actors which left `llm_info`."""
+        self.activities = {
+            key: activity
+            for key, activity in self.activities.items()
+            if key[1] in llm_info.get(key[0], {})
+        }
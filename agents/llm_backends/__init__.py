@@ -0,0 +1,88 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Pluggable LLM backends.
+
+`config.LLM_BACKEND` selects the backend and `config.LLM_MODEL` (or the
+backend's entry of `config.LLM_MODELS`) its model. Each backend keeps a pool
+of keep-alive connections, shared by the agent threads through
+`get_backend()`. SDKs are imported when a backend is created, so that only
+the selected backend's dependencies need to be installed.
+"""
+
+import threading
+
+import config
+from .base import LLMBackend, LLMHTTPError, LLMResponse, StreamedText
+
+
+def _mistral(model):
+    from .mistral import MistralBackend
+    return MistralBackend(model)
+
+
+def _openai(model):
+    from .openai_compat import OpenAICompatibleBackend
+    return OpenAICompatibleBackend.from_env(model)
+
+
+def _local(model):
+    from .openai_compat import LocalHTTPBackend
+    return LocalHTTPBackend(model=model)
+
+
+def _mock(model):
+    from .mock import MockBackend
+    return MockBackend(model=model)
+
+
+# Backend name -> factory(model)
+BACKENDS = {
+    "mistral": _mistral,
+    "openai": _openai,
+    "local": _local,
+    "mock": _mock,
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def create_backend(name: str = None, model: str = None) -> LLMBackend:
+    """Create the backend `name` (default `config.LLM_BACKEND`)."""
+    name = name or config.LLM_BACKEND
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown LLM backend {name!r}, expected one of " +
+                         ", ".join(sorted(BACKENDS)))
+    return BACKENDS[name](model or config.LLM_MODEL or config.LLM_MODELS[name])
+
+
+def get_backend() -> LLMBackend:
+    """The process-wide backend, created on first use."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = create_backend()
+        return _backend
+
+
+def set_backend(backend: LLMBackend):
+    """Replace the process-wide backend, e.g. by a configured mock."""
+    global _backend
+    with _backend_lock:
+        previous, _backend = _backend, backend
+    if previous is not None and previous is not backend:
+        previous.close()
@@ -0,0 +1,132 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+
+
+class LLMResponse:
+    """The text of a chat completion and the tokens billed for it."""
+    def __init__(self,
+                 content: str,
+                 model: str,
+                 prompt_tokens: int = 0,
+                 completion_tokens: int = 0):
+        self.content = content
+        self.model = model
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+
+
+class StreamedText(str):
+    """
+    The text of a completion read until it was good enough, see
+    `LLMBackend.complete_until`. `rest` is a future of the whole completion
+    when the rest is read in the background, else None.
+    """
+    def __new__(cls, text: str, rest=None):
+        streamed = super().__new__(cls, text)
+        streamed.rest = rest
+        return streamed
+
+
+class LLMHTTPError(Exception):
+    """
+    An HTTP error answered by the server. `status_code` and the `response`
+    headers (e.g. Retry-After) drive the retries of the rate limiter.
+    """
+    def __init__(self, status_code: int, response=None, message: str = ""):
+        super().__init__(f"LLM server answered {status_code}: {message}")
+        self.status_code = status_code
+        self.response = response
+
+
+class LLMBackend:
+    """
+    Interface of the LLM backends.
+
+    `messages` are chat messages, [{"role": ..., "content": ...}, ...].
+    Subclasses implement `complete`, and `stream` if the server can stream.
+    """
+    name = "base"
+
+    def __init__(self,
+                 model: str,
+                 timeout: float = config.LLM_REQUEST_TIMEOUT,
+                 pool_size: int = config.LLM_POOL_SIZE):
+        self.model = model
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._executor = None
+
+    def complete(self, messages: list, **kwargs) -> LLMResponse:
+        raise NotImplementedError()
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.pool_size,
+                thread_name_prefix=f"{self.name}_worker")
+        return self._executor
+
+    def complete_batch(self, batch: list, **kwargs) -> list:
+        """Complete every messages list of `batch`, concurrently."""
+        return list(self._get_executor().map(
+            lambda messages: self.complete(messages, **kwargs), batch))
+
+    def stream(self, messages: list, **kwargs):
+        """Yields the completion by chunks of text as they arrive."""
+        yield self.complete(messages, **kwargs).content
+
+    def complete_until(self,
+                       messages: list,
+                       stop: callable,
+                       rest: str = "cancel",
+                       **kwargs) -> LLMResponse:
+        """
+        Stream the completion until `stop(text read so far)` is True.
+
+        Parameters
+        ----------
+        rest: str, what to do with the rest of the completion: "cancel"
+            closes the stream, so that the server stops generating it;
+            "background" reads it in the background, see `StreamedText`.
+
+        Returns
+        -------
+        LLMResponse, with a `StreamedText` content if the stream was stopped
+            early. The tokens are not counted.
+        """
+        chunks = self.stream(messages, **kwargs)
+        text = ""
+        for chunk in chunks:
+            text += chunk
+            if stop(text):
+                break
+        else:
+            return LLMResponse(text, self.model)
+        if rest == "background":
+            future = self._get_executor().submit(
+                lambda: text + "".join(chunks))
+            return LLMResponse(StreamedText(text, future), self.model)
+        if hasattr(chunks, "close"):
+            chunks.close()
+        return LLMResponse(StreamedText(text), self.model)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
@@ -0,0 +1,67 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+import config
+from .base import LLMBackend, LLMResponse
+
+
+class MistralBackend(LLMBackend):
+    """
+    Mistral chat API through the `mistralai` SDK, on a pooled keep-alive
+    `httpx` client. Needs MISTRAL_API_KEY.
+    """
+    name = "mistral"
+
+    def __init__(self,
+                 model: str = config.LLM_MODELS["mistral"],
+                 api_key: str = None,
+                 timeout: float = config.LLM_REQUEST_TIMEOUT,
+                 pool_size: int = config.LLM_POOL_SIZE):
+        super().__init__(model, timeout, pool_size)
+        import httpx
+        from mistralai import Mistral
+
+        self.http = httpx.Client(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=pool_size,
+                                max_keepalive_connections=pool_size))
+        self.client = Mistral(api_key=api_key or os.environ["MISTRAL_API_KEY"],
+                              client=self.http,
+                              timeout_ms=int(timeout * 1000))
+
+    def complete(self, messages: list, **kwargs) -> LLMResponse:
+        response = self.client.chat.complete(model=self.model,
+                                             messages=messages,
+                                             **kwargs)
+        usage = getattr(response, "usage", None)
+        return LLMResponse(response.choices[0].message.content, self.model,
+                           getattr(usage, "prompt_tokens", 0) or 0,
+                           getattr(usage, "completion_tokens", 0) or 0)
+
+    def stream(self, messages: list, **kwargs):
+        events = self.client.chat.stream(model=self.model,
+                                         messages=messages,
+                                         **kwargs)
+        with events:
+            for event in events:
+                content = event.data.choices[0].delta.content
+                if content:
+                    yield content
+
+    def close(self):
+        super().close()
+        self.http.close()
@@ -0,0 +1,50 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import config
+from .base import LLMBackend, LLMResponse
+
+
+class MockBackend(LLMBackend):
+    """
+    The simulated server of `agents.mock_llm`, for offline runs and
+    benchmarks. `client` is a configured `MockLLMClient`.
+    """
+    name = "mock"
+
+    def __init__(self,
+                 client=None,
+                 model: str = config.LLM_MODELS["mock"],
+                 timeout: float = config.LLM_REQUEST_TIMEOUT,
+                 pool_size: int = config.LLM_POOL_SIZE):
+        super().__init__(model, timeout, pool_size)
+        if client is None:
+            from ..mock_llm import MockLLMClient
+            client = MockLLMClient()
+        self.client = client
+
+    def complete(self, messages: list, **kwargs) -> LLMResponse:
+        response = self.client.chat.complete(model=self.model,
+                                             messages=messages,
+                                             **kwargs)
+        return LLMResponse(response.choices[0].message.content, self.model,
+                           response.usage.prompt_tokens,
+                           response.usage.completion_tokens)
+
+    def stream(self, messages: list, **kwargs):
+        return self.client.chat.stream(model=self.model,
+                                       messages=messages,
+                                       **kwargs)
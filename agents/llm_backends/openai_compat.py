@@ -0,0 +1,143 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+
+import config
+from .base import LLMBackend, LLMHTTPError, LLMResponse
+
+
+class OpenAICompatibleBackend(LLMBackend):
+    """
+    Any server of the OpenAI `/chat/completions` API, over a pooled
+    keep-alive `requests` session.
+
+    Parameters
+    ----------
+    base_url: str, e.g. "https://api.openai.com/v1".
+    headers: dict, e.g. the authorization header.
+    params: dict, query parameters, e.g. the Azure api-version.
+    send_model: bool, if False the model is not sent, for servers which
+        take it from the URL (Azure deployments).
+    """
+    name = "openai"
+
+    def __init__(self,
+                 base_url: str,
+                 model: str = config.LLM_MODELS["openai"],
+                 headers: dict = None,
+                 params: dict = None,
+                 send_model: bool = True,
+                 timeout: float = config.LLM_REQUEST_TIMEOUT,
+                 pool_size: int = config.LLM_POOL_SIZE):
+        super().__init__(model, timeout, pool_size)
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.url = base_url.rstrip("/") + "/chat/completions"
+        self.params = params or {}
+        self.send_model = send_model
+        self.session = requests.Session()
+        self.session.headers.update(headers or {})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @classmethod
+    def from_env(cls, model: str = config.LLM_MODELS["openai"]):
+        """
+        OpenAI with OPENAI_API_KEY (and OPENAI_API_BASE), or Azure OpenAI if
+        AZURE_OPENAI_API_TYPE is "azure", with the deployment `model`.
+        """
+        if os.environ.get("AZURE_OPENAI_API_TYPE", "").lower() == "azure":
+            return cls(os.environ["AZURE_OPENAI_API_BASE"].rstrip("/") +
+                       f"/openai/deployments/{model}",
+                       model,
+                       headers={"api-key": os.environ["AZURE_OPENAI_API_KEY"]},
+                       params={
+                           "api-version":
+                           os.environ["AZURE_OPENAI_API_VERSION"]
+                       },
+                       send_model=False)
+        api_key = os.environ.get("OPENAI_API_KEY") or os.environ.get(
+            "AZURE_OPENAI_API_KEY")
+        return cls(os.environ.get("OPENAI_API_BASE",
+                                  "https://api.openai.com/v1"),
+                   model,
+                   headers={"Authorization": f"Bearer {api_key}"})
+
+    def _post(self, messages: list, stream: bool, **kwargs):
+        body = dict(kwargs, messages=messages)
+        if self.send_model:
+            body["model"] = self.model
+        if stream:
+            body["stream"] = True
+        response = self.session.post(self.url,
+                                     params=self.params,
+                                     json=body,
+                                     timeout=self.timeout,
+                                     stream=stream)
+        if response.status_code >= 400:
+            message = response.text[:200]
+            response.close()
+            raise LLMHTTPError(response.status_code, response, message)
+        return response
+
+    def complete(self, messages: list, **kwargs) -> LLMResponse:
+        data = self._post(messages, False, **kwargs).json()
+        usage = data.get("usage") or {}
+        return LLMResponse(data["choices"][0]["message"]["content"],
+                           data.get("model", self.model),
+                           usage.get("prompt_tokens", 0),
+                           usage.get("completion_tokens", 0))
+
+    def stream(self, messages: list, **kwargs):
+        """Server-sent events of the completion chunks."""
+        response = self._post(messages, True, **kwargs)
+        with response:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    return
+                choices = json.loads(data).get("choices") or [{}]
+                content = (choices[0].get("delta") or {}).get("content")
+                if content:
+                    yield content
+
+    def close(self):
+        super().close()
+        self.session.close()
+
+
+class LocalHTTPBackend(OpenAICompatibleBackend):
+    """
+    A local inference server with an OpenAI-compatible API (vLLM,
+    llama.cpp server, ...) at LOCAL_LLM_URL, e.g. "http://localhost:8000/v1".
+    """
+    name = "local"
+
+    def __init__(self,
+                 base_url: str = None,
+                 model: str = config.LLM_MODELS["local"],
+                 timeout: float = config.LLM_REQUEST_TIMEOUT,
+                 pool_size: int = config.LLM_POOL_SIZE):
+        super().__init__(base_url or os.environ.get("LOCAL_LLM_URL",
+                                                    "http://localhost:8000/v1"),
+                         model,
+                         timeout=timeout,
+                         pool_size=pool_size)
@@ -0,0 +1,209 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Persistent prompt -> response cache for LLM decisions.
+
+Entries are content-addressed by a hash of the model name and the normalized
+prompt. Lookups hit an in-memory LRU tier first, then an SQLite tier on disk
+which survives across games and evaluation runs.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from civrealm.freeciv.utils.freeciv_logging import fc_logger
+
+import config
+
+
+class CachedText(str):
+    """An LLM answer replayed from the cache rather than freshly generated."""
+
+
+class LLMCache:
+    """
+    Two-tier LRU cache of LLM responses.
+
+    The disk tier is bounded by `max_entries` (least recently used entries
+    are evicted first), both tiers by `max_age` in seconds. Use `path=None`
+    for a memory-only cache.
+    """
+    # Evict the disk tier once every `EVICT_EVERY` insertions.
+    EVICT_EVERY = 256
+
+    def __init__(self,
+                 path: str = config.LLM_CACHE_PATH,
+                 memory_size: int = config.LLM_CACHE_MEMORY_SIZE,
+                 max_entries: int = config.LLM_CACHE_MAX_ENTRIES,
+                 max_age: float = config.LLM_CACHE_MAX_AGE):
+        self.path = path
+        self.memory_size = memory_size
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.memory = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        if path is not None:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses (" +
+                "key TEXT PRIMARY KEY, model TEXT, response TEXT, " +
+                "created REAL, accessed REAL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS accessed_idx " +
+                               "ON responses (accessed)")
+            self.evict()
+
+    @staticmethod
+    def normalize(prompt: str) -> str:
+        """Prompts differing only in whitespace share an entry."""
+        return " ".join(prompt.split())
+
+    @classmethod
+    def make_key(cls, model: str, prompt: str) -> str:
+        return hashlib.sha256(
+            (model + "\0" + cls.normalize(prompt)).encode("utf-8")).hexdigest()
+
+    def get(self, model: str, prompt: str):
+        """Returns the cached response, or None."""
+        key = self.make_key(model, prompt)
+        now = time.time()
+        with self._lock:
+            if key in self.memory:
+                response, created = self.memory[key]
+                if now - created <= self.max_age:
+                    self.memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return response
+                del self.memory[key]
+            if self._conn is not None:
+                row = self._conn.execute(
+                    "SELECT response, created FROM responses WHERE key = ?",
+                    (key, )).fetchone()
+                if row is not None and now - row[1] <= self.max_age:
+                    self._conn.execute(
+                        "UPDATE responses SET accessed = ? WHERE key = ?",
+                        (now, key))
+                    self._remember(key, row[0], row[1])
+                    self.disk_hits += 1
+                    return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, model: str, prompt: str, response: str):
+        key = self.make_key(model, prompt)
+        now = time.time()
+        with self._lock:
+            self._remember(key, response, now)
+            if self._conn is None:
+                return
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, model, response, now, now))
+            self._conn.commit()
+            self._puts += 1
+        if self._puts % self.EVICT_EVERY == 0:
+            self.evict()
+
+    def discard(self, model: str, prompt: str):
+        """Drop an entry, e.g. a response which turned out to be unusable."""
+        key = self.make_key(model, prompt)
+        with self._lock:
+            self.memory.pop(key, None)
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM responses WHERE key = ?",
+                                   (key, ))
+                self._conn.commit()
+
+    def _remember(self, key: str, response: str, created: float):
+        # Kept with its insertion time, the memory tier ages like the disk.
+        self.memory[key] = (response, created)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def evict(self):
+        """Apply the age and size bounds to the disk tier."""
+        if self._conn is None:
+            return
+        with self._lock:
+            self._conn.execute("DELETE FROM responses WHERE created < ?",
+                               (time.time() - self.max_age, ))
+            count = self._conn.execute(
+                "SELECT COUNT(*) FROM responses").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM " +
+                    "responses ORDER BY accessed ASC LIMIT ?)",
+                    (count - self.max_entries, ))
+                fc_logger.debug(
+                    f"Evicted {count - self.max_entries} LLM cache entries.")
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        hits = self.memory_hits + self.disk_hits
+        total = hits + self.misses
+        return {
+            "hits": hits,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": hits / total if total else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+_llm_cache = None
+_llm_cache_lock = threading.Lock()
+
+
+def get_llm_cache():
+    """
+    The LLM cache shared by all agents of the process, or None if caching is
+    disabled by `config.LLM_CACHE_ENABLED`.
+    """
+    global _llm_cache
+    if not config.LLM_CACHE_ENABLED:
+        return None
+    with _llm_cache_lock:
+        if _llm_cache is None:
+            _llm_cache = LLMCache()
+        return _llm_cache
+
+
+def set_llm_cache(cache):
+    """
+    Replace the process-wide LLM cache, e.g. by a proxy of the cache of
+    another process.
+    """
+    global _llm_cache
+    with _llm_cache_lock:
+        _llm_cache = cache
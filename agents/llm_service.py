@@ -0,0 +1,83 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+LLM request scheduling and caching shared by several processes.
+
+The parent process serves one `RateLimiter` and one `LLMCache` with
+`start_llm_service`; worker processes call `connect_llm_service` before
+creating their agents, so that all games share the quota and the cache.
+"""
+
+import os
+import threading
+from multiprocessing.managers import BaseManager
+
+import config
+from .llm_cache import LLMCache, set_llm_cache
+from .rate_limiter import RateLimiter, SharedRateLimiter, set_rate_limiter
+
+_served = {}
+# The manager serves each connection on its own thread.
+_served_lock = threading.Lock()
+
+
+def _served_rate_limiter() -> RateLimiter:
+    with _served_lock:
+        if "rate_limiter" not in _served:
+            _served["rate_limiter"] = RateLimiter()
+        return _served["rate_limiter"]
+
+
+def _served_llm_cache() -> LLMCache:
+    with _served_lock:
+        if "llm_cache" not in _served:
+            _served["llm_cache"] = LLMCache()
+        return _served["llm_cache"]
+
+
+class LLMServiceManager(BaseManager):
+    """Serves the shared rate limiter and cache singletons."""
+
+
+LLMServiceManager.register("rate_limiter", callable=_served_rate_limiter)
+LLMServiceManager.register("llm_cache", callable=_served_llm_cache)
+
+
+def start_llm_service() -> tuple:
+    """
+    Start the service process.
+
+    Returns
+    -------
+    (manager, authkey): give `manager.address` and `authkey` to the workers,
+        and `manager.shutdown()` at the end.
+    """
+    authkey = os.urandom(16)
+    manager = LLMServiceManager(address=("127.0.0.1", 0), authkey=authkey)
+    manager.start()
+    return manager, authkey
+
+
+def connect_llm_service(
+        address: tuple,
+        authkey: bytes,
+        share_cache: bool = config.LLM_CACHE_ENABLED) -> LLMServiceManager:
+    """Make the agents of this process use the served limiter and cache."""
+    manager = LLMServiceManager(address=address, authkey=authkey)
+    manager.connect()
+    set_rate_limiter(SharedRateLimiter(manager.rate_limiter()))
+    if share_cache:
+        set_llm_cache(manager.llm_cache())
+    return manager
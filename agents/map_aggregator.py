@@ -0,0 +1,226 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Zoomed-out map of the whole game map, in blocks of 5x5 tiles.
+
+`MapAggregator.update` takes the tile arrays of `observations['map']` and
+computes, for every block, the number of unexplored tiles and the
+histograms of terrains, extras, unit types, unit owners, city owners and
+tile owners, with array operations over all the blocks at once. After the
+first turn, only the blocks having a changed tile are recomputed, and only
+their descriptions are rendered again.
+"""
+
+import numpy as np
+
+from civrealm.freeciv.map.map_const import EXTRA_NAMES, TERRAIN_NAMES
+
+import config
+from .redundants.improvement_consts import UNIT_TYPES
+
+# Owner ids are below this value; it marks tiles without owner.
+NO_OWNER = 255
+# (key of observations['map'], fill value of the tiles past the map edge)
+LAYERS = (("status", NO_OWNER), ("terrain", NO_OWNER), ("extras", False),
+          ("unit", 0), ("unit_owner", NO_OWNER), ("city_owner", NO_OWNER),
+          ("tile_owner", NO_OWNER))
+
+
+def _histogram(values: np.ndarray, width: int) -> np.ndarray:
+    """Per row of `values` (blocks x tiles), the counts of 0..width-1."""
+    rows = values.shape[0]
+    offsets = np.arange(rows)[:, None] * width
+    valid = values < width
+    return np.bincount((values.astype(np.int64) + offsets)[valid],
+                       minlength=rows * width).reshape(rows, width)
+
+
+class MapAggregator:
+    """
+    Parameters
+    ----------
+    block_size: int, side of the blocks in tiles.
+    terrain_names, extra_names, unit_type_names: list, names of the terrain
+        ids, of the extras layers and of the unit type layers.
+    """
+    def __init__(self,
+                 block_size: int = config.MAP_BLOCK_SIZE,
+                 terrain_names: list = TERRAIN_NAMES,
+                 extra_names: list = EXTRA_NAMES,
+                 unit_type_names: list = UNIT_TYPES):
+        self.block_size = block_size
+        self.terrain_names = terrain_names
+        self.extra_names = extra_names
+        self.unit_type_names = unit_type_names
+        self.shape = None
+        self.tiles = None
+        self.previous = None
+        # Per block (bx, by, ...) counts, see `_compute`.
+        self.unexplored = None
+        self.terrain = None
+        self.extras = None
+        self.units = None
+        self.unit_owners = None
+        self.city_owners = None
+        self.tile_owners = None
+        # (bx, by) -> {my_player_id: description}, rendered on demand.
+        self.descriptions = {}
+
+    def _reset(self, map_state: dict):
+        xsize, ysize = map_state['terrain'].shape
+        size = self.block_size
+        self.shape = (-(-xsize // size), -(-ysize // size))
+        bx, by = self.shape
+        # Tiles of the blocks, fewer at the right and bottom edges.
+        self.tiles = np.outer(
+            np.minimum(size, xsize - np.arange(bx) * size),
+            np.minimum(size, ysize - np.arange(by) * size))
+        self.unexplored = np.zeros((bx, by), dtype=np.int32)
+        self.terrain = np.zeros((bx, by, len(self.terrain_names)),
+                                dtype=np.int32)
+        self.extras = np.zeros((bx, by, map_state['extras'].shape[2]),
+                               dtype=np.int32)
+        self.units = np.zeros((bx, by, map_state['unit'].shape[2]),
+                              dtype=np.int32)
+        self.unit_owners = np.zeros((bx, by, NO_OWNER), dtype=np.int32)
+        self.city_owners = np.zeros((bx, by, NO_OWNER), dtype=np.int32)
+        self.tile_owners = np.zeros((bx, by, NO_OWNER), dtype=np.int32)
+        self.previous = None
+        self.descriptions = {}
+
+    def _blocks(self, array: np.ndarray, fill) -> np.ndarray:
+        """View of `array` (x, y, ...) as (bx, by, size, size, ...)."""
+        size = self.block_size
+        bx, by = self.shape
+        pad = [(0, bx * size - array.shape[0]), (0, by * size - array.shape[1])]
+        array = np.pad(array, pad + [(0, 0)] * (array.ndim - 2),
+                       constant_values=fill)
+        array = array.reshape((bx, size, by, size) + array.shape[2:])
+        return np.swapaxes(array, 1, 2)
+
+    def _compute(self, map_state: dict, bxs: np.ndarray, bys: np.ndarray):
+        """Recompute the counts of the blocks (bxs[i], bys[i])."""
+        blocks = {
+            key: self._blocks(np.asarray(map_state[key]), fill)[bxs, bys]
+            for key, fill in LAYERS
+        }
+        count = len(bxs)
+        tiles = self.block_size * self.block_size
+        flat = {
+            key: blocks[key].reshape(count, tiles)
+            for key in ("status", "terrain", "unit_owner", "city_owner",
+                        "tile_owner")
+        }
+        self.unexplored[bxs, bys] = (flat['status'] == 0).sum(axis=1)
+        self.terrain[bxs, bys] = _histogram(flat['terrain'],
+                                            len(self.terrain_names))
+        self.extras[bxs, bys] = blocks['extras'].sum(axis=(1, 2))
+        self.units[bxs, bys] = blocks['unit'].sum(axis=(1, 2))
+        self.unit_owners[bxs, bys] = _histogram(flat['unit_owner'], NO_OWNER)
+        self.city_owners[bxs, bys] = _histogram(flat['city_owner'], NO_OWNER)
+        self.tile_owners[bxs, bys] = _histogram(flat['tile_owner'], NO_OWNER)
+        for block in zip(bxs.tolist(), bys.tolist()):
+            self.descriptions.pop(block, None)
+
+    def _changed_blocks(self, map_state: dict) -> np.ndarray:
+        """Mask (bx, by) of the blocks having a tile changed since `update`."""
+        changed = np.zeros(map_state['terrain'].shape, dtype=bool)
+        for key, _ in LAYERS:
+            diff = np.asarray(map_state[key]) != self.previous[key]
+            changed |= diff.any(axis=2) if diff.ndim == 3 else diff
+        return self._blocks(changed, False).any(axis=(2, 3))
+
+    def update(self, map_state: dict) -> int:
+        """
+        Update the blocks from `observations['map']`. Returns the number of
+        blocks recomputed.
+        """
+        if self.shape is None or \
+                map_state['terrain'].shape != self.previous['terrain'].shape:
+            self._reset(map_state)
+        if self.previous is None:
+            changed = np.ones(self.shape, dtype=bool)
+        else:
+            changed = self._changed_blocks(map_state)
+        bxs, bys = np.nonzero(changed)
+        if len(bxs):
+            self._compute(map_state, bxs, bys)
+        self.previous = {
+            key: np.array(map_state[key], copy=True)
+            for key, _ in LAYERS
+        }
+        return len(bxs)
+
+    @staticmethod
+    def _owners(counts: np.ndarray, my_player_id) -> list:
+        return [
+            "myself player_" + str(owner) if owner == my_player_id else
+            "player_" + str(owner) for owner in np.flatnonzero(counts)
+        ]
+
+    def describe(self, block: tuple, my_player_id=None) -> list:
+        """The block as in the `upper_map` of the actors, e.g. '7 Hills'."""
+        cached = self.descriptions.setdefault(tuple(block), {})
+        if my_player_id in cached:
+            return cached[my_player_id]
+        bx, by = block
+        tiles = self.tiles[bx, by]
+        out = []
+        if self.unexplored[bx, by] == tiles:
+            out.append(f"{tiles} tiles unexplored")
+        else:
+            if self.unexplored[bx, by]:
+                out.append(f"{self.unexplored[bx, by]} tiles unexplored")
+            for names, counts in ((self.terrain_names, self.terrain[bx, by]),
+                                  (self.extra_names, self.extras[bx, by]),
+                                  (self.unit_type_names, self.units[bx, by])):
+                out.extend(f"{counts[i]} {names[i]}"
+                           for i in np.flatnonzero(counts) if i < len(names))
+            owners = self._owners(self.unit_owners[bx, by], my_player_id)
+            if owners:
+                out.append("unit owners are: " + " ".join(owners))
+            for owner in np.flatnonzero(self.city_owners[bx, by]):
+                whose = "myself player_" if owner == my_player_id else \
+                    "player_"
+                out.append(f"{self.city_owners[bx, by, owner]} cities of " +
+                           f"{whose}{owner}")
+            territory = self.tile_owners[bx, by, my_player_id] \
+                if my_player_id is not None else 0
+            if territory:
+                out.append(f"{territory} tiles of our territory")
+        cached[my_player_id] = out
+        return out
+
+    def zoomed_out_map(self, my_player_id=None, max_blocks: int = None) -> dict:
+        """
+        {"block_<bx>_<by>": description} of the explored blocks, those with
+        our units or cities first, then the most explored ones.
+        """
+        explored = np.argwhere(self.unexplored < self.tiles)
+        if my_player_id is not None:
+            ours = (self.unit_owners[..., my_player_id] +
+                    self.city_owners[..., my_player_id])
+        else:
+            ours = np.zeros(self.shape, dtype=np.int32)
+        order = sorted(explored.tolist(),
+                       key=lambda block: (-ours[block[0], block[1]],
+                                          self.unexplored[block[0], block[1]]))
+        if max_blocks is not None:
+            order = order[:max_blocks]
+        return {
+            f"block_{bx}_{by}": self.describe((bx, by), my_player_id)
+            for bx, by in order
+        }
@@ -0,0 +1,241 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Latency, token and fallback metrics of the agent loop.
+
+Every metric is identified by a name and an optional label (e.g. the actor
+type). Timing spans and values go into log-bucketed histograms, events into
+counters; both cost a dict lookup and a few additions per record.
+"""
+
+import csv
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import config
+
+
+class Histogram:
+    """
+    Histogram of positive values in geometric buckets, so that percentiles
+    are exact up to the relative error `GROWTH - 1`.
+    """
+    GROWTH = 1.05
+    _LOG_GROWTH = math.log(GROWTH)
+    # Bucket of the values <= 0.
+    _ZERO = -2**31
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float):
+        index = self._ZERO if value <= 0 else math.floor(
+            math.log(value) / self._LOG_GROWTH)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def percentile(self, q: float) -> float:
+        """The `q` (in [0, 100]) percentile, or 0.0 if empty."""
+        if not self.count:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                if index == self._ZERO:
+                    return 0.0
+                # Upper bound of the bucket, clipped to the observed range.
+                return min(self.max, max(self.min, self.GROWTH**(index + 1)))
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max if self.count else 0.0,
+        }
+
+
+class MetricsStore:
+    """
+    Thread-safe store of the histograms and counters of a process.
+
+    Parameters
+    ----------
+    enabled: bool, if False recording is a no-op.
+    export_path: str, file the snapshots are appended to, as CSV if it ends
+        with ".csv" else as JSONL. None disables the export.
+    export_interval: float, minimal seconds between two exports of
+        `maybe_export`.
+    """
+    FIELDS = ("time", "kind", "name", "label", "count", "sum", "mean", "p50",
+              "p90", "p99", "max")
+
+    def __init__(self,
+                 enabled: bool = config.METRICS_ENABLED,
+                 export_path: str = config.METRICS_EXPORT_PATH,
+                 export_interval: float = config.METRICS_EXPORT_INTERVAL):
+        self.enabled = enabled
+        self.export_path = export_path
+        self.export_interval = export_interval
+        self.histograms = {}
+        self.counters = {}
+        self._last_export = time.monotonic()
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float, label: str = ""):
+        """Add `value` to the histogram `name`."""
+        if not self.enabled:
+            return
+        key = (name, label)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.add(value)
+
+    def count(self, name: str, amount: float = 1, label: str = ""):
+        """Add `amount` to the counter `name`."""
+        if not self.enabled:
+            return
+        key = (name, label)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    @contextmanager
+    def span(self, name: str, label: str = ""):
+        """Time the `with` block into the histogram `name`, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, label)
+
+    def rows(self) -> list:
+        """A snapshot of every metric, as rows of `FIELDS`."""
+        now = time.time()
+        rows = []
+        with self._lock:
+            for (name, label), histogram in sorted(self.histograms.items()):
+                rows.append(
+                    dict(time=now,
+                         kind="histogram",
+                         name=name,
+                         label=label,
+                         **histogram.summary()))
+            for (name, label), value in sorted(self.counters.items()):
+                rows.append(
+                    dict(time=now,
+                         kind="counter",
+                         name=name,
+                         label=label,
+                         count=value))
+        return rows
+
+    def export(self, path: str = None):
+        """Append a snapshot to `path`, by default `self.export_path`."""
+        path = path or self.export_path
+        if not self.enabled or path is None:
+            return
+        rows = self.rows()
+        if path.endswith(".csv"):
+            header = not os.path.exists(path)
+            with open(path, "a", newline="", encoding="utf-8") as filep:
+                writer = csv.DictWriter(filep, fieldnames=self.FIELDS)
+                if header:
+                    writer.writeheader()
+                writer.writerows(rows)
+        else:
+            with open(path, "a", encoding="utf-8") as filep:
+                for row in rows:
+                    filep.write(json.dumps(row) + "\n")
+
+    def maybe_export(self):
+        """Export if `export_interval` seconds passed since the last one."""
+        now = time.monotonic()
+        if now - self._last_export < self.export_interval:
+            return
+        self._last_export = now
+        self.export()
+
+    def summary(self) -> dict:
+        """
+        Returns {"histograms": {name: summary}, "counters": {name: value}},
+        where labeled metrics are named "name[label]".
+        """
+        summary = {"histograms": {}, "counters": {}}
+        for row in self.rows():
+            name = row['name'] + (f"[{row['label']}]" if row['label'] else "")
+            if row['kind'] == "histogram":
+                summary['histograms'][name] = {
+                    key: row[key]
+                    for key in ("count", "mean", "p50", "p99", "max")
+                }
+            else:
+                summary['counters'][name] = row['count']
+        return summary
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+
+
+def format_summary(summary: dict) -> str:
+    """Human readable table of `MetricsStore.summary()`."""
+    lines = [f"{'metric':<32}{'count':>8}{'mean':>10}{'p50':>10}" +
+             f"{'p99':>10}{'max':>10}"]
+    for name, hist in summary['histograms'].items():
+        lines.append(f"{name:<32}{hist['count']:>8}{hist['mean']:>10.4f}" +
+                     f"{hist['p50']:>10.4f}{hist['p99']:>10.4f}" +
+                     f"{hist['max']:>10.4f}")
+    for name, value in summary['counters'].items():
+        lines.append(f"{name:<32}{value:>8}")
+    return "\n".join(lines)
+
+
+def actor_type(actor_name: str) -> str:
+    """The type of an actor from its name, e.g. "Settlers" of "Settlers 103"."""
+    head, _, tail = actor_name.rpartition(" ")
+    return head if head and tail.isdigit() else actor_name
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics() -> MetricsStore:
+    """The metrics store shared by all agents of the process."""
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = MetricsStore()
+        return _metrics
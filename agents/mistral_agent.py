@@ -17,23 +17,53 @@
 import random
 import os
 import json
-import time
-from datetime import datetime
+import functools
 import shutil
+import time
+from concurrent.futures import (FIRST_COMPLETED, ThreadPoolExecutor,
+                                TimeoutError, wait)
 
 
-from mistralai import Mistral
 from civrealm.agents.base_agent import BaseAgent
 from civrealm.configs import fc_args
 
-model = "mistral-large-latest"
-api_key = os.environ["MISTRAL_API_KEY"]
-client = Mistral(api_key=api_key)
+import config
+from .rate_limiter import get_rate_limiter, estimate_tokens, LLMUnavailableError
+from .llm_cache import CachedText, get_llm_cache
+from .dialogue_log import DialogueLogWriter
+from .actor_context import ActorContextStore
+from .output_parser import (ParseError, action_ready, parse_action,
+                            parse_batch, parse_confidence)
+from .scheduler import ActorScheduler
+from .metrics import get_metrics, actor_type
+from .llm_backends import StreamedText, get_backend
+from .model_router import get_model_router
+from .fast_path import FastPath, action_signature
+from .prompt_encoder import (ActorPromptEncoder, count_tokens, group_actions,
+                             verbose_actor_prompt)
 
 save_directory = os.path.join(os.getcwd(), "saved_dialogues")
 
 class MistralAgent(BaseAgent):
-    def __init__(self):
+    def __init__(self,
+                 planning_mode: bool = config.PLANNING_MODE,
+                 max_concurrency: int = config.LLM_MAX_CONCURRENCY,
+                 prefetch_depth: int = config.PREFETCH_DEPTH,
+                 decision_timeout: float = config.DECISION_TIMEOUT,
+                 turn_time_budget: float = config.TURN_TIME_BUDGET):
+        """
+        Parameters
+        ----------
+        planning_mode: bool, if True, decide all actors of a turn with
+            concurrent LLM requests at the first `act` of the turn.
+        max_concurrency: int, the maximal number of LLM requests in flight.
+        prefetch_depth: int, without planning mode, number of the next
+            actors decided in the background while the environment steps.
+        decision_timeout: float, seconds an actor waits for the LLM before
+            taking a fallback action (see `fallback_action`), or None.
+        turn_time_budget: float, seconds of a turn after which the actors
+            left take fallback actions without waiting for the LLM, or None.
+        """
         super().__init__()
         if fc_args["debug.randomly_generate_seeds"]:
             agentseed = os.getpid()
@@ -42,49 +72,693 @@ class MistralAgent(BaseAgent):
             if "debug.agentseed" in fc_args:
                 self.set_agent_seed(fc_args["debug.agentseed"])
 
-        clear_saved_dialogues_folder()  #Remove previous run data
+        self.planning_mode = planning_mode
+        self.max_concurrency = max(1, max_concurrency)
+        self.prefetch_depth = prefetch_depth
+        self.decision_timeout = decision_timeout
+        self.turn_time_budget = turn_time_budget
+        # time.monotonic() at which the time budget of the turn runs out
+        self.turn_deadline = None
+        self.scheduler = ActorScheduler()
+        # (ctrl_type, actor_id) -> action_name decided by `plan_turn`
+        self.plans = {}
+        # (ctrl_type, actor_id) -> (future action_name, available_actions)
+        self.prefetched = {}
+        self._executor = None
+        self.rate_limiter = get_rate_limiter()
+        self.compact_prompts = config.COMPACT_PROMPTS
+        self.batch_prompts = config.BATCH_PROMPTS
+        self.streaming = config.LLM_STREAMING
+        self.actor_contexts = ActorContextStore() if (
+            config.ACTOR_CONTEXT_ENABLED and self.compact_prompts) else None
+        self.prompt_encoder = ActorPromptEncoder()
+        self.metrics = get_metrics()
+        self.router = get_model_router()
+        self.fast_path = FastPath() if config.FAST_PATH_ENABLED else None
+        # Whether the saved dialogues were submitted to `self.fast_path`
+        self._learning_started = False
+        # (text, metadata) of the decisions of the turn, for `self.memory`
+        self.memory_pending = []
+        # Suggestion of the advisor for the current turn
+        self.advice = None
+        # Dialogues of previous runs are kept: each run writes its own
+        # segments (see `clear_saved_dialogues_folder`).
+        self.dialogue_log = DialogueLogWriter(save_directory)
+
+    # The stores below open files or import numpy: they are only set up when
+    # first used, so that importing and constructing the agent stays cheap.
+    @functools.cached_property
+    def cache(self):
+        return get_llm_cache()
+
+    @functools.cached_property
+    def memory(self):
+        if not config.MEMORY_ENABLED:
+            return None
+        from .vector_memory import get_vector_memory
+        return get_vector_memory()
+
+    @functools.cached_property
+    def advisor(self):
+        if not config.ADVISOR_ENABLED:
+            return None
+        from .advisor import Advisor
+        return Advisor()
+
+    def learn_saved_dialogues(self):
+        """
+        Teach `self.fast_path` the LLM choices of the recent saved dialogues
+        of previous runs, in the background.
+        """
+        if self._learning_started or self.fast_path is None:
+            return None
+        self._learning_started = True
+        return self._get_executor().submit(self.fast_path.learn_from_dialogues,
+                                           save_directory,
+                                           skip_run=self.dialogue_log.run_id)
 
     def act(self, observation, info):
+        self.learn_saved_dialogues()
         if info['turn'] != self.turn:
-            self.planned_actor_ids = []
             self.turn = info['turn']
+            if self.turn_time_budget is not None:
+                self.turn_deadline = time.monotonic() + self.turn_time_budget
+            self.plans = {}
+            self.drop_prefetched()
+            self.flush_memory()
+            self.scheduler.new_turn(self.turn, info['llm_info'])
+            if self.actor_contexts is not None:
+                self.actor_contexts.evict(info['llm_info'])
+            if self.fast_path is not None:
+                self.fast_path.forget(info['llm_info'])
+            if self.advisor is not None:
+                self.advice = self.advise(observation, info)
+            if self.planning_mode:
+                self.plan_turn(info)
+
+        key = self.scheduler.next_actor(info['llm_info'])
+        if key is None:
+            return None
+        ctrl_type, actor_id = key
+        actor = info['llm_info'][ctrl_type][actor_id]
+        action_name = self.plans.pop(key, None)
+        if action_name is None:
+            action_name = self.take_prefetched(key, actor)
+        if action_name not in actor['available_actions']:
+            # Not planned (e.g. the actor appeared during the turn), or the
+            # plan went stale (e.g. the actor has moved): decide it now.
+            action_name = self.decide_fast(key, actor)
+        if action_name is None:
+            # Query LLM To Get action_name
+            action_name = self.llm_decide(key, actor)
+            #action_name = self.llm_choose_random_action(actor['available_actions'])
+            #action_name = random.choice(actor['available_actions'])
+        if self.fast_path is not None:
+            self.fast_path.record(key, actor, self.turn, action_name)
+        if self.memory is not None:
+            self.memory_pending.append(
+                (f"Turn {self.turn}: {actor['name']} chose {action_name} " +
+                 f"among {group_actions(actor['available_actions'])}", {
+                     "kind": "history",
+                     "turn": self.turn,
+                     "actor": actor['name'],
+                     "action_name": action_name,
+                 }))
+        if self.prefetch_depth > 0 and not self.planning_mode:
+            self.prefetch(info)
+        return (ctrl_type, actor_id, action_name)
+
+    def prefetch(self, info):
+        """
+        Start deciding the next `prefetch_depth` actors in the background,
+        from the current `info`, so that the LLM round trips overlap with
+        `env.step`.
+        """
+        for key in self.scheduler.peek(self.prefetch_depth):
+            if key in self.prefetched or key in self.plans:
+                continue
+            actor = info['llm_info'].get(key[0], {}).get(key[1])
+            if actor is None:
+                continue
+            action_name = self.decide_fast(key, actor)
+            if action_name is not None:
+                self.plans[key] = action_name
+                continue
+            future = self._get_executor().submit(
+                self.llm_choose_action_from_actor_info, actor, key)
+            self.prefetched[key] = (future, list(actor['available_actions']))
+
+    def take_prefetched(self, key, actor):
+        """
+        The prefetched decision of the actor, or None if there is none or if
+        its available actions changed since it was prefetched.
+        """
+        entry = self.prefetched.pop(key, None)
+        if entry is None:
+            return None
+        future, available_actions = entry
+        if available_actions != actor['available_actions']:
+            future.cancel()
+            if self.actor_contexts is not None:
+                self.actor_contexts.reset(key)
+            self.metrics.count("agent.prefetch.stale")
+            return None
+        self.metrics.count("agent.prefetch.used")
+        return self.wait_decision(future, key, actor)
+
+    def time_left(self):
+        """
+        Seconds a decision may still wait for the LLM: at most
+        `decision_timeout` and what is left of the turn budget. None if
+        unlimited.
+        """
+        limits = []
+        if self.decision_timeout is not None:
+            limits.append(self.decision_timeout)
+        if self.turn_deadline is not None:
+            limits.append(max(0.0, self.turn_deadline - time.monotonic()))
+        return min(limits) if limits else None
+
+    def llm_decide(self, key, actor):
+        """
+        Ask the LLM for the action of the actor within the time budget, see
+        `wait_decision`.
+        """
+        timeout = self.time_left()
+        if timeout is None:
+            return self.llm_choose_action_from_actor_info(actor, key)
+        if timeout <= 0:
+            # The turn is over budget, do not even ask.
+            return self.fallback_action(key, actor, "turn_budget")
+        future = self._get_executor().submit(
+            self.llm_choose_action_from_actor_info, actor, key)
+        return self.wait_decision(future, key, actor)
+
+    def wait_decision(self, future, key, actor):
+        """
+        The action name `future` resolves to within `time_left`, else a
+        fallback action. A late answer still completes in the background: it
+        is logged, cached and learned from by the fast path.
+        """
+        try:
+            return future.result(self.time_left())
+        except TimeoutError:
+            future.cancel()
+            return self.fallback_action(key, actor, "timeout")
 
-        for ctrl_type, actors_dict in info['llm_info'].items():
-            for actor_id in actors_dict.keys():
-                if actor_id in self.planned_actor_ids:
-                    continue
-                available_actions = actors_dict[actor_id]['available_actions']
-                if available_actions:
-                    # Query LLM To Get action_name
-                    action_name = self.llm_choose_action_from_actor_info(actors_dict[actor_id])
-                    #action_name = self.llm_choose_random_action(available_actions)
-                    #action_name = random.choice(available_actions)
-                    self.planned_actor_ids.append(actor_id)
-                    return (ctrl_type, actor_id, action_name)
-
-    def query_llm(self, prompt):
+    def fallback_action(self, key, actor, reason: str):
         """
-        Query the LLM with the given prompt and return the generated text.
+        The action of an actor the LLM did not decide in time, from the first
+        tier of `config.DECISION_FALLBACKS` having one:
+        - "cache": the cached LLM answer to the full prompt of the actor.
+        - "guess": the action the LLM chose most for the same actor type and
+          set of actions (see `FastPath.guess`).
+        - "previous": the action of the actor at the previous turn.
+        - "random": a random available action.
+        Counted as `agent.fallback.<reason>.<tier>[<actor type>]`.
         """
+        if self.actor_contexts is not None:
+            # Its request may still be answered: ignore it, start over.
+            self.actor_contexts.reset(key)
+        available_actions = actor['available_actions']
+        kind = actor_type(actor['name'])
+        action_name, tier = None, "random"
+        for tier in config.DECISION_FALLBACKS:
+            if tier == "cache" and self.cache is not None:
+                # Keyed as by `query_llm`, for a request of the full prompt.
+                cache_text = self.chat_messages(
+                    self.build_actor_prompt(actor), None, self.advice)[1]
+                # The answers of the largest models first.
+                for model_tier in reversed(self.route(kind, key[0])):
+                    llm_output = self.cache.get(
+                        self.backend(model_tier).model, cache_text)
+                    if llm_output is None:
+                        continue
+                    try:
+                        action_name, _ = parse_action(llm_output,
+                                                      available_actions)
+                        break
+                    except ParseError:
+                        pass
+            elif tier == "guess" and self.fast_path is not None:
+                action_name = self.fast_path.guess(actor)
+            elif tier == "previous" and self.fast_path is not None:
+                action_name = self.fast_path.previous(key, actor, self.turn)
+            elif tier == "random":
+                action_name = random.choice(available_actions)
+            if action_name is not None:
+                break
+        if action_name is None:
+            tier, action_name = "random", random.choice(available_actions)
+        self.metrics.count(f"agent.fallback.{reason}.{tier}", label=kind)
+        print(f"No LLM answer in time for {actor['name']} ({reason}), " +
+              f"falling back to the {tier} action: {action_name}")
+        return action_name
 
-        while True:
+    def advise(self, observation, info):
+        """
+        Ask the advisor for the suggestion of the turn, from the whole
+        empire and the zoomed-out map. Returns None if there is none.
+        """
+        with self.metrics.span("agent.advisor"):
+            with self.metrics.span("agent.prompt_build"):
+                system, user = self.advisor.messages(observation,
+                                                     info['llm_info'])
             try:
-                response = client.chat.complete(
-                model=model,
-                messages=[
-                    {"role": "user", "content": prompt},]
-                )
-                break
-            except Exception as e:
-                # Check if it's the rate limit error by examining the error attributes
-                if hasattr(e, 'status_code') and e.status_code == 429:
-                    #print("Rate limit exceeded. Retrying in 1 second...")
-                    time.sleep(1)  # Wait for 1 second before retrying
-                else:
-                    raise  # Re-raise if it's not a rate limit error
-
-        return response.choices[0].message.content.strip()
+                llm_output, advice = self.within_budget(
+                    self.query_cascade, user['content'], [system], None,
+                    self.route("advisor"), lambda llm_output:
+                    (self.advisor.parse(llm_output), False, None))
+            except ParseError as einfo:
+                print(f"{einfo} The actors get no advice this turn.")
+                return None
+            except (LLMUnavailableError, TimeoutError) as einfo:
+                print(f"{einfo!r} The actors get no advice this turn.")
+                return None
+        print(f"Advisor suggests: {advice}")
+        with self.metrics.span("dialogue.write"):
+            self.dialogue_log.write({
+                "turn": self.turn,
+                "actor": "advisor",
+                "prompt": user['content'],
+                "llm_output": llm_output,
+                "action_name": None,
+                "source": "advisor",
+            })
+        return advice
+
+    def flush_memory(self):
+        """Insert the decisions of the last turn into the vector memory."""
+        if not self.memory_pending:
+            return
+        texts, metadata = zip(*self.memory_pending)
+        self.memory_pending = []
+        with self.metrics.span("memory.insert"):
+            self.memory.add(list(texts), list(metadata))
+
+    def manual_and_history_search(self, look_up: str) -> str:
+        """Answer the manualAndHistorySearch command from local memory."""
+        if self.memory is None:
+            return "Nothing relevant found."
+        self.flush_memory()
+        with self.metrics.span("memory.search"):
+            return self.memory.manual_and_history_search(look_up)
+
+    def decide_fast(self, key, actor):
+        """The action of the fast path for the actor, or None."""
+        if self.fast_path is None:
+            return None
+        decision = self.fast_path.decide(key, actor, self.turn)
+        if decision is None:
+            return None
+        action_name, rule = decision
+        self.metrics.count(f"fast_path.{rule}",
+                           label=actor_type(actor['name']))
+        return action_name
+
+    def drop_prefetched(self):
+        for key, (future, _) in self.prefetched.items():
+            future.cancel()
+            if self.actor_contexts is not None:
+                self.actor_contexts.reset(key)
+        self.prefetched = {}
+
+    def wait_started(self, calls: list) -> list:
+        """
+        Submit the `(function, *args)` of `calls` to the executor and wait
+        until each is done, has run for `decision_timeout` seconds since it
+        started (requests queued behind `max_concurrency` are not timed), or
+        the turn budget is spent. Returns the futures of the calls.
+        """
+        starts = {}
+
+        def run(index, function, *args):
+            starts[index] = time.monotonic()
+            return function(*args)
+
+        executor = self._get_executor()
+        futures = [
+            executor.submit(run, index, *call)
+            for index, call in enumerate(calls)
+        ]
+        waiting = dict(enumerate(futures))
+        while waiting:
+            deadlines = []
+            if self.turn_deadline is not None:
+                deadlines.append(self.turn_deadline)
+            if self.decision_timeout is not None:
+                deadlines += [
+                    starts[index] + self.decision_timeout
+                    for index in waiting if index in starts
+                ]
+            timeout = None
+            if deadlines:
+                timeout = max(0.0, min(deadlines) - time.monotonic())
+            wait(waiting.values(), timeout, return_when=FIRST_COMPLETED)
+            now = time.monotonic()
+            over_budget = self.turn_deadline is not None and \
+                now >= self.turn_deadline
+            for index, future in list(waiting.items()):
+                if future.done() or over_budget or (
+                        self.decision_timeout is not None and index in starts
+                        and now - starts[index] >= self.decision_timeout):
+                    del waiting[index]
+        return futures
+
+    def plan_turn(self, info):
+        """
+        Decide every actor queued by the scheduler with concurrent LLM
+        requests, into `self.plans`.
+
+        The turn then costs about one LLM round trip instead of one per actor.
+        With `config.BATCH_PROMPTS`, every request decides a group of actors.
+        """
+        pending = []
+        for key in self.scheduler.pending():
+            actor = info['llm_info'][key[0]][key[1]]
+            action_name = self.decide_fast(key, actor)
+            if action_name is None:
+                pending.append((key[0], key[1], actor))
+            else:
+                self.plans[key] = action_name
+        if not pending:
+            return
+
+        if self.batch_prompts:
+            groups = self.group_actors(pending)
+            calls = [(self.llm_choose_actions_for_group, group)
+                     for group in groups]
+        else:
+            groups = [[item] for item in pending]
+            calls = [(self.llm_choose_action_from_actor_info, item[2],
+                      item[:2]) for item in pending]
+        futures = self.wait_started(calls)
+        for group, future in zip(groups, futures):
+            if not future.done():
+                # Late: cancelled if still queued, else ignored when it
+                # completes (its actor contexts are reset).
+                future.cancel()
+                actions = [
+                    self.fallback_action(item[:2], item[2], "timeout")
+                    for item in group
+                ]
+            elif self.batch_prompts:
+                actions = future.result()
+            else:
+                actions = [future.result()]
+            for item, action_name in zip(group, actions):
+                self.plans[item[:2]] = action_name
+
+    def group_actors(self, pending: list) -> list:
+        """
+        Split the (ctrl_type, actor_id, actor) of `pending` into groups of
+        (ctrl_type, actor_id, actor, prompt section), by unit type or
+        ctrl_type (`config.BATCH_GROUP_BY`), of at most
+        `config.BATCH_MAX_ACTORS` actors and `config.BATCH_TOKEN_BUDGET`
+        tokens.
+        """
+        by_key = {}
+        for ctrl_type, actor_id, actor in pending:
+            key = ctrl_type
+            if config.BATCH_GROUP_BY == "unit_type" and ctrl_type == "unit":
+                key = (ctrl_type, actor_type(actor['name']))
+            by_key.setdefault(key, []).append((ctrl_type, actor_id, actor))
+
+        groups = []
+        for items in by_key.values():
+            group, tokens = [], 0
+            for ctrl_type, actor_id, actor in items:
+                section = self.prompt_encoder.actor_section(actor_id, actor)
+                section_tokens = count_tokens(section)
+                if group and (len(group) >= config.BATCH_MAX_ACTORS or
+                              tokens + section_tokens >
+                              config.BATCH_TOKEN_BUDGET):
+                    groups.append(group)
+                    group, tokens = [], 0
+                group.append((ctrl_type, actor_id, actor, section))
+                tokens += section_tokens
+            if group:
+                groups.append(group)
+        return groups
+
+    def llm_choose_actions_for_group(self, group: list) -> list:
+        """
+        Decide the actors of a group of `group_actors` with one request.
+        Returns their action names, in the order of `group`; actors without
+        a valid answer fall back to a random action.
+        """
+        if len(group) == 1:
+            return [
+                self.llm_choose_action_from_actor_info(group[0][2],
+                                                       group[0][:2])
+            ]
+
+        actors = {actor_id: actor for _, actor_id, actor, _ in group}
+        # A late answer is logged with the turn it was asked at.
+        turn, advice = self.turn, self.advice
+        with self.metrics.span("agent.prompt_build"):
+            prompt = self.prompt_encoder.batch_prompt(
+                [section for _, _, _, section in group])
+        def parse(llm_output):
+            decided, salvaged = parse_batch(llm_output, actors)
+            return decided, salvaged, "incomplete" if None in decided.values(
+            ) else None
+
+        try:
+            llm_output, decided = self.query_cascade(
+                prompt, None, advice,
+                self.route(actor_type(group[0][2]['name']), group[0][0]),
+                parse)
+        except ParseError as einfo:
+            llm_output = einfo.llm_output
+            decided = {actor_id: None for actor_id in actors}
+            print(f"LLM failed to parse the batch JSON: {einfo}")
+        except LLMUnavailableError as einfo:
+            llm_output = repr(einfo)
+            decided = {actor_id: None for actor_id in actors}
+            print(f"{einfo} Falling back to random choices.")
+
+        actions = []
+        for _, actor_id, actor, _ in group:
+            kind = actor_type(actor['name'])
+            self.metrics.count("agent.decisions", label=kind)
+            action_name = decided[actor_id]
+            signature = action_signature(actor['available_actions'])
+            if action_name is None:
+                source = "random"
+                action_name = random.choice(actor['available_actions'])
+                self.metrics.count("agent.fallback.batch", label=kind)
+                print(f"No valid batch answer for {actor['name']}, falling " +
+                      f"back to random choice: {action_name}")
+            else:
+                # The fast path learns from fresh answers only.
+                source = "cache" if isinstance(llm_output,
+                                               CachedText) else "llm"
+                if self.fast_path is not None and source == "llm":
+                    self.fast_path.learn(actor, action_name, signature)
+                print(f"LLM chose action for {actor['name']}: {action_name}")
+            actions.append(action_name)
+            with self.metrics.span("dialogue.write"):
+                self.dialogue_log.write({
+                    "turn": turn,
+                    "actor": actor['name'],
+                    "prompt": prompt,
+                    "llm_output": llm_output,
+                    "action_name": action_name,
+                    "source": source,
+                    "signature": signature,
+                })
+        return actions
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_concurrency,
+                thread_name_prefix="llm_query")
+        return self._executor
+
+    @staticmethod
+    def chat_messages(prompt, history=None, advice=None):
+        """The chat messages of a request, and the text it is cached by."""
+        messages = list(history or []) + [{"role": "user", "content": prompt}]
+        if advice:
+            from .advisor import ADVICE_PROMPT
+            messages.insert(0, {
+                "role": "system",
+                "content": ADVICE_PROMPT.format(advice=advice)
+            })
+        return messages, json.dumps(messages) if len(messages) > 1 else prompt
+
+    def within_budget(self, function, *args):
+        """
+        `function(*args)` within `time_left`, raising `TimeoutError` after
+        it. A late LLM answer is still cached.
+        """
+        timeout = self.time_left()
+        if timeout is None:
+            return function(*args)
+        return self._get_executor().submit(function, *args).result(timeout)
+
+    def route(self, kind: str, ctrl_type: str = None) -> list:
+        """
+        The model tiers to ask about an actor of type `kind`, cheapest first
+        (see `ModelRouter.route`), or [None] for the process-wide backend.
+        """
+        if self.router is None:
+            return [None]
+        return self.router.route(kind, ctrl_type, self.turn)
+
+    def backend(self, tier=None):
+        """The backend of a model tier, or the process-wide one."""
+        if tier is None:
+            return get_backend()
+        return self.router.backend(tier)
+
+    def query_cascade(self,
+                      prompt,
+                      history,
+                      advice,
+                      tiers: list,
+                      parse,
+                      stop=None):
+        """
+        Ask the model `tiers` in order, until one answers usably.
+
+        Parameters
+        ----------
+        parse: callable, `parse(llm_output)` returns (value, salvaged,
+            problem), where problem is None if the answer is good enough, or
+            why it is escalated to the next tier ("unconfident",
+            "incomplete"). It raises `ParseError` if the answer is unusable.
+        stop: callable, see `query_llm`.
+
+        Returns
+        -------
+        (llm_output, value) of the first usable answer; the answer of the
+            last tier is used whatever its problem.
+
+        Raises
+        ------
+        ParseError: if the last tier's answer is unusable, which is its
+            `llm_output`.
+        LLMUnavailableError: if a request is given up.
+        """
+        for index, tier in enumerate(tiers):
+            last = index == len(tiers) - 1
+            llm_output = self.query_llm(prompt, history, advice, tier, stop)
+            model = self.backend(tier).model
+            try:
+                with self.metrics.span("agent.parse"):
+                    value, salvaged, problem = parse(llm_output)
+            except ParseError as einfo:
+                self.count_parse(f"failed.{einfo.reason}", model)
+                self.discard_cached_output(prompt, history, advice, tier)
+                if last:
+                    einfo.llm_output = llm_output
+                    raise
+                self.router.escalate(tier, "invalid")
+                continue
+            if isinstance(llm_output, StreamedText):
+                # Cut short, so parsed from a truncated JSON object.
+                self.count_parse("early", model)
+            else:
+                self.count_parse("salvaged" if salvaged else "ok", model)
+            if last or problem is None:
+                return llm_output, value
+            self.router.escalate(tier, problem)
+
+    def query_llm(self,
+                  prompt,
+                  history=None,
+                  advice=None,
+                  tier=None,
+                  stop=None):
+        """
+        Query the LLM with the given prompt and return the generated text.
+        `history` are the chat messages of the previous exchanges, if any,
+        and `advice` the advisor's suggestion of the turn, if any. `tier` is
+        the model tier of the router to ask, if any.
+
+        With `config.LLM_STREAMING` and a `stop(text read so far)` callable,
+        the answer is streamed and returned as a `StreamedText` as soon as
+        `stop` is True. The rest is cancelled or read in the background
+        (`config.LLM_STREAM_REST`), and then the whole answer is cached.
+
+        The request goes through the process-wide rate limiter, which retries
+        rate limits, server errors and timeouts. Raises `LLMUnavailableError`
+        when the request is given up, so that callers can fall back.
+        Responses are served from and stored into the LLM cache, a replayed
+        one is returned as a `CachedText`.
+        """
+        messages, cache_text = self.chat_messages(prompt, history, advice)
+        backend = self.backend(tier)
+        if self.cache is not None:
+            cached = self.cache.get(backend.model, cache_text)
+            if cached is not None:
+                self.metrics.count("llm.cache_hits")
+                return CachedText(cached)
+
+        start = time.perf_counter()
+        with self.metrics.span("llm.request"):
+            if stop is not None and self.streaming:
+                response = self.rate_limiter.call(
+                    lambda: backend.complete_until(
+                        messages, stop, config.LLM_STREAM_REST),
+                    tokens=estimate_tokens(prompt))
+                # Streams do not report the usage: estimate what was read.
+                response.prompt_tokens = estimate_tokens(cache_text)
+                response.completion_tokens = estimate_tokens(
+                    response.content)
+            else:
+                response = self.rate_limiter.call(
+                    lambda: backend.complete(messages),
+                    tokens=estimate_tokens(prompt))
+        if tier is not None:
+            self.router.record(tier, response, time.perf_counter() - start)
+        self.record_usage(response)
+
+        llm_output = response.content.strip()
+        if not isinstance(response.content, StreamedText):
+            if self.cache is not None:
+                self.cache.put(backend.model, cache_text, llm_output)
+        else:
+            # Cut short: the whole answer is cached once the rest is read,
+            # the part read never is (all there is if the rest is cancelled).
+            self.metrics.count("llm.stream.stopped_early")
+            rest = response.content.rest
+            llm_output = StreamedText(llm_output, rest)
+            if rest is not None and self.cache is not None:
+
+                def cache_whole(future):
+                    if future.exception() is None:
+                        self.cache.put(backend.model, cache_text,
+                                       future.result().strip())
+
+                rest.add_done_callback(cache_whole)
+        return llm_output
               
+    def record_usage(self, response):
+        """Record the prompt and completion tokens billed for `response`."""
+        for kind in ("prompt_tokens", "completion_tokens"):
+            tokens = getattr(response, kind)
+            self.metrics.observe(f"llm.{kind}", tokens)
+            self.metrics.count(f"llm.{kind}", tokens)
+
+    def count_parse(self, outcome: str, model: str = None):
+        """
+        Count a parse outcome of `model` (by default the process-wide
+        backend's): ok, salvaged or failed.<reason>.
+        """
+        self.metrics.count(f"parse.{outcome}",
+                           label=model or get_backend().model)
+
+    def discard_cached_output(self, prompt, history=None, advice=None,
+                              tier=None):
+        """Do not replay an unusable LLM output for this prompt."""
+        if self.cache is not None:
+            self.cache.discard(self.backend(tier).model,
+                               self.chat_messages(prompt, history, advice)[1])
+
     def llm_choose_random_action(self, available_actions):
         """
         Query the LLM with the list of available_actions. The prompt instructs 
@@ -111,95 +785,149 @@ class MistralAgent(BaseAgent):
         No additional commentary. No explanations. Return valid JSON only.
         """
 
-        llm_output = self.query_llm(prompt)
-        # Extract text from LLM response
-
         # Try to parse JSON from the LLM's response
         try:
-            parsed = json.loads(llm_output)
-            action_name = parsed.get("action_name")
-            # Validate that the selected action is in the list
-            if action_name not in available_actions:
-                raise ValueError(f"LLM chose an invalid action: {action_name}")
+            llm_output = self.query_llm(prompt)
+            action_name, _ = parse_action(llm_output, available_actions)
             print(f"LLM chose action: {action_name}")
-        except (json.JSONDecodeError, ValueError, KeyError):
+        except ParseError:
             # If parsing fails or LLM picks an invalid action, 
             # fall back to random choice from the list
+            self.discard_cached_output(prompt)
             action_name = random.choice(available_actions)
             print(f"LLM failed to parse JSON, falling back to random choice: {action_name}")
+        except LLMUnavailableError as einfo:
+            action_name = random.choice(available_actions)
+            print(f"{einfo} Falling back to random choice: {action_name}")
 
         return action_name
 
-    def llm_choose_action_from_actor_info(self, actor):
+    def build_actor_prompt(self, actor):
         """
+        The prompt asking the LLM to choose an action for `actor`, in the
+        compact token-budgeted form if `config.COMPACT_PROMPTS` is set.
+        """
+        if self.compact_prompts:
+            return self.prompt_encoder.prompt(actor)
+        return verbose_actor_prompt(actor)
 
+    def llm_choose_action_from_actor_info(self, actor, key=None):
+        """
+        Ask the LLM to choose an action of `actor`, falling back to a random
+        available action.
+
+        Parameters
+        ----------
+        actor: dict, an actor of `info['llm_info']`.
+        key: tuple, (ctrl_type, actor_id) of the actor. If given, follow-up
+            requests only send the changes since the previous request about
+            it (see `ActorContextStore`).
         """
         available_actions = actor['available_actions']
         actor_name = actor['name']
-        
-        # Create a structured prompt asking the model to choose one action from the list
-        prompt = f"""
-        You are an AI playing a Civilization-style game.
-        Your task: Achieve Total World Domination. Expand, explore, and multiply as fast as possible.
-
-        You are the following character:
-        {json.dumps(actor, indent=4)}
-
-        You must choose an action from the available actions:
-
-        {json.dumps(available_actions, indent=4)}
-
-        **IMPORTANT**: Your response must be a valid JSON object with the following structure:
-
-        ```json
-        {{
-            "reasoning": "<EXPLANATION_OF_WHY_THIS_ACTION_WAS_CHOSEN>",
-            "action_name": "<SELECTED_ACTION>"
-        }}
-        ```
+        kind = actor_type(actor_name)
+        signature = action_signature(available_actions)
+        # A late answer is logged with the turn it was asked at.
+        turn, advice = self.turn, self.advice
+        self.metrics.count("agent.decisions", label=kind)
 
-        - Do not provide any additional commentary.
-        - Do not include markdown formatting like ```json.
-        - Return only a valid JSON object.
-
-        """
+        # Create a structured prompt asking the model to choose one action from the list
+        history = None
+        with self.metrics.span("agent.prompt_build"):
+            if self.actor_contexts is not None and key is not None:
+                messages, ticket = self.actor_contexts.build_messages(
+                    key, actor, self.build_actor_prompt)
+                history, prompt = messages[:-1], messages[-1]['content']
+            else:
+                prompt = self.build_actor_prompt(actor)
+
+        # The router escalates unconfident answers: stream up to the
+        # confidence.
+        need_confidence = self.router is not None
+
+        def parse(llm_output):
+            action_name, salvaged = parse_action(llm_output,
+                                                 available_actions)
+            confident = self.router is None or self.router.confident(
+                parse_confidence(llm_output))
+            return action_name, salvaged, None if confident else "unconfident"
 
-        llm_output = self.query_llm(prompt)
-        
         # Extract text from LLM response
         try:
-            parsed = json.loads(llm_output.strip())  # Ensure clean JSON parsing
-            action_name = parsed.get("action_name")
-
-            # Validate that the selected action is in the list
-            if action_name not in available_actions:
-                raise ValueError(f"LLM chose an invalid action: {action_name} for {actor_name}")
+            llm_output, action_name = self.query_cascade(
+                prompt, history, advice,
+                self.route(kind, key[0] if key is not None else None), parse,
+                lambda text: action_ready(text, available_actions,
+                                          need_confidence))
+            # The fast path learns from fresh answers only.
+            source = "cache" if isinstance(llm_output, CachedText) else "llm"
+            if self.fast_path is not None and source == "llm":
+                self.fast_path.learn(actor, action_name, signature)
 
             print(f"LLM chose action for {actor_name}: {action_name}")
+            if history is not None:
+                self.actor_contexts.record(key, ticket, actor, messages[-1],
+                                           action_name)
 
-        except (json.JSONDecodeError, ValueError, KeyError):
+        except ParseError as einfo:
             # If parsing fails or LLM picks an invalid action, 
             # fall back to random choice from the list
+            llm_output = einfo.llm_output
+            source = "random"
             action_name = random.choice(available_actions)
-            print(f"LLM failed to parse JSON, falling back to random choice for {actor_name}: {action_name}")
+            self.metrics.count("agent.fallback.parse", label=kind)
+            if history is not None:
+                # The diff has no answer in the conversation, start over.
+                self.actor_contexts.reset(key)
+            print(f"{einfo} ({einfo.reason}), falling back to random choice for {actor_name}: {action_name}")
+        except LLMUnavailableError as einfo:
+            llm_output = repr(einfo)
+            source = "random"
+            action_name = random.choice(available_actions)
+            self.metrics.count("agent.fallback.unavailable", label=kind)
+            if history is not None:
+                # The LLM did not see this state, start over next time.
+                self.actor_contexts.reset(key)
+            print(f"{einfo} Falling back to random choice for {actor_name}: {action_name}")
+
+        # Queue the dialogue for the background log writer
+        with self.metrics.span("dialogue.write"):
+            self.write_dialogue({
+                "turn": turn,
+                "actor": actor_name,
+                "prompt": prompt,
+                "llm_output": llm_output,
+                "action_name": action_name,
+                "source": source,
+                "signature": signature,
+            })
 
-        # Create the filename with actor_name, turn number, and timestamp
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"{actor_name}_Turn{self.turn}_{timestamp}.txt"
-        filepath = os.path.join(save_directory, filename)
+        return action_name
 
-        # Ensure the directory exists
-        os.makedirs(save_directory, exist_ok=True)
+    def write_dialogue(self, record: dict):
+        """
+        Queue a dialogue for the log writer. An answer cut short while its
+        rest is read in the background is logged whole, once read.
+        """
+        rest = getattr(record['llm_output'], "rest", None)
+        if rest is None:
+            self.dialogue_log.write(record)
+            return
 
-        # Save prompt and llm_output to file
-        with open(filepath, "w", encoding="utf-8") as file:
-            file.write(f"Prompt:\n{prompt}\n\nLLM Output:\n{llm_output}")
+        def write_whole(future):
+            if future.exception() is None:
+                record['llm_output'] = future.result().strip()
+            self.dialogue_log.write(record)
 
-        return action_name
+        rest.add_done_callback(write_whole)
 
     
 
 def clear_saved_dialogues_folder():
+    """
+    Remove the saved dialogues of all the runs. Not called by the agents:
+    run it explicitly to start from an empty folder.
+    """
     if os.path.exists(save_directory):
         shutil.rmtree(save_directory)  # Remove the directory and all its contents
     os.makedirs(save_directory)  # Recreate an empty directory
@@ -0,0 +1,289 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Offline stand-in of the Mistral client, for running and benchmarking the
+agents without an API key.
+
+`MockLLMClient` answers `client.chat.complete(model=..., messages=...)`
+like the Mistral SDK, after a simulated latency, and injects rate limits,
+server errors and malformed outputs at the configured rates. Answers are
+rule-based by default: the first preferred action listed in the prompt.
+Everything is seeded by the prompt, so runs are reproducible even when
+requests are issued concurrently.
+"""
+
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+
+import config
+
+# Rule-based answers pick the first of these actions available to the actor,
+# else a random available action.
+PREFERRED_ACTIONS = ("build_city", "mine", "irrigation", "build_road",
+                     "explore", "fortify", "research", "sentry")
+
+COMPACT_ACTIONS_PATTERN = re.compile(r"choose one action from: (.*)")
+VERBOSE_ACTIONS_PATTERN = re.compile(r"from the available actions:\s*(\[.*?\])",
+                                     re.DOTALL)
+GROUP_PATTERN = re.compile(r"^(.*)_\[(.*)\]$")
+ADVISOR_PATTERN = re.compile(r"zoomed-out observation|global observation")
+BATCH_SECTION_PATTERN = re.compile(r"^\[actor_id (.*?)\]$.*?^actions: (.*?)$",
+                                   re.DOTALL | re.MULTILINE)
+
+
+def parse_latency(spec: str) -> callable:
+    """
+    The latency sampler of `spec`, a function of a `random.Random`:
+    "const:S", "uniform:LOW,HIGH", "exp:MEAN" or "lognormal:MEDIAN,SIGMA",
+    in seconds.
+    """
+    kind, _, params = spec.partition(":")
+    values = [float(value) for value in params.split(",") if value]
+    if kind == "const":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "exp":
+        return lambda rng: rng.expovariate(1 / values[0])
+    if kind == "lognormal":
+        return lambda rng: values[0] * rng.lognormvariate(0, values[1])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def expand_actions(grouped: str) -> list:
+    """Inverse of `prompt_encoder.group_actions`."""
+    actions = []
+    for item in grouped.split(", "):
+        group = GROUP_PATTERN.match(item.strip())
+        if group:
+            actions += [
+                f"{group.group(1)}_{suffix}"
+                for suffix in group.group(2).split(",")
+            ]
+        elif item.strip():
+            actions.append(item.strip())
+    return actions
+
+
+def prompt_actions(prompt: str) -> list:
+    """The available actions listed in a compact or verbose actor prompt."""
+    match = COMPACT_ACTIONS_PATTERN.search(prompt)
+    if match:
+        return expand_actions(match.group(1))
+    match = VERBOSE_ACTIONS_PATTERN.search(prompt)
+    if match:
+        try:
+            return json.loads(match.group(1))
+        except json.JSONDecodeError:
+            pass
+    return []
+
+
+def _rule_choice(actions: list, rng: random.Random) -> str:
+    action_name = next(
+        (action for action in PREFERRED_ACTIONS if action in actions), None)
+    if action_name is None:
+        action_name = rng.choice(actions) if actions else "no_action"
+    return action_name
+
+
+def rule_answer(prompt: str, rng: random.Random) -> str:
+    """
+    Answer with the first preferred action available, else a random one, for
+    every actor of a batch prompt, with a random confidence between 0.5 and
+    1 for single actors, in the key order the prompt asks for. Advisor
+    prompts get a fixed suggestion.
+    """
+    if ADVISOR_PATTERN.search(prompt) and not prompt_actions(prompt):
+        return json.dumps({
+            "thoughts": {
+                "thought": "Rule-based answer of the mock LLM."
+            },
+            "command": {
+                "name": "suggestion",
+                "input": {
+                    "suggestion": "Settlers should build cities, workers " +
+                    "improve the land and the other units explore."
+                }
+            }
+        })
+    sections = BATCH_SECTION_PATTERN.findall(prompt)
+    if sections:
+        return json.dumps([{
+            "actor_id": actor_id,
+            "reasoning": "Rule-based answer of the mock LLM.",
+            "action_name": _rule_choice(expand_actions(grouped), rng)
+        } for actor_id, grouped in sections])
+    answer = {
+        "reasoning": "Rule-based answer of the mock LLM.",
+        "action_name": _rule_choice(prompt_actions(prompt), rng),
+        "confidence": round(0.5 + 0.5 * rng.random(), 2)
+    }
+    if prompt.find('"action_name"') < prompt.find('"reasoning"'):
+        answer = {key: answer[key]
+                  for key in ("action_name", "confidence", "reasoning")}
+    return json.dumps(answer)
+
+
+class MockLLMError(Exception):
+    """An injected HTTP error, retried by the rate limiter like real ones."""
+    def __init__(self, status_code: int, retry_after: float = None):
+        super().__init__(f"Mock LLM error {status_code}")
+        self.status_code = status_code
+        headers = {} if retry_after is None else {
+            "Retry-After": str(retry_after)
+        }
+        self.response = type("MockHTTPResponse", (), {"headers": headers})()
+
+
+class _Record:
+    """Attribute access to keyword arguments, like the SDK response types."""
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class MockLLMClient:
+    """
+    Parameters
+    ----------
+    latency: str, latency distribution, see `parse_latency`.
+    rate_limit_rate: float, probability of answering HTTP 429.
+    server_error_rate: float, probability of answering HTTP 503.
+    malformed_rate: float, probability of answering text which is not JSON.
+    first_chunk_share: float, share of the latency before the first chunk of
+        a streamed answer; the rest is spread over the chunks.
+    answer: callable, `answer(prompt, rng)` returns the content, by default
+        `rule_answer`. Use `scripted_answers` to replay fixed answers.
+    seed: int, seed of all random draws.
+    sleep: bool, if False the latency is reported but not waited for.
+    """
+    def __init__(self,
+                 latency: str = config.MOCK_LLM_LATENCY,
+                 rate_limit_rate: float = config.MOCK_LLM_RATE_LIMIT_RATE,
+                 server_error_rate: float = config.MOCK_LLM_SERVER_ERROR_RATE,
+                 malformed_rate: float = config.MOCK_LLM_MALFORMED_RATE,
+                 first_chunk_share: float = config.MOCK_LLM_FIRST_CHUNK_SHARE,
+                 answer: callable = rule_answer,
+                 seed: int = 0,
+                 sleep: bool = True):
+        self.sample_latency = parse_latency(latency)
+        self.rate_limit_rate = rate_limit_rate
+        self.server_error_rate = server_error_rate
+        self.malformed_rate = malformed_rate
+        self.first_chunk_share = first_chunk_share
+        self.answer = answer
+        self.seed = seed
+        self.sleep = sleep
+        # The SDK exposes the completion endpoint as `client.chat.complete`.
+        self.chat = self
+        self.calls = 0
+        self.errors = 0
+        self.simulated_latency = 0.0
+        self._attempts = {}
+        self._lock = threading.Lock()
+
+    def _rng(self, prompt: str) -> random.Random:
+        """Seeded by the prompt and the number of times it was asked."""
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        with self._lock:
+            attempt = self._attempts.get(digest, 0)
+            self._attempts[digest] = attempt + 1
+            self.calls += 1
+        return random.Random(f"{self.seed}:{digest}:{attempt}")
+
+    def _respond(self, prompt: str) -> tuple:
+        """(latency, content, injected error or None) of a request."""
+        rng = self._rng(prompt)
+        latency = self.sample_latency(rng)
+        with self._lock:
+            self.simulated_latency += latency
+
+        draw = rng.random()
+        if draw < self.rate_limit_rate + self.server_error_rate:
+            with self._lock:
+                self.errors += 1
+            if draw < self.rate_limit_rate:
+                return latency, None, MockLLMError(
+                    429, retry_after=round(rng.uniform(0, 1), 3))
+            return latency, None, MockLLMError(503)
+        if draw < (self.rate_limit_rate + self.server_error_rate +
+                   self.malformed_rate):
+            content = "Sure! I would pick " + rule_answer(prompt, rng)[:20]
+        else:
+            content = self.answer(prompt, rng)
+        return latency, content, None
+
+    def complete(self, model: str, messages: list, **kwargs):
+        prompt = messages[-1]["content"]
+        latency, content, error = self._respond(prompt)
+        if self.sleep:
+            time.sleep(latency)
+        if error is not None:
+            raise error
+
+        return _Record(
+            model=model,
+            choices=[_Record(message=_Record(role="assistant",
+                                             content=content))],
+            usage=_Record(prompt_tokens=len(prompt) // 4 + 1,
+                          completion_tokens=len(content) // 4 + 1))
+
+    def stream(self, model: str, messages: list, chunk_size: int = 4,
+               **kwargs):
+        """
+        Yields the answer of `complete` by chunks of `chunk_size` characters:
+        the first one after `first_chunk_share` of the latency, the next ones
+        spread over the rest of it.
+        """
+        latency, content, error = self._respond(messages[-1]["content"])
+        if self.sleep:
+            time.sleep(latency * self.first_chunk_share)
+        if error is not None:
+            raise error
+        chunks = [
+            content[start:start + chunk_size]
+            for start in range(0, len(content), chunk_size)
+        ]
+        for index, chunk in enumerate(chunks):
+            if index and self.sleep:
+                time.sleep(latency * (1 - self.first_chunk_share) /
+                           (len(chunks) - 1))
+            yield chunk
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "errors": self.errors,
+                "simulated_latency": self.simulated_latency,
+            }
+
+
+def scripted_answers(answers: list) -> callable:
+    """An `answer` replaying `answers` in a loop, whatever the prompt."""
+    lock = threading.Lock()
+    position = [0]
+
+    def answer(prompt: str, rng: random.Random) -> str:
+        with lock:
+            content = answers[position[0] % len(answers)]
+            position[0] += 1
+        return content
+
+    return answer
@@ -0,0 +1,188 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Cascade of models of increasing cost for the LLM requests.
+
+An actor is first asked to the tier `config.MODEL_ROUTES` gives its actor
+type (or ctrl_type) in the current phase of the game, and its request is
+escalated to the next tier when the answer fails validation or reports a
+low confidence. Requests, latency, cost and escalations are counted per tier
+as `router.<metric>[<tier>]`.
+"""
+
+import threading
+
+import config
+from .llm_backends import create_backend, get_backend
+from .metrics import get_metrics
+
+
+class ModelRouter:
+    """
+    Parameters
+    ----------
+    backend_name: str, the backend serving every tier, by default
+        `config.LLM_BACKEND`.
+    tiers: dict, tier -> model, by default the backend's entry of
+        `config.MODEL_TIERS`.
+    order: tuple, the tiers from the cheapest; tiers missing from `tiers`
+        are skipped.
+    routes: dict, first tier of an actor type, ctrl_type or "_final": a
+        tier, or a dict of tiers by turn phase ("opening" or "game").
+    backends: dict, tier -> backend, instead of creating them.
+    """
+    def __init__(self,
+                 backend_name: str = None,
+                 tiers: dict = None,
+                 order: tuple = config.MODEL_TIER_ORDER,
+                 routes: dict = config.MODEL_ROUTES,
+                 opening_turns: int = config.MODEL_ROUTER_OPENING_TURNS,
+                 min_confidence: float = config.MODEL_ROUTER_MIN_CONFIDENCE,
+                 costs: dict = config.MODEL_COSTS,
+                 backends: dict = None):
+        self.backend_name = backend_name or config.LLM_BACKEND
+        if tiers is None:
+            tiers = config.MODEL_TIERS[self.backend_name]
+        self.tiers = tiers
+        self.order = [tier for tier in order if tier in tiers]
+        self.routes = routes
+        self.opening_turns = opening_turns
+        self.min_confidence = min_confidence
+        self.costs = costs
+        self.backends = dict(backends or {})
+        self.metrics = get_metrics()
+        self._lock = threading.Lock()
+
+    def phase(self, turn) -> str:
+        if turn is not None and turn <= self.opening_turns:
+            return "opening"
+        return "game"
+
+    def route(self, kind: str, ctrl_type: str = None, turn=None) -> list:
+        """
+        The tiers to ask for an actor of type `kind`, from its first tier to
+        the most expensive one.
+        """
+        first = self.routes[kind if kind in self.routes else ctrl_type]
+        if isinstance(first, dict):
+            first = first.get(self.phase(turn))
+        if first not in self.order:
+            return list(self.order)
+        return self.order[self.order.index(first):]
+
+    def backend(self, tier: str):
+        """
+        The backend of `tier`, created on first use. The process-wide backend
+        (see `get_backend`) serves the tier of its own model.
+        """
+        with self._lock:
+            backend = self.backends.get(tier)
+            if backend is None:
+                shared = get_backend()
+                if getattr(shared, "name", None) == self.backend_name and \
+                        shared.model == self.tiers[tier]:
+                    backend = shared
+                else:
+                    backend = create_backend(self.backend_name,
+                                             self.tiers[tier])
+                self.backends[tier] = backend
+            return backend
+
+    def confident(self, confidence) -> bool:
+        """
+        Whether a reported confidence is enough: an answer reporting none
+        (None) passes, an unusable one (`INVALID_CONFIDENCE`) does not.
+        """
+        return confidence is None or confidence >= self.min_confidence
+
+    def record(self, tier: str, response, seconds: float):
+        """Count a completed request of `tier`, its latency and cost."""
+        self.metrics.count("router.requests", label=tier)
+        self.metrics.observe("router.latency", seconds, label=tier)
+        prices = self.costs.get(response.model) or self.costs.get(
+            self.tiers[tier])
+        if prices is not None:
+            self.metrics.count(
+                "router.cost", (response.prompt_tokens * prices[0] +
+                                response.completion_tokens * prices[1]) / 1e6,
+                label=tier)
+
+    def escalate(self, tier: str, reason: str):
+        """
+        Count an answer of `tier` passed on to the next tier, because it was
+        "invalid" or "unconfident".
+        """
+        self.metrics.count("router.escalations", label=tier)
+        self.metrics.count(f"router.escalations.{reason}", label=tier)
+
+    def stats(self) -> dict:
+        """
+        Per tier requests, escalation rate, mean latency (s) and cost ($), from
+        the metrics.
+        """
+        summary = self.metrics.summary()
+        stats = {}
+        for tier in self.order:
+            requests = summary['counters'].get(f"router.requests[{tier}]", 0)
+            escalations = summary['counters'].get(
+                f"router.escalations[{tier}]", 0)
+            latency = summary['histograms'].get(f"router.latency[{tier}]")
+            stats[tier] = {
+                "model": self.tiers[tier],
+                "requests": requests,
+                "escalation_rate": escalations / requests if requests else 0.0,
+                "latency": latency['mean'] if latency else 0.0,
+                "cost": summary['counters'].get(f"router.cost[{tier}]", 0.0),
+            }
+        return stats
+
+    def close(self):
+        """Close the backends created by the router."""
+        shared = get_backend()
+        with self._lock:
+            for backend in self.backends.values():
+                if backend is not shared:
+                    backend.close()
+            self.backends = {}
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_model_router():
+    """
+    The router shared by all agents of the process, or None if routing is
+    disabled (`config.MODEL_ROUTER_ENABLED`), the model pinned by
+    `config.LLM_MODEL` or the backend has no `config.MODEL_TIERS`.
+    """
+    global _router
+    if not config.MODEL_ROUTER_ENABLED or config.LLM_MODEL or \
+            config.LLM_BACKEND not in config.MODEL_TIERS:
+        return None
+    with _router_lock:
+        if _router is None:
+            _router = ModelRouter()
+        return _router
+
+
+def set_model_router(router: ModelRouter):
+    """Replace the process-wide router, e.g. by one of mock backends."""
+    global _router
+    with _router_lock:
+        previous, _router = _router, router
+    if previous is not None and previous is not router:
+        previous.close()
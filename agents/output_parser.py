@@ -0,0 +1,369 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tolerant parsing of the structured LLM outputs.
+
+The first balanced JSON object (or array) is cut out of the output, whatever
+surrounds it (markdown fences, prose), common defects are repaired, and the
+answered action is matched against the available actions, exactly, then up
+to formatting, then fuzzily. Failures raise `ParseError` with the reason.
+"""
+
+import ast
+import difflib
+import functools
+import json
+import re
+
+from .prompt_encoder import normalize_action
+
+TRAILING_COMMA_PATTERN = re.compile(r",\s*([}\]])")
+UNQUOTED_KEY_PATTERN = re.compile(r"([{,]\s*)([A-Za-z_][A-Za-z0-9_]*)(\s*:)")
+DIGITS_PATTERN = re.compile(r"\d+")
+ACTION_NAME_PATTERN = re.compile(
+    r"[\"']?action_name[\"']?\s*[:=]\s*[\"']([^\"'\n]+)[\"']")
+CONFIDENCE_PATTERN = re.compile(
+    r"[\"']?confidence[\"']?\s*[:=]\s*[\"']?([0-9.]+|low|medium|high)",
+    re.IGNORECASE)
+CONFIDENCE_WORDS = {"low": 0.25, "medium": 0.5, "high": 0.9}
+# A reported confidence which is not a number from 0 to 1 (or a percentage).
+INVALID_CONFIDENCE = -1.0
+# A confidence whose value is complete, while streaming.
+CONFIDENCE_DONE_PATTERN = re.compile(
+    CONFIDENCE_PATTERN.pattern + r"[\"']?\s*[,}\n]", re.IGNORECASE)
+# Fuzzy matches must be at least this similar.
+FUZZY_CUTOFF = 0.75
+
+
+class ParseError(ValueError):
+    """
+    Why an output could not be used: `reason` is one of "no_json",
+    "invalid_json", "missing_action" or "unknown_action".
+    """
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+class JSONScanner:
+    """
+    Finds the first balanced JSON object or array in text fed by chunks, as
+    it is streamed. Brackets inside strings are ignored.
+    """
+    def __init__(self, opener: str = "{"):
+        self.opener = opener
+        self.closer = "}" if opener == "{" else "]"
+        self.buffer = []
+        self.stack = []
+        self.started = False
+        self.in_string = False
+        self.escaped = False
+        self.done = False
+
+    def feed(self, chunk: str):
+        """Returns the text of the first balanced value once complete."""
+        if self.done:
+            return None
+        for char in chunk:
+            if not self.started:
+                if char != self.opener:
+                    continue
+                self.started = True
+            self.buffer.append(char)
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.stack.append("}" if char == "{" else "]")
+            elif char in "}]":
+                if self.stack and self.stack[-1] == char:
+                    self.stack.pop()
+                if not self.stack:
+                    self.done = True
+                    return "".join(self.buffer)
+        return None
+
+    def partial(self):
+        """The text scanned so far, closed as if it ended here, or None."""
+        if not self.started:
+            return None
+        text = "".join(self.buffer)
+        if self.in_string:
+            text += '"'
+        return text + "".join(reversed(self.stack))
+
+
+def repair_json(text: str) -> str:
+    """Fix trailing commas, unquoted keys and Python literals."""
+    text = TRAILING_COMMA_PATTERN.sub(r"\1", text)
+    text = UNQUOTED_KEY_PATTERN.sub(r'\1"\2"\3', text)
+    return re.sub(r"\b(True|False|None)\b", lambda match: {
+        "True": "true",
+        "False": "false",
+        "None": "null"
+    }[match.group(1)], text)
+
+
+def extract_json(text: str, opener: str = "{"):
+    """
+    The first JSON object (or array, for `opener` "[") of `text`.
+
+    Returns
+    -------
+    (value, salvaged): salvaged is True if the text needed repairs.
+
+    Raises
+    ------
+    ParseError: "no_json" or "invalid_json".
+    """
+    scanner = JSONScanner(opener)
+    candidate = scanner.feed(text)
+    truncated = candidate is None
+    if truncated:
+        candidate = scanner.partial()
+    if candidate is None:
+        raise ParseError("no_json", f"No JSON {opener}...{scanner.closer} " +
+                         "in the LLM output.")
+    salvaged = truncated or candidate.strip() != text.strip()
+    try:
+        return json.loads(candidate), salvaged
+    except json.JSONDecodeError:
+        pass
+    try:
+        return json.loads(repair_json(candidate)), True
+    except json.JSONDecodeError:
+        pass
+    try:
+        # Single quoted strings and the like.
+        value = ast.literal_eval(candidate)
+        if isinstance(value, (dict, list)):
+            return value, True
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        pass
+    raise ParseError("invalid_json", "Invalid JSON in the LLM output.")
+
+
+def _trigrams(name: str) -> set:
+    padded = f"  {name} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class ActionMatcher:
+    """
+    Matches answered action names to the available actions of an actor.
+
+    Exact and normalized names are looked up in dicts. Fuzzy matches are
+    searched among the actions sharing the most character trigrams with the
+    answer, so that large action sets are not compared one by one. Numbers
+    must match exactly: `goto_7` is not a typo of `goto_1`.
+    """
+    CANDIDATES = 16
+
+    def __init__(self, available_actions: tuple):
+        self.actions = set(available_actions)
+        self.normalized = {}
+        self.trigrams = {}
+        for action in available_actions:
+            name = normalize_action(action)
+            self.normalized.setdefault(name, action)
+            for trigram in _trigrams(name):
+                self.trigrams.setdefault(trigram, []).append(name)
+
+    def match(self, name):
+        """
+        Returns (action, fuzzy), where action is None if nothing is close
+        enough to `name`.
+        """
+        if name in self.actions:
+            return name, False
+        name = normalize_action(name)
+        if name in self.normalized:
+            return self.normalized[name], False
+        counts = {}
+        for trigram in _trigrams(name):
+            for candidate in self.trigrams.get(trigram, ()):
+                counts[candidate] = counts.get(candidate, 0) + 1
+        digits = DIGITS_PATTERN.findall(name)
+        candidates = sorted(
+            (candidate for candidate in counts
+             if DIGITS_PATTERN.findall(candidate) == digits),
+            key=counts.get,
+            reverse=True)[:self.CANDIDATES]
+        close = difflib.get_close_matches(name,
+                                          candidates,
+                                          n=1,
+                                          cutoff=FUZZY_CUTOFF)
+        if not close:
+            return None, False
+        return self.normalized[close[0]], True
+
+
+@functools.lru_cache(maxsize=1024)
+def get_matcher(available_actions: tuple) -> ActionMatcher:
+    return ActionMatcher(available_actions)
+
+
+def parse_action(llm_output: str, available_actions: list) -> tuple:
+    """
+    The available action answered in `llm_output`.
+
+    Returns
+    -------
+    (action_name, salvaged): salvaged is True if the output needed repairs,
+        or the action a fuzzy match.
+
+    Raises
+    ------
+    ParseError: with the reason of the failure.
+    """
+    try:
+        parsed, salvaged = extract_json(llm_output)
+        name = parsed.get("action_name") if isinstance(parsed, dict) else None
+    except ParseError as einfo:
+        # Last resort: a quoted action_name anywhere in the output.
+        match = ACTION_NAME_PATTERN.search(llm_output)
+        if match is None:
+            raise einfo
+        name, salvaged = match.group(1), True
+    if not isinstance(name, str) or not name.strip():
+        raise ParseError("missing_action", "No action_name in the LLM output.")
+    action_name, fuzzy = get_matcher(tuple(available_actions)).match(name)
+    if action_name is None:
+        raise ParseError("unknown_action",
+                         f"LLM chose an invalid action: {name}")
+    return action_name, salvaged or fuzzy
+
+
+def parse_confidence(llm_output: str):
+    """
+    The "confidence" of the JSON object of `llm_output` (of the text if
+    there is no JSON), between 0 and 1: percentages above 1 are scaled and
+    low/medium/high converted. None if there is none, INVALID_CONFIDENCE if
+    it is reported but unusable, which is never confident enough.
+    """
+    try:
+        parsed, _ = extract_json(llm_output)
+    except ParseError:
+        match = CONFIDENCE_PATTERN.search(llm_output)
+        value = None if match is None else match.group(1)
+    else:
+        value = parsed.get("confidence") if isinstance(parsed, dict) else None
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = CONFIDENCE_WORDS.get(value.strip().lower(), value)
+    if isinstance(value, bool):
+        return INVALID_CONFIDENCE
+    try:
+        confidence = float(value)
+    except (TypeError, ValueError):
+        return INVALID_CONFIDENCE
+    if 1 < confidence <= 100:
+        confidence /= 100
+    return confidence if 0 <= confidence <= 1 else INVALID_CONFIDENCE
+
+
+def _top_level_match(pattern, text: str, start: int = 0):
+    """
+    The first match of `pattern` in `text` from `start` which is a key of
+    the outermost JSON object, not e.g. quoted inside its reasoning.
+    """
+    scanner = JSONScanner()
+    scanned = 0
+    for match in pattern.finditer(text, start):
+        scanner.feed(text[scanned:match.start()])
+        scanned = match.start()
+        # A key follows the opening brace or a comma, a value a colon.
+        if scanner.started and len(scanner.stack) == 1 and \
+                not scanner.in_string and \
+                text[:match.start()].rstrip()[-1:] in ("{", ","):
+            return match
+    return None
+
+
+def action_ready(text: str,
+                 available_actions: list,
+                 need_confidence: bool = False) -> bool:
+    """
+    Whether a partly streamed answer already names an available action,
+    followed by its confidence if `need_confidence`: the rest of the answer
+    can then be skipped. Only the keys of the answer object count, not
+    those quoted in its reasoning.
+    """
+    match = _top_level_match(ACTION_NAME_PATTERN, text)
+    if match is None or get_matcher(tuple(available_actions)).match(
+            match.group(1))[0] is None:
+        return False
+    return not need_confidence or _top_level_match(
+        CONFIDENCE_DONE_PATTERN, text, match.end()) is not None
+
+
+def _extract_batch(llm_output: str) -> tuple:
+    """
+    The first JSON array of objects of `llm_output`, skipping the brackets
+    of prose before it (e.g. "[actor_id 103]" echoed from the prompt).
+    """
+    error = None
+    start = llm_output.find("[")
+    while start != -1:
+        try:
+            entries, salvaged = extract_json(llm_output[start:], "[")
+        except ParseError as einfo:
+            error = error or einfo
+        else:
+            if isinstance(entries, list) and entries and all(
+                    isinstance(entry, dict) for entry in entries):
+                return entries, salvaged or bool(llm_output[:start].strip())
+        start = llm_output.find("[", start + 1)
+    raise error or ParseError("no_json", "No JSON array of objects in the " +
+                              "LLM output.")
+
+
+def parse_batch(llm_output: str, actors: dict) -> tuple:
+    """
+    Map the JSON array answered to a batch prompt to
+    {actor_id: available action or None}, for the actors of `actors`
+    ({actor_id: actor}).
+
+    Returns
+    -------
+    (decided, salvaged)
+
+    Raises
+    ------
+    ParseError: if there is no usable JSON array in `llm_output`.
+    """
+    entries, salvaged = _extract_batch(llm_output)
+    by_key = {str(actor_id): actor_id for actor_id in actors}
+    decided = {actor_id: None for actor_id in actors}
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        actor_id = by_key.get(str(entry.get("actor_id")))
+        name = entry.get("action_name")
+        if actor_id is None or decided[actor_id] is not None or \
+                not isinstance(name, str):
+            continue
+        action_name, fuzzy = get_matcher(
+            tuple(actors[actor_id]['available_actions'])).match(name)
+        decided[actor_id] = action_name
+        salvaged = salvaged or fuzzy
+    return decided, salvaged
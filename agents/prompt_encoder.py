@@ -0,0 +1,296 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Actor prompt serialization.
+
+`verbose_actor_prompt` is the original prompt pasting the indented JSON of
+the actor. `ActorPromptEncoder` emits a compact and deterministic form of
+the same information: the 5x5 tiles as a grid with a legend of the tile
+contents, the zoomed-out blocks as a 3x3 table, and the actions grouped by
+family, within a token budget.
+"""
+
+import json
+import re
+import threading
+
+from civrealm.freeciv.utils.freeciv_logging import fc_logger
+
+import config
+
+ACTOR_PROMPT = """
+        You are an AI playing a Civilization-style game.
+        Your task: Achieve Total World Domination. Expand, explore, and multiply as fast as possible.
+
+        You are the following character:
+        {character}
+
+        You must choose an action from the available actions:
+
+        {actions}
+
+        **IMPORTANT**: Your response must be a valid JSON object with the following structure:
+
+        ```json
+        {schema}
+        ```
+
+        - Do not provide any additional commentary.
+        - Do not include markdown formatting like ```json.
+        - Return only a valid JSON object.
+
+        """
+
+COMPACT_ACTOR_PROMPT = """You are an AI playing a Civilization-style game.
+Your task: Achieve Total World Domination. Expand, explore, and multiply as fast as possible.
+
+You are the following character:
+{character}
+
+You must choose one action from: {actions}
+
+Reply with only this JSON object, without markdown:
+{schema}
+"""
+
+BATCH_ACTOR_PROMPT = """You are an AI playing a Civilization-style game.
+Your task: Achieve Total World Domination. Expand, explore, and multiply as fast as possible.
+
+You control the following {count} characters. For each of them, choose one action from its own actions.
+
+{characters}
+
+Reply with only this JSON array, one object per character, without markdown:
+[{{"actor_id": <actor_id>, "reasoning": "<why>", "action_name": "<one of its actions>"}}, ...]
+"""
+
+# JSON answer of a single actor. The action-first form lets a streamed
+# answer be used before its reasoning is generated.
+ANSWER_SCHEMA = ('{"reasoning": "<why>", '
+                 '"action_name": "<one available action>", '
+                 '"confidence": <0 to 1>}')
+ACTION_FIRST_ANSWER_SCHEMA = ('{"action_name": "<one available action>", '
+                              '"confidence": <0 to 1>, "reasoning": "<why>"}')
+
+# Offsets (north-south, west-east) of the tiles and blocks around the actor.
+RADIUS = 2
+
+
+def _direction_key(prefix: str, d_ns: int, d_we: int) -> str:
+    parts = []
+    if d_ns:
+        parts.append(f"{'north' if d_ns < 0 else 'south'}_{abs(d_ns)}")
+    if d_we:
+        parts.append(f"{'west' if d_we < 0 else 'east'}_{abs(d_we)}")
+    if not parts:
+        return f"current_{prefix}"
+    return f"{prefix}_" + "_".join(parts)
+
+
+# Strings describing who owns the units on a tile or block; least useful.
+OWNERSHIP_PATTERN = re.compile(r"belong to|owners are")
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+
+def count_tokens(text: str) -> int:
+    """
+    Number of tokens of `text` with tiktoken, or an estimate if its
+    encoding cannot be loaded.
+    """
+    global _tokenizer
+    with _tokenizer_lock:
+        if _tokenizer is None:
+            try:
+                import tiktoken
+                _tokenizer = tiktoken.get_encoding(
+                    config.PROMPT_TOKEN_ENCODING)
+            except Exception as einfo:
+                # Not installed, or its encoding cannot be downloaded
+                # (offline): estimate from now on.
+                fc_logger.warning("No tiktoken encoding, token counts are " +
+                                  f"estimated: {einfo!r}")
+                _tokenizer = False
+    if _tokenizer is False:
+        return len(text) // 4 + 1
+    return len(_tokenizer.encode(text))
+
+
+def answer_schema() -> str:
+    """The JSON answer asked of a single actor, see ACTION_FIRST_ANSWERS."""
+    if config.ACTION_FIRST_ANSWERS:
+        return ACTION_FIRST_ANSWER_SCHEMA
+    return ANSWER_SCHEMA
+
+
+def verbose_actor_prompt(actor: dict) -> str:
+    """The original prompt, with the indented JSON of the whole actor."""
+    return ACTOR_PROMPT.format(
+        character=json.dumps(actor, indent=4),
+        actions=json.dumps(actor['available_actions'], indent=4),
+        schema=answer_schema())
+
+
+def group_actions(actions: list) -> str:
+    """
+    List actions grouped by family, keeping their order of appearance,
+    e.g. `goto_0, goto_1, goto_3` becomes `goto_[0,1,3]`.
+    """
+    families = {}
+    for action in actions:
+        stem, _, suffix = action.rpartition("_")
+        families.setdefault(stem if stem else action, []).append(
+            suffix if stem else None)
+    out = []
+    for stem, suffixes in families.items():
+        if len(suffixes) > 1 and None not in suffixes:
+            out.append(f"{stem}_[{','.join(suffixes)}]")
+        else:
+            out += [stem if suffix is None else f"{stem}_{suffix}"
+                    for suffix in suffixes]
+    return ", ".join(out)
+
+
+def normalize_action(name: str) -> str:
+    return re.sub(r"[\s\-]+", "_", str(name).strip().strip("'\"`")).lower()
+
+
+class ActorPromptEncoder:
+    """
+    Compact, token-budgeted serialization of `info['llm_info']` actors.
+
+    Details are dropped from the least to the most valuable until the prompt
+    fits `token_budget`: unit ownership strings, then the zoomed-out blocks
+    except the current one, then the outer ring of tiles, then all tiles.
+    """
+    # Detail levels, from the most to the least detailed.
+    LEVELS = (
+        {"ownership": True, "blocks": True, "radius": 2},
+        {"ownership": False, "blocks": True, "radius": 2},
+        {"ownership": False, "blocks": False, "radius": 2},
+        {"ownership": False, "blocks": False, "radius": 1},
+        {"ownership": False, "blocks": False, "radius": 0},
+    )
+
+    def __init__(self, token_budget: int = config.PROMPT_TOKEN_BUDGET):
+        self.token_budget = token_budget
+
+    def prompt(self, actor: dict) -> str:
+        """The compact prompt of `actor`, within the token budget if possible."""
+        for level in self.LEVELS:
+            prompt = COMPACT_ACTOR_PROMPT.format(
+                character=self.encode_actor(actor, **level),
+                actions=group_actions(actor['available_actions']),
+                schema=answer_schema())
+            if count_tokens(prompt) <= self.token_budget:
+                break
+        return prompt
+
+    def actor_section(self, actor_id, actor: dict) -> str:
+        """
+        The part of a batch prompt describing `actor`, within the token
+        budget of a single prompt if possible.
+        """
+        for level in self.LEVELS:
+            section = f"[actor_id {actor_id}]\n" + \
+                self.encode_actor(actor, **level) + \
+                f"\nactions: {group_actions(actor['available_actions'])}"
+            if count_tokens(section) <= self.token_budget:
+                break
+        return section
+
+    @staticmethod
+    def batch_prompt(sections: list) -> str:
+        """The prompt deciding the actors of `sections` in one request."""
+        return BATCH_ACTOR_PROMPT.format(count=len(sections),
+                                         characters="\n\n".join(sections))
+
+    def encode_actor(self,
+                     actor: dict,
+                     ownership: bool = True,
+                     blocks: bool = True,
+                     radius: int = RADIUS) -> str:
+        lines = [f"name: {actor['name']}"]
+        observations = actor.get('observations', {})
+        legend = {}
+
+        def code(item: str) -> str:
+            if item not in legend:
+                legend[item] = _legend_code(len(legend))
+            return legend[item]
+
+        def cell(items: list) -> str:
+            items = [
+                item for item in items
+                if ownership or not OWNERSHIP_PATTERN.search(item)
+            ]
+            return "+".join(code(item) for item in items) or "-"
+
+        body = []
+        minimap = observations.get('minimap')
+        if minimap and radius > 0:
+            body.append(
+                "tiles (rows north to south, columns west to east, " +
+                "actor at the center):")
+            for d_ns in range(-radius, radius + 1):
+                body.append(" ".join(
+                    cell(minimap.get(_direction_key("tile", d_ns, d_we), []))
+                    for d_we in range(-radius, radius + 1)))
+
+        upper_map = observations.get('upper_map')
+        if upper_map:
+            if blocks:
+                body.append("blocks of 5x5 tiles (rows north to south, " +
+                            "columns west to east, actor in the center one):")
+                for d_ns in (-1, 0, 1):
+                    body.append(" | ".join(
+                        self._block(
+                            upper_map.get(_direction_key("block", d_ns, d_we),
+                                          []), ownership)
+                        for d_we in (-1, 0, 1)))
+            else:
+                body.append("current block of 5x5 tiles: " + self._block(
+                    upper_map.get("current_block", []), ownership))
+
+        if legend:
+            lines.append("legend: " + ", ".join(f"{value}={key}"
+                                                for key, value in legend.items()))
+        lines += body
+        for key, value in actor.items():
+            if key not in ('name', 'available_actions', 'observations'):
+                lines.append(f"{key}: " +
+                             json.dumps(value, separators=(",", ":")))
+        for key, value in observations.items():
+            if key not in ('minimap', 'upper_map'):
+                lines.append(f"{key}: " +
+                             json.dumps(value, separators=(",", ":")))
+        return "\n".join(lines)
+
+    @staticmethod
+    def _block(items: list, ownership: bool) -> str:
+        return ", ".join(
+            item for item in items
+            if ownership or not OWNERSHIP_PATTERN.search(item)) or "-"
+
+
+def _legend_code(index: int) -> str:
+    """A, B, ..., Z, AA, AB, ..."""
+    out = ""
+    index += 1
+    while index:
+        index, rest = divmod(index - 1, 26)
+        out = chr(ord("A") + rest) + out
+    return out
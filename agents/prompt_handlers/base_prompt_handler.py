@@ -17,15 +17,134 @@ Base Prompt Handler @
 
 """
 
+import ast
 import os
 import re
-import copy
+from collections.abc import Mapping
 from civrealm.freeciv.utils.freeciv_logging import fc_logger
+from .registry import CONF_FNAME, get_prompt_registry
 
-print(os.getcwd())
 PROMPT_ROOT_DIR = "./prompt_collections/"
 BASE_DIR = "base_prompts/"
 
+TOKEN_PATTERN = re.compile(r"<%[ ]+(.*?)[ ]+%>|<\$[ ]+(.*?)[ ]+\$>")
+
+
+class CompiledTemplate:
+    """
+    A template compiled into a list of segments, which are literal strings,
+    `<% variable %>` slots, and `<$ sub_prompt(key=literal, ...) $>` calls.
+    """
+    TEXT, VAR, SUB = 0, 1, 2
+
+    def __init__(self, raw: str, name: str):
+        self.name = name
+        self.segments = []
+        text_start = 0
+        for match in TOKEN_PATTERN.finditer(raw):
+            self._add_text(raw[text_start:match.start()])
+            text_start = match.end()
+            if match.group(1) is not None:
+                self.segments.append((self.VAR, match.group(1)))
+            else:
+                self.segments.append(
+                    (self.SUB, self._parse_call(match.group(2), raw,
+                                                match.start())))
+        self._add_text(raw[text_start:])
+        self.references = {
+            value[0]
+            for kind, value in self.segments if kind == self.SUB
+        }
+
+    def _add_text(self, text: str):
+        if not text:
+            return
+        if self.segments and self.segments[-1][0] == self.TEXT:
+            self.segments[-1] = (self.TEXT, self.segments[-1][1] + text)
+        else:
+            self.segments.append((self.TEXT, text))
+
+    def _parse_call(self, key: str, raw: str, pos: int) -> tuple:
+        """`name` or `name(key=literal, ...)` -> (name, kwargs)."""
+        if "(" not in key:
+            return key.strip(), {}
+        try:
+            call = ast.parse(key.strip(), mode="eval").body
+            if not isinstance(call, ast.Call) or not isinstance(
+                    call.func, ast.Name) or call.args:
+                raise ValueError("expected `name(key=literal, ...)`")
+            return call.func.id, {
+                keyword.arg: ast.literal_eval(keyword.value)
+                for keyword in call.keywords
+            }
+        except (SyntaxError, ValueError) as einfo:
+            line = raw.count("\n", 0, pos) + 1
+            raise Exception(f"Invalid sub-prompt `{key}` in {self.name}, " +
+                            f"line {line}: {einfo}") from einfo
+
+    def render(self, handler, links: tuple, _raise_empty: bool,
+               kwargs: dict) -> str:
+        """`links` is given by `BasePromptHandler._link`."""
+        targets, broken = links
+        out = []
+        for kind, value in self.segments:
+            if kind == self.TEXT:
+                out.append(value)
+            elif kind == self.VAR:
+                try:
+                    out.append(str(kwargs[value]))
+                    # I decide not to use `kwargs.get(key, "")` in order to
+                    # log the incidents when key is not provided in args.
+                except KeyError as einfo:
+                    fc_logger.error(f"Failed to provide key {value}" +
+                                    f" in generating {self.name}.")
+                    fc_logger.error(einfo)
+                    print(f"Failed to provide key {value}" +
+                          f" in generating {self.name}.")
+                    if _raise_empty:
+                        raise
+            else:
+                sub_name, sub_kwargs = value
+                target = targets.get(sub_name)
+                if target is None or sub_name in broken:
+                    if _raise_empty:
+                        raise Exception(f"Failed to load submodule {sub_name}"
+                                        + f" in generating {self.name}.")
+                    continue
+                out.append(handler.templates[target](_raise_empty,
+                                                     **sub_kwargs))
+        return "".join(out)
+
+
+class TemplateView(Mapping):
+    """
+    The templates of a handler: template name -> prompt generator.
+
+    Templates are compiled on first use through the shared registry, and
+    re-bound when the registry has reloaded their file.
+    """
+    def __init__(self, handler):
+        self.handler = handler
+        # name -> (compiled, generator)
+        self.bound = {}
+
+    def __getitem__(self, name: str) -> callable:
+        handler = self.handler
+        path = handler.registry.table(handler.prompt_prefix)[1][name]
+        compiled = handler.registry.get_compiled(path, name,
+                                                 handler._compile_template)
+        entry = self.bound.get(name)
+        if entry is None or entry[0] is not compiled:
+            entry = (compiled, handler._bind(compiled, handler._link(compiled)))
+            self.bound[name] = entry
+        return entry[1]
+
+    def __iter__(self):
+        return iter(self.handler.registry.table(self.handler.prompt_prefix)[1])
+
+    def __len__(self) -> int:
+        return len(self.handler.registry.table(self.handler.prompt_prefix)[1])
+
 
 class BasePromptHandler:
     """
@@ -36,10 +155,14 @@ class BasePromptHandler:
     The prompts can be in .txt format and can use `<% name %>` for certain
     replacement of variables, provided the variables are given.
 
+    Templates are loaded lazily and shared between handlers through the
+    process-wide `PromptRegistry`, so that constructing a handler does not
+    read any file once the collections are warm.
+
     [TODO] How to implement `if` and `for` in the setup? I think importing
     python scripts could be a solution, but another processor must be written.
     """
-    CONF_FNAME = "__settings__.conf"
+    CONF_FNAME = CONF_FNAME
 
     def __init__(self, prompt_prefix: str = BASE_DIR):
         """
@@ -52,17 +175,19 @@ class BasePromptHandler:
         self.prompt_prefix = PROMPT_ROOT_DIR + self._ending_dir(prompt_prefix)
         if not os.path.exists(self.prompt_prefix):
             if os.path.exists(prompt_prefix):
-                self.prompt_prefix = prompt_prefix
+                self.prompt_prefix = self._ending_dir(prompt_prefix)
             else:
                 raise Exception(
                     f"Prompt prefix dir `{prompt_prefix}` does not exist! " +
                     f"Use 'example' for {PROMPT_ROOT_DIR}example/," +
                     "or simply the full path.")
-        self.templates = {}
-        self.related_pclasses = [self.prompt_prefix]
-        self._solve_dependency()
-        for prefix in reversed(self.related_pclasses):
-            self._load_prompt_templates(prefix)
+        self.registry = get_prompt_registry(PROMPT_ROOT_DIR)
+        self.templates = TemplateView(self)
+
+    @property
+    def related_pclasses(self) -> list:
+        """The dirs of the dependency chain, BFS on the dependency graph."""
+        return self.registry.table(self.prompt_prefix)[0]
 
     @staticmethod
     def _ending_dir(path: str):
@@ -74,104 +199,100 @@ class BasePromptHandler:
         # Maybe, more rules?
         return key.replace(".", "_")
 
-    def _solve_dependency(self):
+    @staticmethod
+    def _compile_template(raw: str, template_name: str):
+        """Compile a template; shared by all handlers of the class."""
+        return CompiledTemplate(raw, template_name)
+
+    def _bind(self, compiled, links: tuple) -> callable:
+        def parser(_raise_empty: bool = False, **kwargs) -> str:
+            return compiled.render(self, links, _raise_empty, kwargs)
+
+        parser.compiled = compiled
+        return parser
+
+    def _txt_parser(self, raw: str, template_name: str) -> callable:
         """
-        Solve the dependency of prompts.
+        Returns prompt generator.
 
-        BFS on dependency graph.
+        The template is compiled once here; generating a prompt is then a
+        single join over the compiled segments.
         """
-        pclass = [self.prompt_prefix]
-
-        while len(pclass) > 0:
-            current = pclass.pop(0)
-            current = self._ending_dir(current)
-            new_dependency = []
-            with open(current + self.CONF_FNAME, "r",
-                      encoding="utf-8") as filep:
-                for line in filep:
-                    if line.strip()[0] == "#":
-                        continue
-                    conf_kv = line.strip().split(":")
-                    if conf_kv[0].strip().lower() == "parents":
-                        new_dependency += conf_kv[1].split(",")
-                        break
-            for name in new_dependency:
-                path = PROMPT_ROOT_DIR + self._ending_dir(name.strip())
-                if path not in self.related_pclasses:
-                    self.related_pclasses.append(path)
-                    pclass.append(path)
+        compiled = self._compile_template(raw, template_name)
+        return self._bind(compiled, self._link(compiled))
 
-    def _txt_parser(self, raw: str, template_name: str) -> callable:
-        def parser(_raise_empty: bool = False, **kwargs) -> str:
-            nonlocal raw, template_name, self
-            variables = set(re.findall("(<%[ ]+(.*?)[ ]+%>)", raw))
-            recursions = set(re.findall(r"(<\$[ ]+(.*?)[ ]+\$>)", raw))
+    def _link(self, compiled) -> tuple:
+        """
+        Resolve the sub-prompt references `<$ ... $>` of a template when it
+        is bound. Unknown and cyclic references are reported here rather than
+        on every generation, and render as empty strings.
 
-            out = copy.deepcopy(raw)
-            for pattern, key in variables:
-                try:
-                    out = out.replace(pattern, str(kwargs[key]))
-                    # I decide not to use `kwargs.get(key, "")` in order to
-                    # log the incidents when key is not provided in args.
-                except KeyError as einfo:
-                    fc_logger.error(f"Failed to provide key {key}" +
-                                    f" in generating {template_name}.")
-                    fc_logger.error(einfo)
-                    print(f"Failed to provide key {key}" +
-                          f" in generating {template_name}.")
-                    if _raise_empty:
-                        raise
-                    out = out.replace(pattern, "")
-            for pattern, key in recursions:
-                try:
-                    func_end = key.find("(")
-                    if func_end == -1:
-                        key = key + "()"
-                        func_end = -2
-                    if key[:func_end] == template_name:
-                        print("Should raise")
-                        raise Exception("Self-quoted!")
-                    # replace = eval(
-                    #     f"self.generate['{key[:func_end]}']({key[func_end:]})")
-                    # print(self.templates.keys())
-                    replace = eval("self." + key)
-
-                    print(replace)
-                    out = out.replace(pattern, replace)
-                except Exception as einfo:
-                    fc_logger.error(f"Failed to load submodule {key}" +
-                                    f" in generating {template_name}.")
-                    fc_logger.error(einfo)
-                    print(f"Failed to load submodule {key}" +
-                          f" in generating {template_name}.")
-                    print(einfo)
-                    if _raise_empty:
-                        raise
-                    out = out.replace(pattern, "")
-            return out
+        Returns
+        -------
+        (targets, broken): sub-prompt name -> template name, and the set of
+            cyclic sub-prompt names.
+        """
+        targets, broken = {}, set()
+        for sub_name in compiled.references:
+            target = self._resolve_template_name(sub_name)
+            if target is None:
+                self._report_broken(compiled.name, sub_name,
+                                    f"No such template `{sub_name}`.")
+                continue
+            cycle = self._find_path(target, compiled.name)
+            if cycle is not None:
+                self._report_broken(
+                    compiled.name, sub_name,
+                    "Self-quoted! " + " -> ".join([compiled.name] + cycle))
+                broken.add(sub_name)
+            targets[sub_name] = target
+        return targets, broken
 
-        return parser
+    def _find_path(self, start: str, goal: str):
+        """DFS on the references from template `start` to `goal`."""
+        paths = self.registry.table(self.prompt_prefix)[1]
+        stack, seen = [(start, [start])], set()
+        while stack:
+            name, path = stack.pop()
+            if name == goal:
+                return path
+            if name in seen:
+                continue
+            seen.add(name)
+            compiled = self.registry.get_compiled(paths[name], name,
+                                                  self._compile_template)
+            for sub_name in compiled.references:
+                target = self._resolve_template_name(sub_name)
+                if target is not None:
+                    stack.append((target, path + [target]))
+        return None
 
-    def _load_prompt_templates(self, prefix: str):
-        # load text-style templates
-        try:
-            files = list(os.walk(prefix))[0][2]
-
-        except Exception as einfo:
-            print("Error in loading prompt files.", einfo)
-            raise einfo
-
-        for fname in [
-                fname[:-4] for fname in files
-                if fname[-4:] == ".txt" and "#" not in fname
-        ]:
-            with open(prefix + fname + ".txt", "r", encoding="utf-8") as filep:
-                raw = filep.read()
-            key = self._regularize(fname)
-            # self.templates[key] = self._txt_parser(raw, key)
-            self.templates[fname] = self._txt_parser(raw, fname)
-            # This should provide a runtime-object-level method management.
-            setattr(self, key, self.templates[fname])
+    def _resolve_template_name(self, sub_name: str):
+        paths = self.registry.table(self.prompt_prefix)[1]
+        if sub_name in paths:
+            return sub_name
+        for name in paths:
+            if self._regularize(name) == sub_name:
+                return name
+        return None
+
+    @staticmethod
+    def _report_broken(template_name: str, sub_name: str, reason: str):
+        fc_logger.error(f"Failed to load submodule {sub_name}" +
+                        f" in generating {template_name}: {reason}")
+        print(f"Failed to load submodule {sub_name}" +
+              f" in generating {template_name}: {reason}")
+
+    def __getattr__(self, key: str):
+        # Templates are also methods, e.g. `phandler.insist_json()`.
+        if key.startswith("_") or key in ("registry", "templates",
+                                          "prompt_prefix"):
+            raise AttributeError(key)
+        name = self._resolve_template_name(key)
+        if name is None:
+            raise AttributeError(
+                f"'{type(self).__name__}' has no template '{key}'")
+        return self.templates[name]
 
     def generate(self,
                  _prompt_key: str,
@@ -189,13 +310,14 @@ class BasePromptHandler:
         out : The prompt piece.
         """
         try:
-            return self.templates[_prompt_key](**kwargs)
+            template = self.templates[_prompt_key]
         except KeyError as einfo:
             fc_logger.error(
                 f"Keyerror {_prompt_key}: No such template registered.")
             fc_logger.error(einfo)
             print(f"Keyerror {_prompt_key}: No such template registered.")
             raise
+        return template(_raise_empty, **kwargs)
 
     # def add_prompt_prefix()
     # Maybe not a good idea?
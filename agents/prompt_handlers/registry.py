@@ -0,0 +1,189 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Process-wide registry of prompt collections.
+
+Every collection dir is scanned once, and every template file is read and
+compiled once per template compiler, on first use. The compiled templates
+are shared by all prompt handlers; files are re-read only when their mtime
+changed, checked at most every `config.PROMPT_RELOAD_INTERVAL` seconds.
+"""
+
+import os
+import threading
+import time
+
+import config
+
+CONF_FNAME = "__settings__.conf"
+
+
+def _mtime(path: str) -> int:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return -1
+
+
+class PromptCollection:
+    """A collection dir: its parents and its `.txt` template files."""
+    def __init__(self, path: str):
+        self.path = path
+        self.conf_mtime = None
+        self.dir_mtime = None
+        self.parents = []
+        self.files = {}
+        self.refresh()
+
+    def refresh(self) -> bool:
+        """Rescan the dir and the conf if changed, returns True if so."""
+        changed = False
+        conf_mtime = _mtime(self.path + CONF_FNAME)
+        if conf_mtime != self.conf_mtime:
+            self.conf_mtime = conf_mtime
+            self.parents = self._read_parents()
+            changed = True
+        dir_mtime = _mtime(self.path)
+        if dir_mtime != self.dir_mtime:
+            self.dir_mtime = dir_mtime
+            self.files = {
+                fname[:-4]: self.path + fname
+                for fname in sorted(os.listdir(self.path))
+                if fname[-4:] == ".txt" and "#" not in fname
+            }
+            changed = True
+        return changed
+
+    def _read_parents(self) -> list:
+        parents = []
+        with open(self.path + CONF_FNAME, "r", encoding="utf-8") as filep:
+            for line in filep:
+                if not line.strip() or line.strip()[0] == "#":
+                    continue
+                conf_kv = line.strip().split(":")
+                if conf_kv[0].strip().lower() == "parents":
+                    parents += [
+                        name.strip() for name in conf_kv[1].split(",")
+                        if name.strip()
+                    ]
+                    break
+        return parents
+
+
+class PromptRegistry:
+    """
+    Shares the prompt collections and the compiled templates of a process.
+
+    Parameters
+    ----------
+    root_dir: str, the dir of the collections, for resolving parents.
+    reload_interval: float, seconds between two mtime checks of the same
+        file or dir; None disables hot reloading.
+    """
+    def __init__(self,
+                 root_dir: str,
+                 reload_interval: float = config.PROMPT_RELOAD_INTERVAL):
+        self.root_dir = root_dir
+        self.reload_interval = reload_interval
+        self.collections = {}
+        # (path, compiler) -> [mtime, compiled]
+        self.compiled = {}
+        # prefix -> (chain of dirs, {template name: path})
+        self.tables = {}
+        self._checked = {}
+        self._lock = threading.RLock()
+
+    def _due(self, key) -> bool:
+        """Whether the mtime of `key` should be checked again now."""
+        if self.reload_interval is None:
+            return False
+        now = time.monotonic()
+        if now - self._checked.get(key, 0.0) < self.reload_interval:
+            return False
+        self._checked[key] = now
+        return True
+
+    def collection(self, path: str) -> PromptCollection:
+        with self._lock:
+            if path not in self.collections:
+                self.collections[path] = PromptCollection(path)
+                self._checked[path] = time.monotonic()
+            return self.collections[path]
+
+    def table(self, prefix: str) -> tuple:
+        """
+        Returns the dependency chain of `prefix` (BFS on the parents, the
+        prefix first) and the template name -> file table, where templates
+        of a dir override the ones of the dirs after it in the chain.
+        """
+        with self._lock:
+            if prefix in self.tables:
+                chain, _ = self.tables[prefix]
+                stale = False
+                for path in chain:
+                    if self._due(path) and self.collection(path).refresh():
+                        stale = True
+                if not stale:
+                    return self.tables[prefix]
+                # Parents or files changed: every table may be affected.
+                self.tables = {}
+
+            chain = [prefix]
+            queue = [prefix]
+            while queue:
+                current = queue.pop(0)
+                for name in self.collection(current).parents:
+                    path = self.root_dir + name + ("" if name[-1] == "/" else
+                                                   "/")
+                    if path not in chain:
+                        chain.append(path)
+                        queue.append(path)
+            paths = {}
+            for path in reversed(chain):
+                paths.update(self.collection(path).files)
+            self.tables[prefix] = (chain, paths)
+            return self.tables[prefix]
+
+    def get_compiled(self, path: str, name: str, compiler: callable):
+        """
+        Returns `compiler(raw, name)` of the template file, compiled once
+        and recompiled only when the file changed.
+        """
+        key = (path, compiler)
+        with self._lock:
+            entry = self.compiled.get(key)
+            if entry is not None and not self._due(key):
+                return entry[1]
+            mtime = _mtime(path)
+            if entry is not None and entry[0] == mtime:
+                return entry[1]
+            with open(path, "r", encoding="utf-8") as filep:
+                raw = filep.read()
+            compiled = compiler(raw, name)
+            self.compiled[key] = [mtime, compiled]
+            self._checked[key] = time.monotonic()
+            return compiled
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_prompt_registry(root_dir: str) -> PromptRegistry:
+    """The registry of the prompt collections under `root_dir`."""
+    with _registries_lock:
+        if root_dir not in _registries:
+            _registries[root_dir] = PromptRegistry(root_dir)
+        return _registries[root_dir]
@@ -16,15 +16,330 @@
 Base Prompt Handler @ Civ-LLMs
 """
 
+import ast
+import builtins
 import os
 import re
 from civrealm.freeciv.utils.freeciv_logging import fc_logger
 from .base_prompt_handler import BasePromptHandler
 
-print(os.getcwd())
 PROMPT_ROOT_DIR = "./prompt_collections/"
 BASE_DIR = "base_prompts/"
 
+TOKEN_PATTERN = re.compile(r"<(?P<symbol>[%$&])[ ]+(.*?)[ ]+(?P=symbol)>")
+
+# Builtins usable in `<& if ... &>` expressions.
+SAFE_BUILTINS = {
+    name: getattr(builtins, name)
+    for name in ("abs", "all", "any", "bool", "float", "int", "len", "max",
+                 "min", "sorted", "str", "sum")
+}
+
+# Node kinds of the compiled template tree.
+TEXT, VAR, SEG, IF, FOR = range(5)
+# Kinds of the for loop items and segment parameters, besides SEG nodes.
+ITEM_CONST, ITEM_VAR, ITEM_RANGE = range(5, 8)
+
+
+class TemplateSyntaxError(Exception):
+    """A template error, with the template name and position."""
+    def __init__(self, template_name: str, raw: str, pos: int, message: str):
+        line = raw.count("\n", 0, pos) + 1
+        column = pos - (raw.rfind("\n", 0, pos) + 1) + 1
+        super().__init__(f"{template_name}:{line}:{column}: {message}")
+        self.template_name = template_name
+        self.line = line
+        self.column = column
+
+
+def _var_name(text: str) -> str:
+    """`%a` or `a` -> `a`."""
+    return text[1:] if text.startswith("%") else text
+
+
+def _split_top_level(text: str) -> list:
+    """Split by commas which are not in quotes, parentheses or brackets."""
+    items, depth, quote, start = [], 0, None, 0
+    for index, char in enumerate(text):
+        if quote:
+            if char == quote and text[index - 1] != "\\":
+                quote = None
+        elif char in "\"'":
+            quote = char
+        elif char in "([{":
+            depth += 1
+        elif char in ")]}":
+            depth -= 1
+        elif char == "," and depth == 0:
+            items.append(text[start:index].strip())
+            start = index + 1
+    items.append(text[start:].strip())
+    return [item for item in items if item]
+
+
+class SIGTemplate:
+    """
+    A SIG template compiled once into a tree of nodes:
+
+    (TEXT, str), (VAR, name), (SEG, name, params),
+    (IF, [(code, expr, nodes), ...], else_nodes),
+    (FOR, loop_var, items, iterate_var, nodes)
+
+    where params map parameter names to (ITEM_CONST, value) or
+    (ITEM_VAR, name), and items is a list of (ITEM_CONST, value),
+    (ITEM_VAR, name), (ITEM_RANGE, None) and SEG nodes.
+    """
+    def __init__(self, raw: str, name: str):
+        self.raw = raw
+        self.name = name
+        self.references = set()
+        self.tokens = self._tokenize(raw)
+        self._index = 0
+        self.nodes = self._parse_block(())
+
+    def error(self, pos: int, message: str):
+        return TemplateSyntaxError(self.name, self.raw, pos, message)
+
+    @staticmethod
+    def _tokenize(raw: str) -> list:
+        tokens = []
+        text_start = 0
+        for match in TOKEN_PATTERN.finditer(raw):
+            if match.start() > text_start:
+                tokens.append(("text", raw[text_start:match.start()],
+                               text_start))
+            tokens.append((match.group("symbol"), match.group(2).strip(),
+                           match.start()))
+            text_start = match.end()
+        if text_start < len(raw):
+            tokens.append(("text", raw[text_start:], text_start))
+        return tokens
+
+    def _parse_block(self, terminators: tuple, opener_pos: int = 0) -> list:
+        """Parse nodes until a control token starting with a terminator."""
+        nodes = []
+        while self._index < len(self.tokens):
+            kind, value, pos = self.tokens[self._index]
+            if kind == "&" and value.split(" ")[0] in terminators:
+                return nodes
+            self._index += 1
+            if kind == "text":
+                nodes.append((TEXT, value))
+            elif kind == "%":
+                nodes.append((VAR, _var_name(value)))
+            elif kind == "$":
+                nodes.append(self._parse_segment(value, pos))
+            else:
+                nodes.append(self._parse_control(value, pos))
+        if terminators:
+            raise self.error(
+                opener_pos, "Unclosed block, expected " +
+                " or ".join(f"`<& {term} &>`" for term in terminators))
+        return nodes
+
+    def _parse_control(self, value: str, pos: int) -> tuple:
+        keyword = value.split(" ")[0]
+        if keyword == "if":
+            return self._parse_if(value, pos)
+        if keyword == "for":
+            return self._parse_for(value, pos)
+        raise self.error(pos, f"Unexpected `<& {value} &>`")
+
+    def _compile_expr(self, expr: str, pos: int):
+        expr = re.sub(r"%(\w+)", r"\1", expr.strip())
+        try:
+            return compile(expr, f"<{self.name}>", "eval")
+        except SyntaxError as einfo:
+            raise self.error(pos,
+                             f"Invalid expression `{expr}`: {einfo.msg}")
+
+    def _parse_if(self, value: str, pos: int) -> tuple:
+        opener_pos = pos
+        branches = [(self._compile_expr(value[3:], pos), value[3:].strip(),
+                     self._parse_block(("elif", "else", "endif"), pos))]
+        else_nodes = []
+        while True:
+            _, value, pos = self.tokens[self._index]
+            self._index += 1
+            keyword = value.split(" ")[0]
+            if keyword == "elif":
+                branches.append(
+                    (self._compile_expr(value[5:], pos), value[5:].strip(),
+                     self._parse_block(("elif", "else", "endif"),
+                                       opener_pos)))
+            elif keyword == "else":
+                else_nodes = self._parse_block(("endif", ), opener_pos)
+            else:
+                return (IF, branches, else_nodes)
+
+    def _parse_for(self, value: str, pos: int) -> tuple:
+        match = re.fullmatch(r"for[ ]+\$(\w+)[ ]+in[ ]+(.+)", value)
+        if match is None:
+            raise self.error(pos, f"Invalid loop `<& {value} &>`, " +
+                             "expected `<& for $x in ... &>`")
+        spec = match.group(2).strip()
+        if spec.startswith("%"):
+            items = [(ITEM_VAR, _var_name(spec))]
+            iterate_var = True
+        elif spec.startswith("[") and spec.endswith("]"):
+            items = self._parse_items(spec[1:-1], pos)
+            iterate_var = False
+        else:
+            raise self.error(pos, f"Invalid loop list `{spec}`")
+        body = self._parse_block(("endfor", ), pos)
+        self._index += 1
+        return (FOR, match.group(1), items, iterate_var, body)
+
+    def _parse_items(self, text: str, pos: int) -> list:
+        items = []
+        for item in _split_top_level(text):
+            if item == "..":
+                items.append((ITEM_RANGE, None))
+            elif item.startswith("%"):
+                items.append((ITEM_VAR, _var_name(item)))
+            elif item.startswith("$"):
+                items.append(self._parse_segment(item[1:], pos))
+            else:
+                try:
+                    items.append((ITEM_CONST, ast.literal_eval(item)))
+                except (SyntaxError, ValueError):
+                    raise self.error(pos, f"Invalid loop item `{item}`")
+        for index, item in enumerate(items):
+            if item[0] == ITEM_RANGE and (index == 0
+                                         or index == len(items) - 1):
+                raise self.error(pos, "`..` must be between two numbers")
+        return items
+
+    def _parse_segment(self, value: str, pos: int) -> tuple:
+        """`seg` or `seg(key=literal, key=%var, ...)`."""
+        if "(" not in value:
+            name, params = value.strip(), {}
+        else:
+            try:
+                call = ast.parse(re.sub(r"%(\w+)", r"__var_\1", value.strip()),
+                                 mode="eval").body
+                if not isinstance(call, ast.Call) or not isinstance(
+                        call.func, ast.Name) or call.args:
+                    raise ValueError("expected `name(key=value, ...)`")
+                name, params = call.func.id, {}
+                for keyword in call.keywords:
+                    if isinstance(keyword.value, ast.Name
+                                  ) and keyword.value.id.startswith("__var_"):
+                        params[keyword.arg] = (ITEM_VAR,
+                                               keyword.value.id[6:])
+                    else:
+                        params[keyword.arg] = (ITEM_CONST,
+                                               ast.literal_eval(keyword.value))
+            except (SyntaxError, ValueError) as einfo:
+                raise self.error(pos, f"Invalid segment `{value}`: {einfo}")
+        self.references.add(name)
+        return (SEG, name, params)
+
+    def render(self, handler, links: tuple, _raise_empty: bool,
+               kwargs: dict) -> str:
+        """`links` is given by `BasePromptHandler._link`."""
+        out = []
+        # The binding (handler, links) is threaded down to the segments.
+        self._render(self.nodes, (handler, links), _raise_empty, kwargs, out)
+        return "".join(out)
+
+    def _fail(self, _raise_empty: bool, message: str, einfo: Exception):
+        fc_logger.error(f"{message} in generating {self.name}.")
+        fc_logger.error(einfo)
+        print(f"{message} in generating {self.name}.")
+        if _raise_empty:
+            raise einfo
+
+    def _render(self, nodes, binding, _raise_empty, ctx, out):
+        for node in nodes:
+            kind = node[0]
+            if kind == TEXT:
+                out.append(node[1])
+            elif kind == VAR:
+                try:
+                    out.append(str(ctx[node[1]]))
+                except KeyError as einfo:
+                    self._fail(_raise_empty,
+                               f"Failed to provide key {node[1]}", einfo)
+            elif kind == SEG:
+                out.append(
+                    self._render_segment(node, binding, _raise_empty, ctx))
+            elif kind == IF:
+                for code, expr, body in node[1]:
+                    try:
+                        taken = eval(code, {"__builtins__": SAFE_BUILTINS},
+                                     ctx)
+                    except Exception as einfo:
+                        self._fail(_raise_empty,
+                                   f"Failed to evaluate `{expr}`", einfo)
+                        taken = False
+                    if taken:
+                        self._render(body, binding, _raise_empty, ctx, out)
+                        break
+                else:
+                    self._render(node[2], binding, _raise_empty, ctx, out)
+            else:
+                _, loop_var, items, iterate_var, body = node
+                try:
+                    values = self._loop_values(items, iterate_var, binding,
+                                               _raise_empty, ctx)
+                except (KeyError, TypeError) as einfo:
+                    self._fail(_raise_empty, "Failed to iterate", einfo)
+                    continue
+                inner = dict(ctx)
+                for value in values:
+                    inner[loop_var] = value
+                    self._render(body, binding, _raise_empty, inner, out)
+
+    def _loop_values(self, items, iterate_var, binding, _raise_empty, ctx):
+        if iterate_var:
+            return ctx[items[0][1]]
+        values = []
+        pending_range = False
+        for item in items:
+            kind = item[0]
+            if kind == ITEM_RANGE:
+                pending_range = True
+                continue
+            if kind == ITEM_CONST:
+                value = item[1]
+            elif kind == ITEM_VAR:
+                value = ctx[item[1]]
+            else:
+                value = self._render_segment(item, binding, _raise_empty, ctx)
+            if pending_range:
+                # `[a,..,b]` is inclusive, and empty if b < a.
+                pending_range = False
+                start, end = int(values[-1]), int(value)
+                if end < start:
+                    values.pop()
+                else:
+                    values += list(range(start + 1, end + 1))
+                continue
+            values.append(value)
+        return values
+
+    def _render_segment(self, node, binding, _raise_empty, ctx) -> str:
+        """Segments see the caller's variables, updated by the parameters."""
+        _, name, params = node
+        handler, (targets, broken) = binding
+        target = targets.get(name)
+        if target is None or name in broken:
+            if _raise_empty:
+                raise Exception(f"Failed to load submodule {name}" +
+                                f" in generating {self.name}.")
+            return ""
+        kwargs = dict(ctx)
+        for key, (kind, value) in params.items():
+            if kind == ITEM_CONST:
+                kwargs[key] = value
+            elif value in ctx:
+                kwargs[key] = ctx[value]
+            else:
+                self._fail(_raise_empty, f"Failed to provide key {value}",
+                           KeyError(value))
+        return handler.templates[target](_raise_empty, **kwargs)
+
 
 class SIGPromptHandler(BasePromptHandler):
     """
@@ -32,7 +347,11 @@ class SIGPromptHandler(BasePromptHandler):
 
     `<% variable_name %>` for certain variable names
     `<$ prompt_segment_name $>` for prompt segments defined in the same dir.
+        or `<$ seg(key="literal", key2=%var) $>` to give parameters. The
+        segment sees the variables of the caller, updated by the parameters.
     `<& if expr() &>` for python-style if and `<& endif &>` strictly required
+        `<& elif expr() &>` and `<& else &>` may be used in between, and
+        variables are used in expressions by name or as `%name`.
     `<& for $x in %A &>` if `A` exists, then iterate over A,
         or use [1,..,n] for numbers,
         or ["a",1,22,"bc"] for combination of numbers and strings
@@ -40,142 +359,13 @@ class SIGPromptHandler(BasePromptHandler):
         or [$seg1(param), $seg2(param)] for other segments!
         ALL the above 4 formats could be used together
         for loop should end with `<& endfor &>`
+        and `<% x %>` is the loop variable in the body.
     """
-    def _txt_parser(self, raw: str, template_name: str) -> callable:
+    @staticmethod
+    def _compile_template(raw: str, template_name: str):
         """
-        Returns prompt generator.
-
-        For efficiency, try not to parse the raw for every prompt generation.
+        Compile a template once into a tree of nodes, raising
+        `TemplateSyntaxError` with the position of any syntax error, so
+        that generating a prompt never re-parses the template.
         """
-
-        full_list = []
-        full_list = re.split(R"(<(?P<symbol>[%$&]))[ ]+(.*?)[ ]+(?P=symbol)>",
-                             raw)
-
-        def generator(_raise_empty: bool = False, **kwargs) -> str:
-            nonlocal self, raw, template_name
-
-            cur_index = 0
-            out_list = []
-
-            # Decorator for do-something
-            def do_template(operation):
-                nonlocal cur_index, out_list
-
-                def inner(_raise_empty, key, kwargs):
-                    nonlocal out_list, flist
-                    try:
-                        operation(_raise_empty, key, kwargs)
-                        # I decide not to use `kwargs.get(key, "")` in order to
-                        # log the incidents when key is not provided in args.
-                    except KeyError as einfo:
-                        fc_logger.error(f"Failed to process {key}" +
-                                        f" in generating {template_name}.")
-                        fc_logger.error(einfo)
-                        print(f"Failed to process {key}" +
-                              f" in generating {template_name}.")
-                        if _raise_empty:
-                            raise
-
-                    return inner
-
-            # Decorator to detect is-something
-            def is_template(cap):
-                def inner(flist):
-                    if len(flist) <= 2:
-                        return False
-
-                    return cap(flist)
-
-                return inner
-
-            @is_template
-            def is_var(flist):
-                return flist[0] == "<%" and flist[1] == "%"
-
-            @do_template
-            def do_var(_raise_empty, key, kwargs):
-                nonlocal out_list, cur_index
-                out_list += [str(kwargs[key])]
-                cur_index += 3
-
-            @is_template
-            def is_prompt(flist):
-                return flist[0] == "<$" and flist[1] == "$"
-
-            @is_template
-            def is_if(flist):
-                if flist[0] != "<&" or flist[1] != "&":
-                    return False
-                if flist[2] == "if" or flist[2][:3] == "if ":
-                    return True
-                return False
-
-            @is_template
-            def is_endif(flist):
-                if flist[0] != "<&" or flist[1] != "&":
-                    return False
-                if flist[2] == "endif":
-                    return True
-                return False
-
-            @is_template
-            def is_elif(flist):
-                if flist[0] != "<&" or flist[1] != "&":
-                    return False
-                if flist[4] == "elif" or flist[2][:5] == "elif ":
-                    return True
-                return False
-
-            @is_template
-            def is_else(flist):
-                if flist[0] != "<&" or flist[1] != "&":
-                    return False
-                if flist[2] == "if" or flist[2][:3] == "if ":
-                    return True
-                return False
-
-            @do_template
-            def do_if(_raise_empty, key, kwargs, else_stat=2):
-                """else_stat: 1 for else, 3 for if and 5 for else."""
-                nonlocal out_list, cur_index
-                try:
-                    if else_stat == 1:
-                        pass
-                except:
-                    pass
-
-            @is_template
-            def is_for(flist):
-                return flist[0] == "<&" and flist[1] == "&" and flist[
-                    2][:4] == "for "
-
-            stack = []
-            while cur_index < len(full_list):
-                if is_if(full_list[cur_index:]):
-                    if do_if(_raise_empty, full_list[cur_index + 2], kwargs):
-                        stack += [(1, cur_index)]
-                    else:
-                        stack += [(0, cur_index)]
-                if is_endif(full_list[cur_index:]):
-                    stack.pop(-1)
-                cur_index += 1
-
-            # def dfs(**kwargs):
-            #     nonlocal out_list, flist
-
-            #     while not is_for(flist):
-
-            #         if is_var(flist):
-            #             do_var(_raise_empty, flist[2], kwargs)
-            #             continue
-            #         if is_if(flist):
-            #             do_if(_raise_empty, flist[2:], kwargs)
-            #         if is_prompt(flist):
-            #             pass
-            #     # return out_list
-
-            # dfs(**kwargs)
-            return "".join(out_list)
-
-        return generator
+        return SIGTemplate(raw, template_name)
@@ -19,6 +19,8 @@ import os
 from civrealm.agents.base_agent import BaseAgent
 from civrealm.configs import fc_args
 
+from .scheduler import ActorScheduler
+
 
 class RandomLLMAgent(BaseAgent):
     def __init__(self):
@@ -29,18 +31,17 @@ class RandomLLMAgent(BaseAgent):
         else:
             if "debug.agentseed" in fc_args:
                 self.set_agent_seed(fc_args["debug.agentseed"])
+        self.scheduler = ActorScheduler()
 
     def act(self, observation, info):
         if info['turn'] != self.turn:
-            self.planned_actor_ids = []
             self.turn = info['turn']
+            self.scheduler.new_turn(self.turn, info['llm_info'])
 
-        for ctrl_type, actors_dict in info['llm_info'].items():
-            for actor_id in actors_dict.keys():
-                if actor_id in self.planned_actor_ids:
-                    continue
-                available_actions = actors_dict[actor_id]['available_actions']
-                if available_actions:
-                    action_name = random.choice(available_actions)
-                    self.planned_actor_ids.append(actor_id)
-                    return (ctrl_type, actor_id, action_name)
+        key = self.scheduler.next_actor(info['llm_info'])
+        if key is None:
+            return None
+        ctrl_type, actor_id = key
+        available_actions = info['llm_info'][ctrl_type][actor_id][
+            'available_actions']
+        return (ctrl_type, actor_id, random.choice(available_actions))
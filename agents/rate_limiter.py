@@ -0,0 +1,341 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Client-side rate limiting and retry scheduling for LLM requests.
+
+A single `RateLimiter` is shared by every agent of the process (see
+`get_rate_limiter`), so that all of them together stay under the API quota.
+"""
+
+import random
+import threading
+import time
+from datetime import datetime, timezone
+
+from civrealm.freeciv.utils.freeciv_logging import fc_logger
+
+import config
+from .metrics import get_metrics
+
+
+class LLMUnavailableError(Exception):
+    """Raised when a request is given up, the caller should fall back."""
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at `rate_per_minute`.
+
+    `reserve` never refuses: it takes the tokens (possibly into debt) and
+    returns how long the caller has to wait before using them, so that
+    concurrent callers are served first come, first served.
+    """
+    def __init__(self, rate_per_minute: float, capacity: float = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float, now: float) -> float:
+        self._refill(now)
+        # A single request larger than the bucket must not wait forever.
+        amount = min(amount, self.capacity)
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures, and lets a single
+    trial request through once `reset_timeout` seconds have passed.
+    """
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+
+    def allow(self, now: float) -> bool:
+        if self.opened_at is None:
+            return True
+        if now - self.opened_at < self.reset_timeout or self._trial_running:
+            return False
+        self._trial_running = True
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+
+    def release_trial(self):
+        """The trial request got an answer which tells nothing of health."""
+        self._trial_running = False
+
+    def record_failure(self, now: float):
+        self.failures += 1
+        self._trial_running = False
+        if self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                fc_logger.warning("LLM circuit breaker opened after " +
+                                  f"{self.failures} failures.")
+            self.opened_at = now
+
+
+def retry_after_seconds(error: Exception):
+    """Read the `Retry-After` header of a failed HTTP request, if any."""
+    response = getattr(error, "raw_response", None) or getattr(
+        error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("Retry-After") or headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    # HTTP dates are rare: parse them without importing `email` up front.
+    from email.utils import parsedate_to_datetime
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0,
+               (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def is_retryable(error: Exception) -> bool:
+    """Rate limits, server errors, timeouts and connection errors."""
+    status_code = getattr(error, "status_code", None)
+    if status_code is not None:
+        return status_code == 429 or status_code >= 500
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    name = type(error).__name__
+    return "Timeout" in name or "Connect" in name
+
+
+class RateLimiter:
+    """
+    Rate limiter and retry scheduler for LLM requests.
+
+    Requests are paced by two token buckets, one on requests per minute and
+    one on LLM tokens per minute. Failed requests are retried with
+    exponential backoff and full jitter, honoring `Retry-After`. Retries are
+    paid from a shared retry budget which successful requests refill, and a
+    circuit breaker stops sending requests when the API keeps failing.
+
+    On HTTP 429 the request rate is halved for everyone, and it recovers
+    additively with successes (AIMD), so parallel agents do not hammer the
+    endpoint in lockstep.
+    """
+    def __init__(self,
+                 requests_per_minute: float = config.LLM_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: float = config.LLM_TOKENS_PER_MINUTE,
+                 max_retries: int = config.LLM_MAX_RETRIES,
+                 backoff_base: float = config.LLM_BACKOFF_BASE,
+                 backoff_cap: float = config.LLM_BACKOFF_CAP,
+                 retry_budget: float = config.LLM_RETRY_BUDGET,
+                 failure_threshold: int = config.LLM_CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout: float = config.LLM_CIRCUIT_RESET_TIMEOUT):
+        self.max_requests_per_minute = requests_per_minute
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.max_retry_budget = retry_budget
+        self.retry_budget = retry_budget
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.blocked_until = 0.0
+        self.requests = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: int = 0) -> float:
+        """
+        Reserve a request of `tokens` LLM tokens, returns the seconds to
+        wait before sending it.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.requests += 1
+            return max(self.request_bucket.reserve(1, now),
+                       self.token_bucket.reserve(tokens, now),
+                       self.blocked_until - now)
+
+    def acquire(self, tokens: int = 0):
+        """Block until a request of `tokens` LLM tokens may be sent."""
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(
+            0, min(self.backoff_cap, self.backoff_base * 2**attempt))
+
+    def admit(self) -> bool:
+        """Whether the circuit breaker lets a new request through."""
+        with self._lock:
+            return self.breaker.allow(time.monotonic())
+
+    def call(self, request: callable, tokens: int = 0):
+        """
+        Send `request()` under the rate limit, retrying transient errors.
+
+        Parameters
+        ----------
+        request: callable, sends the request and returns the response.
+        tokens: int, estimated LLM tokens used by the request.
+
+        Raises
+        ------
+        LLMUnavailableError: if the circuit is open, or the retries or the
+            retry budget are exhausted.
+        """
+        return call_limited(self, request, tokens)
+
+    def on_failure(self):
+        """
+        A request failed with an error which is not retried (e.g. 400, 401):
+        the API answered, the circuit breaker does not count it.
+        """
+        with self._lock:
+            self.breaker.release_trial()
+
+    def on_retryable_error(self, status_code, retry_after, attempt: int):
+        """
+        Returns the delay before retrying, or None to give up. A
+        `Retry-After` is honoured up to `backoff_cap` seconds.
+        """
+        now = time.monotonic()
+        delay = min(retry_after, self.backoff_cap) \
+            if retry_after is not None else self.backoff(attempt)
+        with self._lock:
+            if status_code == 429:
+                # Slow every caller down, not only this one.
+                self.request_bucket.rate = max(self.request_bucket.rate / 2,
+                                               1 / 60.0)
+                self.blocked_until = max(self.blocked_until, now + delay)
+            if attempt >= self.max_retries or self.retry_budget < 1:
+                self.breaker.record_failure(now)
+                return None
+            self.retry_budget -= 1
+            self.retries += 1
+        return delay
+
+    def on_success(self):
+        with self._lock:
+            self.breaker.record_success()
+            self.retry_budget = min(self.max_retry_budget,
+                                    self.retry_budget + 0.1)
+            self.request_bucket.rate = min(
+                self.max_requests_per_minute / 60.0,
+                self.request_bucket.rate + 1 / 60.0)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"requests": self.requests, "retries": self.retries}
+
+
+def call_limited(limiter, request: callable, tokens: int = 0):
+    """
+    The retry loop of `RateLimiter.call`. It only uses the picklable
+    primitives of the limiter, so that `limiter` may also be a proxy of a
+    limiter living in another process.
+    """
+    if not limiter.admit():
+        raise LLMUnavailableError("LLM circuit breaker is open.")
+
+    metrics = get_metrics()
+    attempt = 0
+    while True:
+        wait = limiter.reserve(tokens)
+        metrics.observe("llm.queue_wait", max(wait, 0.0))
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            with metrics.span("llm.network"):
+                response = request()
+        except Exception as einfo:
+            if not is_retryable(einfo):
+                limiter.on_failure()
+                raise
+            delay = limiter.on_retryable_error(
+                getattr(einfo, "status_code", None),
+                retry_after_seconds(einfo), attempt)
+            if delay is None:
+                raise LLMUnavailableError(
+                    f"LLM request failed after {attempt + 1} attempts: " +
+                    repr(einfo)) from einfo
+            fc_logger.debug(f"LLM request failed ({einfo!r}), " +
+                            f"retry {attempt + 1} in {delay:.2f}s.")
+            metrics.count("llm.retries")
+            metrics.observe("llm.retry_wait", delay)
+            time.sleep(delay)
+            attempt += 1
+            continue
+        limiter.on_success()
+        return response
+
+
+class SharedRateLimiter:
+    """
+    Client of a `RateLimiter` served by another process, through a proxy
+    exposing its primitives (see `agents.llm_service`).
+    """
+    def __init__(self, proxy):
+        self.proxy = proxy
+
+    def call(self, request: callable, tokens: int = 0):
+        return call_limited(self.proxy, request, tokens)
+
+    def stats(self) -> dict:
+        return self.proxy.stats()
+
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    """The rate limiter shared by all agents of the process."""
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter()
+        return _rate_limiter
+
+
+def set_rate_limiter(limiter):
+    """Replace the process-wide rate limiter, e.g. by a `SharedRateLimiter`."""
+    global _rate_limiter
+    with _rate_limiter_lock:
+        _rate_limiter = limiter
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap estimate of the number of LLM tokens of `text`."""
+    return len(text) // 4 + 1
@@ -0,0 +1,123 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Per-turn work queue of the actors to move.
+
+The queue is built once per turn, in the order of `config.ACTOR_PRIORITIES`,
+so that each `act` pops the next actor in constant time instead of
+rescanning `info['llm_info']`.
+"""
+
+from collections import deque
+
+import config
+from .metrics import actor_type
+
+
+class ActorScheduler:
+    """
+    Parameters
+    ----------
+    priorities: dict, priority of the actors by actor type (e.g. "Settlers")
+        or ctrl_type (e.g. "city"), lower first; the actor type wins. Actors
+        matching neither get `default_priority`. Actors of equal priority
+        keep their order of `info['llm_info']`.
+    """
+    def __init__(self,
+                 priorities: dict = config.ACTOR_PRIORITIES,
+                 default_priority: int = config.ACTOR_DEFAULT_PRIORITY):
+        self.priorities = priorities
+        self.default_priority = default_priority
+        self.turn = None
+        # priority -> deque of (ctrl_type, actor_id)
+        self.buckets = {}
+        self.levels = []
+        self.queued = set()
+        self.planned = set()
+
+    def priority(self, ctrl_type: str, actor: dict) -> int:
+        kind = actor_type(actor.get('name', ""))
+        if kind in self.priorities:
+            return self.priorities[kind]
+        return self.priorities.get(ctrl_type, self.default_priority)
+
+    def new_turn(self, turn, llm_info: dict):
+        """Queue the actors having available actions."""
+        self.turn = turn
+        self.buckets = {}
+        self.levels = []
+        self.queued = set()
+        self.planned = set()
+        self._add_new(llm_info)
+
+    def _add_new(self, llm_info: dict) -> bool:
+        """Queue the actors which are not queued yet, returns True if any."""
+        added = False
+        for ctrl_type, actors_dict in llm_info.items():
+            for actor_id, actor in actors_dict.items():
+                key = (ctrl_type, actor_id)
+                if key in self.queued or not actor['available_actions']:
+                    continue
+                self.queued.add(key)
+                level = self.priority(ctrl_type, actor)
+                if level not in self.buckets:
+                    self.buckets[level] = deque()
+                    self.levels = sorted(self.buckets)
+                self.buckets[level].append(key)
+                added = True
+        return added
+
+    def pending(self) -> list:
+        """The queued actors which are not planned yet, in queue order."""
+        return [
+            key for level in self.levels for key in self.buckets[level]
+            if key not in self.planned
+        ]
+
+    def peek(self, count: int) -> list:
+        """The next `count` actors `next_actor` would pop, if unchanged."""
+        out = []
+        for level in self.levels:
+            for key in self.buckets[level]:
+                if len(out) >= count:
+                    return out
+                if key not in self.planned:
+                    out.append(key)
+        return out
+
+    def next_actor(self, llm_info: dict):
+        """
+        Pop the next actor to move, as (ctrl_type, actor_id), and mark it as
+        planned. Actors which left `llm_info` or lost their actions are
+        skipped. When the queue is empty, `llm_info` is scanned once for
+        actors which appeared during the turn. Returns None at the end of
+        the turn.
+        """
+        while True:
+            for level in self.levels:
+                bucket = self.buckets[level]
+                while bucket:
+                    key = bucket.popleft()
+                    if key in self.planned:
+                        continue
+                    actor = llm_info.get(key[0], {}).get(key[1])
+                    if actor is None or not actor['available_actions']:
+                        # Queue it again if it gets actions back.
+                        self.queued.discard(key)
+                        continue
+                    self.planned.add(key)
+                    return key
+            if not self._add_new(llm_info):
+                return None
@@ -0,0 +1,295 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Indexed trajectory recording of whole games.
+
+`TrajectoryRecorder` appends, for every step, the observations and each
+actor of `info['llm_info']` as separately compressed pickles to rotating
+segment files, and one JSON line per step to an append-only `.idx.jsonl`
+index holding the turn, the chosen action and the (offset, length) of every
+blob. `TrajectoryReader` memory-maps the segments and decodes single actors
+or observations on demand, so that long games can be scanned or sampled
+without loading them.
+
+Usage:
+    python -m agents.trajectory saved_trajectories --turn 12 --actor 103
+"""
+
+import argparse
+import atexit
+import json
+import mmap
+import os
+import pickle
+import queue
+import threading
+import time
+import zlib
+
+from civrealm.freeciv.utils.freeciv_logging import fc_logger
+
+import config
+
+SEGMENT_SUFFIX = ".bin"
+INDEX_SUFFIX = ".idx.jsonl"
+
+
+class TrajectoryRecorder:
+    """
+    Records the steps of a game into `directory`.
+
+    The step is pickled by the caller, so that later changes of the objects
+    do not leak into the record; compression and writing happen in a
+    background thread. A new segment is started when the current one exceeds
+    `segment_bytes`.
+    """
+    def __init__(self,
+                 directory: str = config.TRAJECTORY_DIRECTORY,
+                 segment_bytes: int = config.TRAJECTORY_SEGMENT_BYTES,
+                 compress_level: int = config.TRAJECTORY_COMPRESS_LEVEL,
+                 queue_size: int = 64):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.compress_level = compress_level
+        self.run_id = time.strftime("%Y%m%d_%H%M%S") + f"_{os.getpid()}"
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._segment_index = 0
+        self._segment_file = None
+        self._index_file = None
+        self._segment_name = None
+        self._closed = False
+
+        os.makedirs(directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run,
+                                        name="trajectory",
+                                        daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record(self, step: int, turn: int, observations, llm_info: dict,
+               action):
+        """Queue a step: the observations it was decided on and its action."""
+        actors = [(ctrl_type, actor_id,
+                   pickle.dumps(actor, protocol=pickle.HIGHEST_PROTOCOL))
+                  for ctrl_type, actors_dict in llm_info.items()
+                  for actor_id, actor in actors_dict.items()]
+        self._queue.put({
+            "step": step,
+            "turn": turn,
+            "action": None if action is None else list(action),
+            "observations": pickle.dumps(observations,
+                                         protocol=pickle.HIGHEST_PROTOCOL),
+            "actors": actors,
+        })
+
+    def close(self):
+        """Write the queued steps and close the current segment."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            try:
+                self._write_step(item)
+            except Exception as einfo:
+                fc_logger.error(f"Failed to record trajectory: {einfo!r}")
+        self._close_segment()
+
+    def _append(self, payload: bytes) -> list:
+        blob = zlib.compress(payload, self.compress_level)
+        offset = self._segment_file.tell()
+        self._segment_file.write(blob)
+        return [offset, len(blob)]
+
+    def _write_step(self, item: dict):
+        if self._segment_file is None:
+            self._open_segment()
+        entry = {
+            "step": item["step"],
+            "turn": item["turn"],
+            "action": item["action"],
+            "segment": self._segment_name,
+            "observations": self._append(item["observations"]),
+            "actors": [[ctrl_type, actor_id] + self._append(payload)
+                       for ctrl_type, actor_id, payload in item["actors"]],
+        }
+        # The blobs reach the file before the index line pointing at them.
+        self._segment_file.flush()
+        self._index_file.write(json.dumps(entry) + "\n")
+        self._index_file.flush()
+        if self._segment_file.tell() >= self.segment_bytes:
+            self._close_segment()
+
+    def _open_segment(self):
+        self._segment_name = f"trajectory_{self.run_id}_" + \
+            f"{self._segment_index:05d}"
+        path = os.path.join(self.directory, self._segment_name)
+        self._segment_file = open(path + SEGMENT_SUFFIX, "ab")
+        self._index_file = open(path + INDEX_SUFFIX, "a", encoding="utf-8")
+        self._segment_index += 1
+
+    def _close_segment(self):
+        if self._segment_file is None:
+            return
+        self._segment_file.close()
+        self._index_file.close()
+        self._segment_file = None
+        self._index_file = None
+
+
+class TrajectoryReader:
+    """
+    Reads the recorded steps of a directory, optionally of one run only.
+
+    Only the index is loaded; the segments are memory-mapped and the blobs
+    decoded when asked for.
+    """
+    def __init__(self, directory: str, run_id: str = None):
+        self.directory = directory
+        self.entries = []
+        self._maps = {}
+        prefix = "trajectory_" + (run_id + "_" if run_id else "")
+        for fname in sorted(os.listdir(directory)):
+            if not fname.startswith(prefix) or \
+                    not fname.endswith(INDEX_SUFFIX):
+                continue
+            path = os.path.join(directory, fname[:-len(INDEX_SUFFIX)])
+            # A segment just opened is empty, and mmap refuses empty files.
+            if not os.path.exists(path + SEGMENT_SUFFIX) or \
+                    os.path.getsize(path + SEGMENT_SUFFIX) == 0:
+                continue
+            self.entries += self._load_index(path + INDEX_SUFFIX)
+        # turn -> positions of its steps
+        self.turn_steps = {}
+        for position, entry in enumerate(self.entries):
+            self.turn_steps.setdefault(entry["turn"], []).append(position)
+
+    @staticmethod
+    def _load_index(path: str) -> list:
+        entries = []
+        with open(path, "r", encoding="utf-8") as filep:
+            for line in filep:
+                if not line.endswith("\n"):
+                    # The last line is being written.
+                    break
+                entries.append(json.loads(line))
+        return entries
+
+    def _map(self, segment: str) -> mmap.mmap:
+        if segment not in self._maps:
+            with open(os.path.join(self.directory, segment + SEGMENT_SUFFIX),
+                      "rb") as filep:
+                self._maps[segment] = mmap.mmap(filep.fileno(),
+                                                0,
+                                                access=mmap.ACCESS_READ)
+        return self._maps[segment]
+
+    def _decode(self, segment: str, offset: int, length: int):
+        data = self._map(segment)
+        if offset + length > len(data):
+            # Recorded after the segment was mapped.
+            data.close()
+            del self._maps[segment]
+            data = self._map(segment)
+        return pickle.loads(zlib.decompress(data[offset:offset + length]))
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def turns(self) -> list:
+        return sorted(self.turn_steps)
+
+    def steps(self, turn: int = None) -> list:
+        """Positions of the recorded steps, of `turn` only if given."""
+        if turn is None:
+            return list(range(len(self.entries)))
+        return self.turn_steps.get(turn, [])
+
+    def action(self, position: int):
+        action = self.entries[position]["action"]
+        return None if action is None else tuple(action)
+
+    def observations(self, position: int):
+        entry = self.entries[position]
+        return self._decode(entry["segment"], *entry["observations"])
+
+    def actor(self, position: int, ctrl_type: str, actor_id):
+        """The actor of `info['llm_info']` at a step, or None."""
+        entry = self.entries[position]
+        for seg_ctrl, seg_id, offset, length in entry["actors"]:
+            if seg_ctrl == ctrl_type and seg_id == actor_id:
+                return self._decode(entry["segment"], offset, length)
+        return None
+
+    def llm_info(self, position: int) -> dict:
+        entry = self.entries[position]
+        out = {}
+        for ctrl_type, actor_id, offset, length in entry["actors"]:
+            out.setdefault(ctrl_type, {})[actor_id] = self._decode(
+                entry["segment"], offset, length)
+        return out
+
+    def find_actor(self, actor_id, turn: int = None):
+        """Yields (position, ctrl_type, actor) of an actor over the steps."""
+        for position in self.steps(turn):
+            entry = self.entries[position]
+            for ctrl_type, seg_id, offset, length in entry["actors"]:
+                if str(seg_id) == str(actor_id):
+                    yield position, ctrl_type, self._decode(
+                        entry["segment"], offset, length)
+
+    def close(self):
+        for data in self._maps.values():
+            data.close()
+        self._maps = {}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Inspect recorded trajectories.")
+    parser.add_argument("directory", nargs="?",
+                        default=config.TRAJECTORY_DIRECTORY)
+    parser.add_argument("--run", default=None, help="run id of the game")
+    parser.add_argument("--turn", type=int, default=None)
+    parser.add_argument("--actor", default=None, help="actor id")
+    args = parser.parse_args()
+
+    reader = TrajectoryReader(args.directory, args.run)
+    if args.actor is None:
+        turns = reader.turns()
+        print(f"{len(reader)} steps, {len(turns)} turns" +
+              (f" ({turns[0]}-{turns[-1]})" if turns else ""))
+        for position in reader.steps(args.turn):
+            if args.turn is not None:
+                print(f"step {reader.entries[position]['step']}: " +
+                      f"{reader.action(position)}")
+        return
+    for position, ctrl_type, actor in reader.find_actor(args.actor,
+                                                        args.turn):
+        entry = reader.entries[position]
+        print(f"=== Step {entry['step']}, turn {entry['turn']}, " +
+              f"{ctrl_type} {args.actor}, action {reader.action(position)} ===")
+        print(json.dumps(actor, indent=2, default=str))
+    reader.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,396 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Embedded vector memory for manual and history lookups.
+
+Embeddings live in a float32 memory-mapped file which grows by doubling,
+next to a JSONL file of the matching records, so that the memory survives
+across games without any network service. Queries are answered in batches
+by one matrix product over all vectors, or, once the memory is large, over
+the vectors of the nearest clusters of an inverted file (IVF) index.
+
+Usage:
+    python -m agents.vector_memory saved_memory "Where to build a city?"
+"""
+
+import argparse
+import importlib
+import json
+import os
+import re
+import threading
+import zlib
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: the directory is not locked.
+    fcntl = None
+
+from civrealm.freeciv.utils.freeciv_logging import fc_logger
+
+import config
+
+VECTORS_FILE = "vectors.f32"
+RECORDS_FILE = "records.jsonl"
+STATE_FILE = "state.json"
+IVF_FILE = "ivf.npy"
+LOCK_FILE = ".lock"
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+# Manual chunks are split at paragraphs, up to this many characters.
+CHUNK_CHARS = 800
+
+
+def hashing_embedding(texts: list, dim: int = config.MEMORY_DIM) -> np.ndarray:
+    """
+    Signed feature hashing of the words and word pairs of `texts`, into
+    L2-normalized rows of `dim` dimensions.
+    """
+    out = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        tokens = TOKEN_PATTERN.findall(text.lower())
+        for feature in tokens + [
+                f"{first} {second}"
+                for first, second in zip(tokens, tokens[1:])
+        ]:
+            digest = zlib.crc32(feature.encode("utf-8"))
+            out[row, digest % dim] += -1.0 if digest >> 31 else 1.0
+    norms = np.linalg.norm(out, axis=1, keepdims=True)
+    return out / np.maximum(norms, 1e-12)
+
+
+def load_embedding(spec: str = config.MEMORY_EMBEDDING) -> callable:
+    """The embedding function of `spec`, "hashing" or "module:function"."""
+    if spec == "hashing":
+        return hashing_embedding
+    module, _, name = spec.partition(":")
+    return getattr(importlib.import_module(module), name)
+
+
+def split_chunks(text: str, size: int = CHUNK_CHARS) -> list:
+    """Split `text` at blank lines into chunks of at most about `size`."""
+    chunks, current = [], ""
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if current and len(current) + len(paragraph) > size:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class VectorMemory:
+    """
+    Parameters
+    ----------
+    directory: str, where the vectors and records are kept.
+    embed: callable, maps a list of texts to an array of embeddings. Its
+        vectors should be L2-normalized, scores are dot products.
+    ivf_min_size: int, size from which searches use the IVF index.
+    ivf_lists: int, number of clusters of the IVF index.
+    ivf_probes: int, number of clusters searched per query.
+
+    The directory is locked for the life of the memory, opening it from a
+    second process raises a RuntimeError: give each worker its own.
+    """
+    def __init__(self,
+                 directory: str = config.MEMORY_DIRECTORY,
+                 embed: callable = None,
+                 ivf_min_size: int = config.MEMORY_IVF_MIN_SIZE,
+                 ivf_lists: int = config.MEMORY_IVF_LISTS,
+                 ivf_probes: int = config.MEMORY_IVF_PROBES):
+        self.directory = directory
+        self.embed = embed or load_embedding()
+        self.ivf_min_size = ivf_min_size
+        self.ivf_lists = ivf_lists
+        self.ivf_probes = ivf_probes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = self._lock_directory()
+
+        state = self._read_state()
+        self.dim = np.asarray(self.embed(["dim"])).shape[1]
+        if state.get("dim", self.dim) != self.dim:
+            raise ValueError(f"{directory} holds {state['dim']}-dimensional " +
+                             f"embeddings, the embedding gives {self.dim}.")
+        self.documents = state.get("documents", {})
+        self._write_state()
+        # Records are appended after their vectors: they are authoritative.
+        self.records = self._read_records()
+        self.count = len(self.records)
+        self.kinds = np.array(
+            [record.get("kind") == "manual" for record in self.records],
+            dtype=bool)
+        self.capacity = 0
+        self.vectors = None
+        self._map(max(1024, self.count))
+
+        self.centroids = None
+        self.assignments = None
+        self.trained_count = 0
+        path = os.path.join(directory, IVF_FILE)
+        if os.path.exists(path):
+            self.centroids = np.load(path)
+            self.trained_count = self.count
+            self.assignments = self._assign(self.vectors[:self.count])
+
+    def _lock_directory(self):
+        lock_file = open(os.path.join(self.directory, LOCK_FILE), "a")
+        if fcntl is None:
+            return lock_file
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            raise RuntimeError(f"{self.directory} is used by another " +
+                               "process, give each its own directory.")
+        return lock_file
+
+    def _read_state(self) -> dict:
+        try:
+            with open(os.path.join(self.directory, STATE_FILE), "r") as filep:
+                return json.load(filep)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_state(self):
+        path = os.path.join(self.directory, STATE_FILE)
+        with open(path + ".tmp", "w") as filep:
+            json.dump({"dim": self.dim, "documents": self.documents}, filep)
+        os.replace(path + ".tmp", path)
+
+    def _read_records(self) -> list:
+        """The records, without a line left incomplete by a crash."""
+        path = os.path.join(self.directory, RECORDS_FILE)
+        if not os.path.exists(path):
+            return []
+        records, complete = [], 0
+        with open(path, "rb") as filep:
+            for line in filep:
+                if not line.endswith(b"\n"):
+                    break
+                records.append(json.loads(line))
+                complete += len(line)
+        if complete != os.path.getsize(path):
+            with open(path, "r+b") as filep:
+                filep.truncate(complete)
+        return records
+
+    def _map(self, capacity: int):
+        """Memory-map the vectors file with room for `capacity` vectors."""
+        path = os.path.join(self.directory, VECTORS_FILE)
+        if self.vectors is not None:
+            self.vectors.flush()
+            del self.vectors
+        with open(path, "ab") as filep:
+            filep.truncate(capacity * self.dim * 4)
+        self.capacity = capacity
+        self.vectors = np.memmap(path,
+                                 dtype=np.float32,
+                                 mode="r+",
+                                 shape=(capacity, self.dim))
+
+    def _assign(self, vectors: np.ndarray) -> np.ndarray:
+        """The nearest centroid of each vector."""
+        return np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+
+    def _train(self, iterations: int = 10, sample: int = 20000):
+        """Spherical k-means of (a sample of) the vectors into IVF lists."""
+        rng = np.random.default_rng(0)
+        data = np.asarray(self.vectors[:self.count])
+        if len(data) > sample:
+            data = data[rng.choice(len(data), sample, replace=False)]
+        centroids = data[rng.choice(len(data), self.ivf_lists, replace=False)]
+        for _ in range(iterations):
+            labels = np.argmax(data @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, data)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # Empty clusters keep their centroid.
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12),
+                                 centroids)
+        self.centroids = centroids.astype(np.float32)
+        self.assignments = self._assign(self.vectors[:self.count])
+        self.trained_count = self.count
+        np.save(os.path.join(self.directory, IVF_FILE), self.centroids)
+
+    def add(self, texts: list, metadata: list = None) -> int:
+        """
+        Insert `texts` with their metadata dicts (e.g. "kind", "turn"),
+        embedded in one batch. Returns the number of vectors.
+        """
+        if not texts:
+            return self.count
+        metadata = metadata or [{} for _ in texts]
+        embeddings = np.asarray(self.embed(texts), dtype=np.float32)
+        with self._lock:
+            start, end = self.count, self.count + len(texts)
+            if end > self.capacity:
+                self._map(max(end, 2 * self.capacity))
+            self.vectors[start:end] = embeddings
+            self.vectors.flush()
+            records = [dict(meta, text=text)
+                       for text, meta in zip(texts, metadata)]
+            with open(os.path.join(self.directory, RECORDS_FILE),
+                      "a",
+                      encoding="utf-8") as filep:
+                for record in records:
+                    filep.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.records.extend(records)
+            self.kinds = np.concatenate([
+                self.kinds,
+                np.array([record.get("kind") == "manual"
+                          for record in records], dtype=bool)
+            ])
+            self.count = end
+
+            if self.count >= self.ivf_min_size and \
+                    self.count >= 2 * self.trained_count:
+                self._train()
+            elif self.centroids is not None:
+                self.assignments = np.concatenate(
+                    [self.assignments, self._assign(embeddings)])
+        return self.count
+
+    def add_document(self, path: str, kind: str = "manual") -> int:
+        """
+        Index the chunks of a text file, unless it was indexed unchanged.
+        Returns the number of chunks added.
+        """
+        mtime = os.path.getmtime(path)
+        if self.documents.get(path) == mtime:
+            return 0
+        with open(path, "r", encoding="utf-8") as filep:
+            chunks = split_chunks(filep.read())
+        self.add(chunks, [{"kind": kind, "source": path} for _ in chunks])
+        self.documents[path] = mtime
+        self._write_state()
+        return len(chunks)
+
+    def _top(self, scores: np.ndarray, ids: np.ndarray, k: int) -> list:
+        """The (score, record) of the `k` best `scores`, best first."""
+        top = min(k, len(ids))
+        if top == 0:
+            return []
+        best = np.argpartition(-scores, top - 1)[:top]
+        best = best[np.argsort(-scores[best])]
+        return [(float(scores[i]), self.records[ids[i]]) for i in best]
+
+    def search(self, queries: list, k: int = config.MEMORY_SEARCH_RESULTS,
+               kind: str = None) -> list:
+        """
+        The `k` records nearest to each query, as lists of (score, record).
+        `kind` is "manual" or "history" to search only these records.
+        """
+        embeddings = np.asarray(self.embed(queries), dtype=np.float32)
+        with self._lock:
+            count = self.count
+            vectors = self.vectors[:count]
+            keep = None
+            if kind is not None:
+                keep = self.kinds[:count] == (kind == "manual")
+            # Few records of a kind may all sit outside the probed clusters.
+            use_ivf = self.centroids is not None and (
+                keep is None or np.count_nonzero(keep) >= self.ivf_min_size)
+            if not use_ivf:
+                # One pass over the vectors for all the queries.
+                ids = np.arange(count) if keep is None else \
+                    np.flatnonzero(keep)
+                subset = vectors if keep is None else vectors[ids]
+                return [
+                    self._top(scores, ids, k)
+                    for scores in embeddings @ np.asarray(subset).T
+                ]
+            results = []
+            for query in embeddings:
+                probes = np.argsort(self.centroids @ query)[::-1][
+                    :self.ivf_probes]
+                selected = np.isin(self.assignments[:count], probes)
+                if keep is not None:
+                    selected &= keep
+                ids = np.flatnonzero(selected)
+                results.append(self._top(vectors[ids] @ query, ids, k))
+        return results
+
+    def manual_and_history_search(
+            self, look_up: str,
+            k: int = config.MEMORY_SEARCH_RESULTS) -> str:
+        """The answer of the manualAndHistorySearch command to `look_up`."""
+        lines = []
+        for kind, title in (("manual", "Manual"), ("history", "History")):
+            found = self.search([look_up], k, kind)[0]
+            if found:
+                lines.append(f"{title}:")
+                lines.extend(f"- {record['text']}" for _, record in found)
+        return "\n".join(lines) or "Nothing relevant found."
+
+    def close(self):
+        with self._lock:
+            if self.vectors is not None:
+                self.vectors.flush()
+            if not self._lock_file.closed:
+                self._lock_file.close()
+
+
+_memory = None
+_memory_lock = threading.Lock()
+
+
+def get_vector_memory():
+    """
+    The vector memory shared by all agents of the process, or None if it is
+    disabled by `config.MEMORY_ENABLED`. The manual of
+    `config.MEMORY_MANUAL_PATH` is indexed on first use.
+    """
+    global _memory
+    if not config.MEMORY_ENABLED:
+        return None
+    with _memory_lock:
+        if _memory is None:
+            _memory = VectorMemory()
+            if config.MEMORY_MANUAL_PATH:
+                try:
+                    _memory.add_document(config.MEMORY_MANUAL_PATH)
+                except OSError as einfo:
+                    fc_logger.error(f"Failed to index the manual: {einfo!r}")
+                    print(f"Failed to index the manual: {einfo!r}")
+        return _memory
+
+
+def set_vector_memory(memory):
+    """Replace the process-wide vector memory."""
+    global _memory
+    with _memory_lock:
+        _memory = memory
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory")
+    parser.add_argument("look_up")
+    parser.add_argument("-k", type=int, default=config.MEMORY_SEARCH_RESULTS)
+    args = parser.parse_args()
+    print(VectorMemory(args.directory).manual_and_history_search(
+        args.look_up, args.k))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Per-`act` scheduling overhead of a whole turn, with the ActorScheduler vs.
+the former loop rescanning `info['llm_info']` on every call, from 10 to
+1000 actors. The action choice itself is a random choice.
+
+Usage:
+    python benchmarks/actor_scheduler.py [--sizes 10 100 1000] [--turns 5]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agents.scheduler import ActorScheduler
+
+UNIT_TYPES = ("Settlers", "Workers", "Explorer", "Warriors")
+
+
+def make_llm_info(actors: int) -> dict:
+    units = {}
+    for actor_id in range(actors):
+        kind = UNIT_TYPES[actor_id % len(UNIT_TYPES)]
+        units[actor_id] = {
+            "name": f"{kind} {actor_id}",
+            "available_actions": ["fortify", "goto_0", "goto_1"],
+        }
+    return {
+        "unit": units,
+        "player": {
+            -1: {"name": "player", "available_actions": ["keep"]}
+        },
+    }
+
+
+def legacy_turn(llm_info: dict) -> int:
+    """The former `act` loop, called until the turn ends."""
+    planned_actor_ids = []
+    moves = 0
+    while True:
+        action = None
+        for ctrl_type, actors_dict in llm_info.items():
+            for actor_id in actors_dict.keys():
+                if actor_id in planned_actor_ids:
+                    continue
+                available_actions = actors_dict[actor_id]['available_actions']
+                if available_actions:
+                    planned_actor_ids.append(actor_id)
+                    action = (ctrl_type, actor_id,
+                              random.choice(available_actions))
+                    break
+            if action is not None:
+                break
+        if action is None:
+            return moves
+        moves += 1
+
+
+def scheduler_turn(llm_info: dict) -> int:
+    scheduler = ActorScheduler()
+    scheduler.new_turn(0, llm_info)
+    moves = 0
+    while True:
+        key = scheduler.next_actor(llm_info)
+        if key is None:
+            return moves
+        random.choice(llm_info[key[0]][key[1]]['available_actions'])
+        moves += 1
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--turns", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'actors':>8}{'rescan us/act':>16}{'scheduler us/act':>18}")
+    for size in args.sizes:
+        llm_info = make_llm_info(size)
+        timings = []
+        for turn in (legacy_turn, scheduler_turn):
+            start = time.perf_counter()
+            moves = 0
+            for _ in range(args.turns):
+                moves += turn(llm_info)
+            timings.append((time.perf_counter() - start) / moves * 1e6)
+        print(f"{size:>8}{timings[0]:>16.2f}{timings[1]:>18.2f}")
+
+
+if __name__ == '__main__':
+    main()
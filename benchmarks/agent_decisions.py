@@ -0,0 +1,177 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Decisions per second of the MistralAgent against the offline mock LLM,
+replaying the recorded observations as consecutive turns.
+
+Every `act` of a turn is timed until the agent has no actor left to move.
+The LLM cache and the vector memory are disabled and the rate limits are
+lifted, so that the numbers measure the agent and the simulated LLM only.
+With --router, the actors are routed through a cascade of two mock models
+(`agents.model_router`), the small one answering with --small-latency.
+Single actor answers are streamed and used as soon as they name an action,
+unless --no-stream.
+
+Usage:
+    python benchmarks/agent_decisions.py [observations_info.txt] \\
+        [--turns 5] [--latency lognormal:0.8,0.4] [--malformed 0.05] \\
+        [--rate-limit 0.02] [--server-error 0.02] [--sequential | --batch] \
+        [--router] [--small-latency lognormal:0.3,0.4] [--no-stream]
+"""
+
+import argparse
+import copy
+import os
+import pickle
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+
+config.LLM_BACKEND = "mock"
+config.LLM_CACHE_ENABLED = False
+config.MEMORY_ENABLED = False
+config.MODEL_ROUTER_ENABLED = False
+
+from agents import mistral_agent
+from agents.llm_backends import set_backend
+from agents.llm_backends.mock import MockBackend
+from agents.metrics import get_metrics
+from agents.mock_llm import MockLLMClient
+from agents.model_router import ModelRouter, set_model_router
+from agents.rate_limiter import RateLimiter, set_rate_limiter
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", nargs="?", default="observations_info.txt")
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument("--latency", default=config.MOCK_LLM_LATENCY)
+    parser.add_argument("--rate-limit", type=float, default=0.0)
+    parser.add_argument("--server-error", type=float, default=0.0)
+    parser.add_argument("--malformed", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--concurrency", type=int,
+                        default=config.LLM_MAX_CONCURRENCY)
+    parser.add_argument("--sequential", action="store_true",
+                        help="decide the actors one by one, without planning")
+    parser.add_argument("--batch", action="store_true",
+                        help="decide groups of actors with one request each")
+    parser.add_argument("--router", action="store_true",
+                        help="route the actors through a small and a large " +
+                        "mock model")
+    parser.add_argument("--small-latency", default="lognormal:0.3,0.4")
+    parser.add_argument("--no-stream", action="store_true",
+                        help="wait for the whole answers")
+    args = parser.parse_args()
+
+    with open(args.path, "rb") as filep:
+        recorded = pickle.load(filep)
+
+    client = MockLLMClient(latency=args.latency,
+                           rate_limit_rate=args.rate_limit,
+                           server_error_rate=args.server_error,
+                           malformed_rate=args.malformed,
+                           seed=args.seed)
+    set_backend(MockBackend(client))
+    router = None
+    if args.router:
+        config.MODEL_ROUTER_ENABLED = True
+        small_client = MockLLMClient(latency=args.small_latency,
+                                     malformed_rate=args.malformed,
+                                     seed=args.seed)
+        router = ModelRouter("mock",
+                             backends={
+                                 "small":
+                                 MockBackend(small_client, model="mock-small"),
+                                 "large": MockBackend(client)
+                             },
+                             costs={
+                                 "mock-small": (0.2, 0.6),
+                                 "mock": (2.0, 6.0)
+                             })
+        set_model_router(router)
+    set_rate_limiter(
+        RateLimiter(requests_per_minute=1e9, tokens_per_minute=1e12))
+    mistral_agent.save_directory = tempfile.mkdtemp(prefix="dialogues_")
+    metrics = get_metrics()
+    metrics.reset()
+
+    agent = mistral_agent.MistralAgent(planning_mode=not args.sequential,
+                                       max_concurrency=args.concurrency)
+    agent.set_agent_seed(args.seed)
+    agent.batch_prompts = args.batch
+    agent.streaming = not args.no_stream
+    act_latencies, turn_latencies = [], []
+    decisions = 0
+    start = time.perf_counter()
+    for turn in range(1, args.turns + 1):
+        info = copy.copy(recorded['info'])
+        info['turn'] = turn
+        turn_start = time.perf_counter()
+        while True:
+            act_start = time.perf_counter()
+            action = agent.act(recorded['observations'], info)
+            if action is None:
+                break
+            act_latencies.append(time.perf_counter() - act_start)
+            decisions += 1
+        turn_latencies.append(time.perf_counter() - turn_start)
+    elapsed = time.perf_counter() - start
+    agent.dialogue_log.close()
+
+    counters = metrics.summary()['counters']
+    fallbacks = sum(value for name, value in counters.items()
+                    if name.startswith("agent.fallback"))
+    llm_decisions = sum(value for name, value in counters.items()
+                        if name.startswith("agent.decisions"))
+    fast_path = {name: value for name, value in counters.items()
+                 if name.startswith("fast_path.")}
+    mode = "sequential" if args.sequential else \
+        f"planning x{args.concurrency}" + (", batched" if args.batch else "")
+    mode += "" if args.no_stream else ", streamed"
+    print(f"Mode: {mode}, latency: {args.latency}, seed: {args.seed}")
+    print(f"Decisions: {decisions} in {args.turns} turns, {elapsed:.2f}s")
+    print(f"Decisions/sec: {decisions / elapsed:.2f}")
+    print(f"act() latency p50: {percentile(act_latencies, 50) * 1000:.2f}ms" +
+          f", p99: {percentile(act_latencies, 99) * 1000:.2f}ms")
+    print(f"Turn latency p50: {percentile(turn_latencies, 50):.3f}s, " +
+          f"p99: {percentile(turn_latencies, 99):.3f}s")
+    print(f"Fallback rate: {fallbacks / max(1, llm_decisions):.1%} " +
+          f"({fallbacks}/{llm_decisions})")
+    print(f"Fast path: {sum(fast_path.values())} decisions without the " +
+          f"LLM {fast_path}")
+    print(f"Mock LLM: {client.stats()}")
+    if router is not None:
+        for tier, stats in router.stats().items():
+            print(f"Tier {tier} ({stats['model']}): " +
+                  f"{stats['requests']} requests, " +
+                  f"{stats['escalation_rate']:.1%} escalated, " +
+                  f"mean latency {stats['latency']:.3f}s, " +
+                  f"${stats['cost']:.4f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Zoomed-out map of a synthetic game map: per-turn cost of the incremental
+`MapAggregator` vs. recomputing all the blocks, and vs. counting each block
+with per-name Python loops as the `upper_map` of the actors is built.
+
+Usage:
+    python benchmarks/map_aggregator.py [--size 80 50] [--turns 50] \\
+        [--moves 20]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agents.map_aggregator import NO_OWNER, MapAggregator
+
+
+def make_map(rng: np.random.Generator, xsize: int, ysize: int) -> dict:
+    status = rng.integers(0, 3, (xsize, ysize)).astype(np.uint16)
+    terrain = rng.integers(2, 14, (xsize, ysize)).astype(np.uint16)
+    terrain[status == 0] = NO_OWNER
+    owners = np.full((xsize, ysize), NO_OWNER, dtype=np.uint16)
+    return {
+        "status": status,
+        "terrain": terrain,
+        "extras": rng.random((xsize, ysize, 34)) < 0.05,
+        "output": np.zeros((xsize, ysize, 6), dtype=np.uint16),
+        "tile_owner": owners.copy(),
+        "city_owner": owners.copy(),
+        "unit": np.zeros((xsize, ysize, 52), dtype=np.uint16),
+        "unit_owner": owners.copy(),
+    }
+
+
+def move_units(rng: np.random.Generator, map_state: dict, moves: int):
+    """Move `moves` units and reveal the tiles around them."""
+    xsize, ysize = map_state['terrain'].shape
+    map_state['unit'][:] = 0
+    map_state['unit_owner'][:] = NO_OWNER
+    for _ in range(moves):
+        x, y = rng.integers(0, xsize), rng.integers(0, ysize)
+        map_state['unit'][x, y, rng.integers(0, 52)] += 1
+        map_state['unit_owner'][x, y] = 0
+        map_state['status'][max(0, x - 1):x + 2, max(0, y - 1):y + 2] = 2
+
+
+def loop_blocks(map_state: dict, size: int = 5) -> dict:
+    """Per block and per name counting, as the actors' upper_map."""
+    out = {}
+    xsize, ysize = map_state['terrain'].shape
+    for bx in range(0, xsize, size):
+        for by in range(0, ysize, size):
+            terrain = map_state['terrain'][bx:bx + size, by:by + size]
+            extras = map_state['extras'][bx:bx + size, by:by + size]
+            units = map_state['unit'][bx:bx + size, by:by + size]
+            counts = [int((terrain == terrain_id).sum())
+                      for terrain_id in range(14)]
+            counts += [int(extras[:, :, extra_id].sum())
+                       for extra_id in range(extras.shape[2])]
+            counts += [int(units[:, :, unit_id].sum())
+                       for unit_id in range(units.shape[2])]
+            out[(bx, by)] = counts
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, nargs=2, default=[80, 50])
+    parser.add_argument("--turns", type=int, default=50)
+    parser.add_argument("--moves", type=int, default=20,
+                        help="units moving per turn")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    map_state = make_map(rng, *args.size)
+    incremental = MapAggregator()
+    timings = {"incremental": 0.0, "full": 0.0, "loops": 0.0}
+    recomputed = 0
+    for _ in range(args.turns):
+        move_units(rng, map_state, args.moves)
+        start = time.perf_counter()
+        recomputed += incremental.update(map_state)
+        incremental.zoomed_out_map(0)
+        timings["incremental"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        full = MapAggregator()
+        full.update(map_state)
+        full.zoomed_out_map(0)
+        timings["full"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        loop_blocks(map_state)
+        timings["loops"] += time.perf_counter() - start
+
+    blocks = incremental.shape[0] * incremental.shape[1]
+    print(f"Map {args.size[0]}x{args.size[1]}, {blocks} blocks, " +
+          f"{args.moves} units moving per turn")
+    print(f"Blocks recomputed per turn: {recomputed / args.turns:.1f}")
+    for name, elapsed in timings.items():
+        print(f"{name:>12}: {elapsed / args.turns * 1000:.2f}ms per turn")
+
+
+if __name__ == '__main__':
+    main()
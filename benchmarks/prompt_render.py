@@ -0,0 +1,102 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Renders per second of the prompt templates in `prompt_collections/`, with
+the compiled templates of BasePromptHandler vs. the former parser which
+re-scanned the raw template on every generation.
+
+Usage:
+    python benchmarks/prompt_render.py [--seconds 1.0]
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from agents.prompt_handlers.base_prompt_handler import (BasePromptHandler,
+                                                        PROMPT_ROOT_DIR)
+
+
+def legacy_render(handler, raw: str, template_name: str, kwargs: dict) -> str:
+    """The former `_txt_parser` generation, without its logging."""
+    variables = set(re.findall("(<%[ ]+(.*?)[ ]+%>)", raw))
+    recursions = set(re.findall(r"(<\$[ ]+(.*?)[ ]+\$>)", raw))
+    out = raw
+    for pattern, key in variables:
+        out = out.replace(pattern, str(kwargs.get(key, "")))
+    for pattern, key in recursions:
+        try:
+            func_end = key.find("(")
+            if func_end == -1:
+                key = key + "()"
+                func_end = -2
+            if key[:func_end] == template_name:
+                raise Exception("Self-quoted!")
+            replace = eval("handler." + key)
+        except Exception:
+            replace = ""
+        out = out.replace(pattern, replace)
+    return out
+
+
+def renders_per_second(render, seconds: float) -> float:
+    count = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while time.perf_counter() < deadline:
+        for _ in range(100):
+            render()
+        count += 100
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=1.0)
+    args = parser.parse_args()
+
+    print(f"{'template':<56}{'legacy/s':>12}{'compiled/s':>12}{'speedup':>9}")
+    for collection in sorted(os.listdir(PROMPT_ROOT_DIR)):
+        with contextlib.redirect_stdout(io.StringIO()):
+            handler = BasePromptHandler(collection)
+        for name, template in sorted(handler.templates.items()):
+            prefix = next(prefix for prefix in handler.related_pclasses
+                          if os.path.exists(prefix + name + ".txt"))
+            with open(prefix + name + ".txt", "r", encoding="utf-8") as filep:
+                raw = filep.read()
+            kwargs = {
+                key: f"<{key}>"
+                for key in re.findall("<%[ ]+(.*?)[ ]+%>", raw)
+            }
+            with contextlib.redirect_stdout(io.StringIO()):
+                legacy = renders_per_second(
+                    lambda: legacy_render(handler, raw, name, kwargs),
+                    args.seconds)
+                compiled = renders_per_second(lambda: template(**kwargs),
+                                              args.seconds)
+            print(f"{collection + '/' + name:<56}{legacy:>12.0f}" +
+                  f"{compiled:>12.0f}{compiled / legacy:>8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
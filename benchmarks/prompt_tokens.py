@@ -0,0 +1,63 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tokens per actor prompt, verbose JSON vs. compact encoding, over the
+recorded observations.
+
+Usage:
+    python benchmarks/prompt_tokens.py [observations_info.txt] [--budget N]
+"""
+
+import argparse
+import os
+import pickle
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agents.prompt_encoder import (ActorPromptEncoder, count_tokens,
+                                   verbose_actor_prompt)
+import config
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", nargs="?", default="observations_info.txt")
+    parser.add_argument("--budget", type=int, default=config.PROMPT_TOKEN_BUDGET)
+    args = parser.parse_args()
+
+    with open(args.path, "rb") as filep:
+        recorded = pickle.load(filep)
+    encoder = ActorPromptEncoder(token_budget=args.budget)
+
+    before, after = [], []
+    print(f"{'actor':<24}{'verbose':>10}{'compact':>10}")
+    for actors_dict in recorded['info']['llm_info'].values():
+        for actor in actors_dict.values():
+            before.append(count_tokens(verbose_actor_prompt(actor)))
+            after.append(count_tokens(encoder.prompt(actor)))
+            print(f"{actor['name']:<24}{before[-1]:>10}{after[-1]:>10}")
+    if not before:
+        print("No actors in the recorded observations.")
+        return
+    mean_before = sum(before) / len(before)
+    mean_after = sum(after) / len(after)
+    print(f"{'mean':<24}{mean_before:>10.1f}{mean_after:>10.1f}")
+    print(f"Compact prompts use {mean_after / mean_before:.1%} of the tokens " +
+          f"(budget {args.budget}).")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Startup cost of the agents package, as paid by every evaluation worker:
+the `python -X importtime` report of `import agents` and of importing the
+MistralAgent, then the time to the first action of a fresh process
+(import, construction, first `act`) against the mock LLM.
+
+Usage:
+    python benchmarks/startup.py [observations_info.txt] [--top 15] \\
+        [--runs 5]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run in a fresh process, from the repository root: prints the import,
+# construction and first action times in seconds.
+FIRST_ACTION = """
+import pickle, sys, tempfile, time
+start = time.perf_counter()
+import config
+config.LLM_BACKEND = "mock"
+config.LLM_CACHE_ENABLED = False
+config.MEMORY_ENABLED = False
+config.MOCK_LLM_LATENCY = "const:0"
+from agents import MistralAgent
+from agents import mistral_agent
+imported = time.perf_counter()
+mistral_agent.save_directory = tempfile.mkdtemp(prefix="dialogues_")
+agent = MistralAgent()
+constructed = time.perf_counter()
+path = sys.argv[1]
+if path:
+    with open(path, "rb") as filep:
+        recorded = pickle.load(filep)
+    observation, info = recorded['observations'], recorded['info']
+else:
+    config.ADVISOR_ENABLED = False
+    observation, info = {}, {"turn": 1, "llm_info": {"unit": {101: {
+        "name": "Settlers", "observations": {},
+        "available_actions": ["fortify", "build_city", "move North"]}}}}
+agent.act(observation, info)
+acted = time.perf_counter()
+agent.dialogue_log.close()
+print(imported - start, constructed - imported, acted - constructed)
+"""
+
+
+def import_times(statement: str) -> list:
+    """(cumulative us, module) of `python -X importtime -c statement`."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                             statement],
+                            cwd=ROOT,
+                            capture_output=True,
+                            text=True,
+                            check=True)
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        times.append((int(cumulative), module.rstrip()))
+    return times
+
+
+def report_imports(statement: str, top: int):
+    # Leave out what the interpreter imports at startup (site, ...).
+    startup = {module for _, module in import_times("pass")}
+    times = [(cumulative, module)
+             for cumulative, module in import_times(statement)
+             if module not in startup]
+    # Top level modules are not indented: their times add up to the total.
+    total = sum(cumulative for cumulative, module in times
+                if not module.startswith("  "))
+    print(f"{statement}: {total / 1000:.1f} ms, {len(times)} modules")
+    for cumulative, module in sorted(times, reverse=True)[:top]:
+        print(f"  {cumulative / 1000:8.1f} ms {module.strip()}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", nargs="?", default="observations_info.txt")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    report_imports("import agents", args.top)
+    report_imports("from agents import MistralAgent", args.top)
+
+    path = os.path.abspath(args.path) if os.path.exists(args.path) else ""
+    runs = []
+    for _ in range(args.runs):
+        result = subprocess.run([sys.executable, "-c", FIRST_ACTION, path],
+                                cwd=ROOT,
+                                capture_output=True,
+                                text=True,
+                                check=True)
+        runs.append([float(value)
+                     for value in result.stdout.splitlines()[-1].split()])
+    print(f"time to first action ({'recorded' if path else 'synthetic'} " +
+          f"observations, median of {args.runs} processes):")
+    for index, stage in enumerate(["import", "construct", "first act"]):
+        print(f"  {stage:10s} " +
+              f"{statistics.median(run[index] for run in runs) * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
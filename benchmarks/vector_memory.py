@@ -0,0 +1,94 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Insert and search latency of the local vector memory, brute force vs. IVF,
+on synthetic decision histories of growing size.
+
+Usage:
+    python benchmarks/vector_memory.py [--sizes 1000 10000 100000] \\
+        [--queries 200] [--batch 100]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agents.vector_memory import VectorMemory
+
+WORDS = ("Settlers", "Workers", "Explorer", "Warriors", "city", "river",
+         "hills", "coast", "plant", "irrigation", "road", "goto", "fortify",
+         "build_city", "hut", "forest", "grassland", "enemy", "border")
+
+
+def make_texts(rng: random.Random, count: int, turn: int) -> list:
+    return [
+        f"Turn {turn}: {rng.choice(WORDS[:4])} {actor_id} near " +
+        f"{rng.choice(WORDS[4:])} and {rng.choice(WORDS[4:])} chose " +
+        f"{rng.choice(WORDS[8:14])}" for actor_id in range(count)
+    ]
+
+
+def run(size: int, queries: int, batch: int, ivf: bool) -> dict:
+    rng = random.Random(0)
+    memory = VectorMemory(tempfile.mkdtemp(prefix="memory_"),
+                          ivf_min_size=min(size, 10000) if ivf else size + 1)
+    start = time.perf_counter()
+    for turn in range(0, size, batch):
+        texts = make_texts(rng, min(batch, size - turn), turn)
+        memory.add(texts, [{"kind": "history", "turn": turn}] * len(texts))
+    insert = time.perf_counter() - start
+    looks = make_texts(rng, queries, -1)
+    start = time.perf_counter()
+    for look_up in looks:
+        memory.search([look_up])
+    search = time.perf_counter() - start
+    start = time.perf_counter()
+    memory.search(looks)
+    batched = time.perf_counter() - start
+    return {
+        "insert_us": insert / size * 1e6,
+        "search_ms": search / queries * 1000,
+        "batched_ms": batched / queries * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[1000, 10000, 100000])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--batch", type=int, default=100,
+                        help="decisions inserted per turn")
+    args = parser.parse_args()
+
+    print(f"{'vectors':>8} {'index':>6} {'insert/vec':>11} " +
+          f"{'search':>9} {'batched':>9}")
+    for size in args.sizes:
+        for ivf in (False, True):
+            result = run(size, args.queries, args.batch, ivf)
+            print(f"{size:>8} {'ivf' if ivf else 'brute':>6} " +
+                  f"{result['insert_us']:>9.1f}us " +
+                  f"{result['search_ms']:>7.3f}ms " +
+                  f"{result['batched_ms']:>7.3f}ms")
+
+
+if __name__ == '__main__':
+    main()
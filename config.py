@@ -1,5 +1,7 @@
 # Configuration mainly for the MastabaAgent Solution
 
+import os
+
 INDIVIDUAL_PROMPT_DEFAULT = True
 
 PROMPT_SOLUTIONS_DICT = {
@@ -29,3 +31,255 @@ class DictDefaultWrapper(dict):
 
 
 PROMPT_SOLUTIONS = DictDefaultWrapper(PROMPT_SOLUTIONS_DICT)
+
+# Model cascade of the MistralAgent, see `agents.model_router`. MODEL_TIERS
+# are the models of each backend by tier, MODEL_TIER_ORDER the tiers from
+# the cheapest. MODEL_ROUTES gives the first tier of each actor type,
+# ctrl_type or "_final" for the others, possibly per turn phase: "opening"
+# for the first MODEL_ROUTER_OPENING_TURNS turns, then "game". An answer
+# failing validation, or whose "confidence" is below
+# MODEL_ROUTER_MIN_CONFIDENCE, is asked again to the next tier. Costs are in
+# dollars per million prompt and completion tokens. Setting LLM_MODEL pins
+# every request to that model.
+MODEL_ROUTER_ENABLED = True
+MODEL_TIERS = {
+    "mistral": {
+        "small": "mistral-small-latest",
+        "large": "mistral-large-latest"
+    },
+    "openai": {
+        "small": "gpt-4o-mini",
+        "large": "gpt-4o"
+    },
+    "local": {
+        "large": "default"
+    },
+    "mock": {
+        "small": "mock-small",
+        "large": "mock"
+    },
+}
+MODEL_TIER_ORDER = ("small", "large")
+MODEL_ROUTES_DICT = {
+    "advisor": "large",
+    "player": "large",
+    "city": {
+        "opening": "large",
+        "game": "small"
+    },
+    "Settlers": {
+        "opening": "large",
+        "game": "small"
+    },
+    "_final": "small",
+}
+MODEL_ROUTES = DictDefaultWrapper(MODEL_ROUTES_DICT)
+MODEL_ROUTER_OPENING_TURNS = 30
+MODEL_ROUTER_MIN_CONFIDENCE = 0.6
+MODEL_COSTS = {
+    "mistral-small-latest": (0.2, 0.6),
+    "mistral-large-latest": (2.0, 6.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-4o": (2.5, 10.0),
+}
+
+
+# Configuration for the MistralAgent
+
+# If True, all actors of a turn are decided with concurrent LLM requests at
+# the first `act` of the turn, and the decisions are drained one per `act`.
+PLANNING_MODE = True
+
+# Without planning mode, decide the next PREFETCH_DEPTH actors of the turn in
+# the background while the environment executes the current action; 0
+# disables prefetching.
+PREFETCH_DEPTH = 2
+
+# Upper bound of concurrent LLM requests issued by one agent.
+LLM_MAX_CONCURRENCY = 8
+
+# Time budget of the decisions, in seconds (None: no limit). An actor whose
+# LLM answer takes more than DECISION_TIMEOUT, or comes after TURN_TIME_BUDGET
+# seconds of the turn, takes the action of the first DECISION_FALLBACKS tier
+# having one: "cache" (cached answer to its full prompt), "guess" (what the
+# LLM chose most for the same actor type and actions), "previous" (its action
+# of the previous turn) or "random". Late answers are still logged and cached.
+DECISION_TIMEOUT = 20.0
+TURN_TIME_BUDGET = 180.0
+DECISION_FALLBACKS = ("cache", "guess", "previous", "random")
+
+# Client-side rate limiting of LLM requests, shared by all agents of the
+# process. Size the buckets from the quota of the API key.
+LLM_REQUESTS_PER_MINUTE = 60
+LLM_TOKENS_PER_MINUTE = 500000
+# Retries of rate limits, server errors and timeouts, with exponential
+# backoff (seconds) and full jitter. A Retry-After header is honoured up to
+# LLM_BACKOFF_CAP. Only these errors count towards the circuit breaker.
+LLM_MAX_RETRIES = 6
+LLM_BACKOFF_BASE = 0.5
+LLM_BACKOFF_CAP = 30.0
+# Number of retries that can be spent before successes refill the budget.
+LLM_RETRY_BUDGET = 20
+# Stop querying the LLM after this many consecutive failures, and try again
+# after the timeout (seconds). Agents fall back to random choices meanwhile.
+LLM_CIRCUIT_FAILURE_THRESHOLD = 5
+LLM_CIRCUIT_RESET_TIMEOUT = 30.0
+
+# Persistent prompt -> response cache of LLM decisions, shared by all agents
+# of the process. Set LLM_CACHE_PATH to None for a memory-only cache.
+LLM_CACHE_ENABLED = True
+LLM_CACHE_PATH = "llm_cache.sqlite3"
+LLM_CACHE_MEMORY_SIZE = 4096
+LLM_CACHE_MAX_ENTRIES = 200000
+# Seconds before an entry expires.
+LLM_CACHE_MAX_AGE = 30 * 24 * 3600
+
+# Dialogue log, written by a background thread into rotating gzip JSONL
+# segments of `saved_dialogues/`. Read it with `python -m agents.dialogue_log`.
+DIALOGUE_SEGMENT_RECORDS = 5000
+DIALOGUE_QUEUE_SIZE = 10000
+DIALOGUE_BATCH_SIZE = 256
+# Seconds between two flushes of the log.
+DIALOGUE_FLUSH_INTERVAL = 1.0
+
+# Serialize actors into compact prompts (tile grid, grouped actions) instead
+# of indented JSON. Details are dropped until the prompt fits the budget,
+# counted in tokens of the tiktoken encoding.
+COMPACT_PROMPTS = True
+PROMPT_TOKEN_BUDGET = 700
+PROMPT_TOKEN_ENCODING = "cl100k_base"
+
+# Order in which the actors of a turn are moved, lower first: by actor type
+# (the name without its id, e.g. "Settlers") or else by ctrl_type.
+ACTOR_PRIORITIES = {
+    "city": 0,
+    "Settlers": 1,
+    "Workers": 2,
+    "unit": 3,
+    "Explorer": 4,
+    "tech": 5,
+    "gov": 6,
+    "player": 7,
+}
+ACTOR_DEFAULT_PRIORITY = 8
+
+# Follow-up requests about an actor only send the changes since its last
+# request, after the last ACTOR_CONTEXT_HISTORY exchanges; a full prompt is
+# sent every ACTOR_CONTEXT_RESYNC requests. The history must hold all the
+# exchanges since the full prompt: at least ACTOR_CONTEXT_RESYNC - 1.
+# Needs COMPACT_PROMPTS.
+ACTOR_CONTEXT_ENABLED = True
+ACTOR_CONTEXT_HISTORY = 4
+ACTOR_CONTEXT_RESYNC = 5
+
+# In planning mode, decide groups of actors with one request each: actors are
+# grouped by unit type ("unit_type") or by "ctrl_type", up to
+# BATCH_MAX_ACTORS actors and BATCH_TOKEN_BUDGET prompt tokens per group.
+BATCH_PROMPTS = False
+BATCH_GROUP_BY = "unit_type"
+BATCH_MAX_ACTORS = 8
+BATCH_TOKEN_BUDGET = 4000
+
+# Decision fast path: actors decided by rules, without an LLM request.
+# - single option: the only available action.
+# - passive: actors whose actions all are variants of FAST_PATH_PASSIVE_ACTIONS
+#   take the first of them available.
+# - rules: per actor type, actions taken whenever available, in order.
+# - continue: FAST_PATH_CONTINUE_ACTION for at most FAST_PATH_CONTINUE_TURNS
+#   turns after a multi-turn activity, while the actions stay unchanged.
+# - learned: the action the LLM chose at least FAST_PATH_LEARNED_MIN_SAMPLES
+#   times with FAST_PATH_LEARNED_MIN_AGREEMENT agreement for the same actor
+#   type and set of actions, in this run and the last
+#   FAST_PATH_LEARNED_SEGMENTS segments of the saved dialogues.
+FAST_PATH_ENABLED = True
+FAST_PATH_PASSIVE_ACTIONS = ("fortify", "sentry", "keep_activity", "no_op")
+FAST_PATH_RULES = {"Explorer": ["explore"]}
+FAST_PATH_CONTINUED_ACTIONS = ("fortify", "sentry", "explore", "plant",
+                               "irrigation", "mine", "build_road", "pillage")
+FAST_PATH_CONTINUE_ACTION = "keep_activity"
+FAST_PATH_CONTINUE_TURNS = 3
+FAST_PATH_LEARNED = True
+FAST_PATH_LEARNED_MIN_SAMPLES = 5
+FAST_PATH_LEARNED_MIN_AGREEMENT = 0.9
+FAST_PATH_LEARNED_SEGMENTS = 4
+
+# Local vector memory behind the manualAndHistorySearch command, replacing
+# Pinecone: embeddings memory-mapped in MEMORY_DIRECTORY, kept across games.
+# MEMORY_EMBEDDING is "hashing" (feature hashing into MEMORY_DIM dimensions,
+# no model needed) or "module:function" mapping a list of texts to an array
+# of embeddings. Searches are brute force below MEMORY_IVF_MIN_SIZE vectors,
+# then probe the MEMORY_IVF_PROBES nearest of MEMORY_IVF_LISTS clusters.
+# MEMORY_MANUAL_PATH is a text file of the game manual, indexed once.
+# Off by default: no prompt asks for the command yet, the memory is only
+# reached through MistralAgent.manual_and_history_search. One process at a
+# time may open a MEMORY_DIRECTORY.
+MEMORY_ENABLED = False
+MEMORY_DIRECTORY = "saved_memory"
+MEMORY_EMBEDDING = "hashing"
+MEMORY_DIM = 256
+MEMORY_IVF_MIN_SIZE = 20000
+MEMORY_IVF_LISTS = 64
+MEMORY_IVF_PROBES = 8
+MEMORY_MANUAL_PATH = None
+MEMORY_SEARCH_RESULTS = 5
+
+# Advisor: once per turn, one LLM request over the empire summary and the
+# zoomed-out map (blocks of MAP_BLOCK_SIZE x MAP_BLOCK_SIZE tiles, at most
+# ADVISOR_MAX_BLOCKS of them), with the prompts of the "vanilla" solution.
+# Its advice is sent with every actor request of the turn.
+ADVISOR_ENABLED = True
+MAP_BLOCK_SIZE = 5
+ADVISOR_MAX_BLOCKS = 30
+
+# Seconds between two checks of the mtime of a prompt template, for hot
+# reloading the edited prompt files. None disables hot reloading.
+PROMPT_RELOAD_INTERVAL = 2.0
+
+# Timing spans, token counts and fallback counters of the agent loop, kept in
+# in-memory histograms. Snapshots are appended every METRICS_EXPORT_INTERVAL
+# seconds to METRICS_EXPORT_PATH, as CSV if it ends with ".csv" else as JSONL.
+METRICS_ENABLED = True
+METRICS_EXPORT_PATH = "metrics.jsonl"
+METRICS_EXPORT_INTERVAL = 30.0
+
+# LLM backend queried by the MistralAgent, see `agents.llm_backends`:
+# "mistral" (needs MISTRAL_API_KEY), "openai" (OpenAI or Azure OpenAI, see
+# README), "local" (OpenAI-compatible server at LOCAL_LLM_URL, e.g. vLLM or
+# llama.cpp) or "mock", the offline stand-in of `agents.mock_llm`.
+# Overridden by $LLM_BACKEND, and the model by $LLM_MODEL.
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "mistral")
+LLM_MODELS = {
+    "mistral": "mistral-large-latest",
+    "openai": "gpt-4o-mini",
+    "local": "default",
+    "mock": "mock",
+}
+LLM_MODEL = os.environ.get("LLM_MODEL")
+# Seconds before an LLM request times out, and kept-alive connections per
+# backend.
+LLM_REQUEST_TIMEOUT = 60.0
+LLM_POOL_SIZE = 16
+# Streamed answers of single actors: the answer is used as soon as it names
+# an available action (and, with the model router, its confidence).
+# LLM_STREAM_REST is "cancel" to close the stream there, or "background" to
+# read the rest for the dialogue log and the cache. ACTION_FIRST_ANSWERS asks
+# for the action before the reasoning, so that it is generated first.
+LLM_STREAMING = True
+LLM_STREAM_REST = "background"
+ACTION_FIRST_ANSWERS = True
+# Behaviour of the mock LLM: latency distribution in seconds (see
+# `agents.mock_llm.parse_latency`), share of it before the first streamed
+# chunk, and probabilities of injected errors.
+MOCK_LLM_LATENCY = "lognormal:0.8,0.4"
+MOCK_LLM_FIRST_CHUNK_SHARE = 0.2
+MOCK_LLM_RATE_LIMIT_RATE = 0.0
+MOCK_LLM_SERVER_ERROR_RATE = 0.0
+MOCK_LLM_MALFORMED_RATE = 0.0
+
+# Trajectory recording of the games played by main.py: observations, actors
+# and chosen action of every step, in compressed append-only segments of
+# `saved_trajectories/`. Read them with `python -m agents.trajectory`.
+TRAJECTORY_RECORDING = True
+TRAJECTORY_DIRECTORY = "saved_trajectories"
+TRAJECTORY_SEGMENT_BYTES = 256 * 1024 * 1024
+TRAJECTORY_COMPRESS_LEVEL = 3
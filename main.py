@@ -14,6 +14,7 @@
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import pickle
+import time
 import warnings
 import gymnasium
 import civrealm
@@ -23,34 +24,52 @@ from civrealm.configs import fc_args
 from civrealm.envs.freeciv_wrapper.llm_wrapper import LLMWrapper
 from agents.utils import print_step, print_action, print_current
 from agents import utils
+from agents.metrics import get_metrics, format_summary
+from agents.trajectory import TrajectoryRecorder
+import config
 
 # FIXME: This is a hack to suppress the warning about the gymnasium spaces. Currently Gymnasium does not support hierarchical actions.
 warnings.filterwarnings('ignore',
                         message='.*The obs returned by the .* method.*')
 
 
-def main():
+def run_game(env, agent, port: int = None) -> dict:
     """
-    Main
+    Play one game of `agent` in `env` until it terminates.
 
-    Main entry of the program.
-    Starts a single-player Freeciv game against rule-based AI.
-    """
-    env = gymnasium.make('civrealm/FreecivLLM-v0')
-    #env = LLMWrapper(env)
-    agent = MistralAgent()
-    # agent = BaseLangAgent()
+    Parameters
+    ----------
+    port: int, freeciv server port to play on, the port of `fc_args` if None.
 
-    observations, info = env.reset()
+    Returns
+    -------
+    stats : dict of steps, turns, elapsed seconds, game results and the
+        summary of the metrics of the game.
+    """
+    metrics = get_metrics()
+    metrics.reset()
+    recorder = TrajectoryRecorder() if config.TRAJECTORY_RECORDING else None
+    start = time.perf_counter()
+    if port is None:
+        observations, info = env.reset()
+    else:
+        observations, info = env.reset(client_port=port)
 
     done = False
     step = 0
     while not done:
         try:
-            action = agent.act(observations, info)
-            observations, reward, terminated, truncated, info = env.step(
-                action)
+            with metrics.span("agent.act"):
+                action = agent.act(observations, info)
+            if recorder is not None:
+                with metrics.span("trajectory.record"):
+                    recorder.record(step, info['turn'], observations,
+                                    info['llm_info'], action)
+            with metrics.span("env.step"):
+                observations, reward, terminated, truncated, info = env.step(
+                    action)
             done = terminated or truncated
+            metrics.maybe_export()
 
             step += 1
             print_step(f'Step: {step}, Turn: {info["turn"]}, ' +
@@ -60,12 +79,37 @@ def main():
             fc_logger.error(repr(e))
             raise e
     env.close()
+    if recorder is not None:
+        recorder.close()
     '''
     players, tags, turns, evaluations = env.evaluate_game()
     '''
     env.plot_game_scores()
-    game_results = env.get_game_results()
-    print('game results:', game_results)
+    metrics.export()
+    return {
+        'steps': step,
+        'turns': info['turn'],
+        'elapsed': time.perf_counter() - start,
+        'game_results': env.get_game_results(),
+        'metrics': metrics.summary(),
+    }
+
+
+def main():
+    """
+    Main
+
+    Main entry of the program.
+    Starts a single-player Freeciv game against rule-based AI.
+    """
+    env = gymnasium.make('civrealm/FreecivLLM-v0')
+    #env = LLMWrapper(env)
+    agent = MistralAgent()
+    # agent = BaseLangAgent()
+
+    stats = run_game(env, agent)
+    print('game results:', stats['game_results'])
+    print(format_summary(stats['metrics']))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,218 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Parallel rollouts
+
+Plays N games in worker processes, each against its own freeciv server
+port, with one LLM rate limiter and cache shared by all of them, and
+aggregates the game results and the throughput of the fleet.
+
+Usage:
+    python rollout.py --games 16 --concurrency 4 --base-port 6001 \\
+        --seeds 1 2 3 --timeout 3600 --output-dir rollouts \\
+        --output rollout_results.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import time
+import traceback
+
+import config
+
+AGENTS = ("mistral", "random")
+
+
+def run_worker(game: int, seed: int, port: int, args: dict,
+               service_address: tuple, authkey: bytes,
+               results: multiprocessing.Queue):
+    """Play one game in this worker process and report its stats."""
+    # The metrics, dialogues, trajectories and memory of the game go to its
+    # own directory, before the agents bind them as defaults on import.
+    directory = os.path.abspath(
+        os.path.join(args['output_dir'], f"game_{game}"))
+    try:
+        os.makedirs(directory, exist_ok=True)
+        for name in ("METRICS_EXPORT_PATH", "TRAJECTORY_DIRECTORY",
+                     "MEMORY_DIRECTORY"):
+            setattr(config, name, os.path.join(
+                directory, os.path.basename(getattr(config, name))))
+        import gymnasium
+        from civrealm.configs import fc_args
+        from agents.llm_service import connect_llm_service
+
+        fc_args['debug.randomly_generate_seeds'] = False
+        fc_args['debug.agentseed'] = seed
+        fc_args['client_port'] = port
+        connect_llm_service(service_address, authkey)
+
+        from main import run_game
+        from agents import MistralAgent, RandomLLMAgent, mistral_agent
+        mistral_agent.save_directory = os.path.join(directory,
+                                                    "saved_dialogues")
+        agent = MistralAgent() if args['agent'] == "mistral" else \
+            RandomLLMAgent()
+        env = gymnasium.make(args['env_id'], client_port=port)
+        stats = run_game(env, agent, port=port)
+        results.put(dict(stats, game=game, seed=seed, port=port,
+                         directory=directory, status="ok"))
+    except Exception:
+        results.put({
+            "game": game,
+            "seed": seed,
+            "port": port,
+            "directory": directory,
+            "status": "error",
+            "error": traceback.format_exc(),
+        })
+
+
+def rollout(args) -> dict:
+    """Run the games of `args`, returns the per-game and fleet stats."""
+    from agents.llm_service import start_llm_service
+
+    context = multiprocessing.get_context("spawn")
+    manager, authkey = start_llm_service()
+    results = context.Queue()
+    seeds = args.seeds or [args.base_seed + game for game in range(args.games)]
+    pending = [(game, seeds[game % len(seeds)]) for game in range(args.games)]
+    free_ports = [args.base_port + slot for slot in range(args.concurrency)]
+    running = {}
+    reports = []
+    start = time.perf_counter()
+
+    def collect(timeout: float) -> bool:
+        """Take one report off the queue, False if there was none."""
+        try:
+            report = results.get(timeout=timeout)
+        except queue.Empty:
+            return False
+        entry = running.pop(report['game'], None)
+        if entry is None:
+            # The game was already reported as timed out or crashed.
+            print(f"Game {report['game']}: dropped late report " +
+                  f"({report['status']})")
+            return True
+        reports.append(report)
+        process, port, _ = entry
+        process.join()
+        free_ports.append(port)
+        print(f"Game {report['game']} (seed {report['seed']}, port " +
+              f"{report['port']}): {report['status']}")
+        return True
+
+    def drain():
+        while collect(timeout=0):
+            pass
+
+    try:
+        while pending or running:
+            while pending and free_ports:
+                game, seed = pending.pop(0)
+                port = free_ports.pop(0)
+                process = context.Process(
+                    target=run_worker,
+                    args=(game, seed, port, vars(args), manager.address,
+                          authkey, results),
+                    name=f"rollout_{game}")
+                process.start()
+                running[game] = (process, port, time.perf_counter())
+            if collect(timeout=1.0):
+                drain()
+
+            now = time.perf_counter()
+            for game, (process, port, started) in list(running.items()):
+                if now - started > args.timeout:
+                    process.terminate()
+                    process.join()
+                    running.pop(game)
+                    free_ports.append(port)
+                    reports.append({"game": game, "port": port,
+                                    "status": "timeout"})
+                    print(f"Game {game} (port {port}): timeout")
+                elif not process.is_alive():
+                    # Give its last report a chance to arrive, other
+                    # reports may be queued before it.
+                    drain()
+                    if game in running:
+                        collect(timeout=1.0)
+                        drain()
+                    if game in running:
+                        running.pop(game)
+                        free_ports.append(port)
+                        reports.append({"game": game, "port": port,
+                                        "status": "crashed",
+                                        "exitcode": process.exitcode})
+        elapsed = time.perf_counter() - start
+        llm_stats = manager.rate_limiter().stats()
+        cache_stats = manager.llm_cache().stats() \
+            if config.LLM_CACHE_ENABLED else {}
+    finally:
+        manager.shutdown()
+
+    steps = sum(report.get('steps', 0) for report in reports)
+    llm_calls = llm_stats['requests'] - llm_stats['retries']
+    return {
+        "games": sorted(reports, key=lambda report: report['game']),
+        "fleet": {
+            "games": args.games,
+            "completed": sum(report['status'] == "ok" for report in reports),
+            "elapsed": elapsed,
+            "steps": steps,
+            "steps_per_sec": steps / elapsed,
+            # Every attempt reserves a request, retries included.
+            "llm_calls": llm_calls,
+            "llm_calls_per_sec": llm_calls / elapsed,
+            "llm_retries": llm_stats['retries'],
+            "cache": cache_stats,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel rollouts.")
+    parser.add_argument("--games", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=2,
+                        help="games played at the same time")
+    parser.add_argument("--seeds", type=int, nargs="*", default=None,
+                        help="agent seeds, cycled over the games")
+    parser.add_argument("--base-seed", type=int, default=0,
+                        help="seed of game i is base_seed + i without --seeds")
+    parser.add_argument("--base-port", type=int, default=6001,
+                        help="worker slot i plays on port base_port + i")
+    parser.add_argument("--timeout", type=float, default=3600.0,
+                        help="seconds before a game is terminated")
+    parser.add_argument("--agent", choices=AGENTS, default="mistral")
+    parser.add_argument("--env-id", default="civrealm/FreecivLLM-v0",
+                        help="gymnasium env id, e.g. of a local stub server")
+    parser.add_argument("--output-dir", default="rollouts",
+                        help="game i writes its metrics, dialogues, " +
+                        "trajectories and memory to output_dir/game_i")
+    parser.add_argument("--output", default=None,
+                        help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    out = rollout(args)
+    print(json.dumps(out['fleet'], indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as filep:
+            json.dump(out, filep, indent=2, default=str)
+
+
+if __name__ == '__main__':
+    main()